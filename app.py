@@ -4,7 +4,6 @@ import streamlit as st
 from streamlit_folium import st_folium
 import folium
 from folium import FeatureGroup, Icon # Import Icon
-import requests
 import pandas as pd
 import datetime
 from shapely import wkt
@@ -13,7 +12,6 @@ import streamlit.components.v1 as components
 from geopy.geocoders import Nominatim
 import time
 from shapely.geometry import LineString, MultiPolygon, Polygon, Point, base # Import base
-import polyline # Make sure polyline is imported
 import geopandas as gpd
 from shapely import wkt
 from shapely.errors import GEOSException # Import GEOSException
@@ -21,6 +19,19 @@ import os
 import base64
 import traceback
 import io # Import io for download button later
+from spatial_logic import SPATIAL_STORE_DIR, GeometryCache, build_dac_index, label_route_stops, load_dac_geometries, load_zip_areas, load_zip_index, memory_report, store_is_fresh
+from cache_logic import (ResponseCache, make_cache_key, DIRECTIONS_CACHE_PATH, DIRECTIONS_CACHE_TTL_SECONDS, DIRECTIONS_CACHE_MAX_ENTRIES,
+                         GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL_SECONDS, GEOCODE_NEGATIVE_TTL_SECONDS, GEOCODE_CACHE_MAX_ENTRIES)
+from concurrency_logic import DeferredMessages, HostRateLimiter, run_ordered
+from plan_logic import process_fleet_data, build_plan, assign_vehicles
+from routing_logic import GoogleDirectionsProvider, LocalGraphProvider, MatrixProvider, build_stop_matrix, route_stop_points
+from sequence_logic import optimize_routes
+from pipeline import GOOGLE_API_RATE_PER_SECOND, ROAD_GRAPH_PATH, calculate_route_feasibility, changed_routes, duplicate_route_ids, mark_routes_calculated, merge_results, route_trip_stops, validate_fleet_df
+from geocoding_logic import iter_route_batches
+from weather_logic import BAND_TEMPERATURES_F, CLIMATOLOGY_PATH, SCHOOL_YEAR_DAYS, evaluate_school_year, load_climatology, school_days
+from simulation_logic import day_profiles, route_temperatures, simulate_fleet, soc_timeline
+from charging_logic import charging_sessions, default_depot_settings, electric_depots, plan_charging
+from map_logic import ELIGIBILITY_COLORS, MapRenderCache, build_dac_overlay, build_overview_map, clamp_zoom, route_stops_key, view_needs_rebuild
 
 st.set_page_config(layout="wide") # Use wide layout for better tab spacing
 
@@ -55,6 +66,11 @@ PICKUP_COLOR = 'blue'
 DROPOFF_COLOR = 'green'
 AM_ROUTE_COLOR = 'purple'
 PM_ROUTE_COLOR = 'orange'
+ROUTE_WORKERS_DEFAULT = 8 # Parallel Directions requests in Tab 3 (1 = process routes one at a time)
+ROUTE_WORKERS_MAX = 32
+GEOCODE_WORKERS = 8 # Parallel Geocoding requests for the Tab 2 CSV upload
+ROUTE_CSV_PREVIEW_ROWS = 5 # Rows read for the Tab 2 upload preview
+STAGED_ROUTES_PREVIEW_ROWS = 20 # Latest staged routes shown while a route CSV is processed
 
 # --- Existing Helper Functions (Keep them as they are - no changes needed for tabs) ---
 # def switch_view(mode): # REMOVED - Tabs handle view switching now
@@ -69,283 +85,162 @@ def load_logo_as_base64(path):
         st.warning(f"Logo file not found at {path}. Skipping logo display.")
         return None
 
-def process_fleet_data(fleet_df):
-    # ... (keep existing function logic) ...
-    ev_fleet = fleet_df[fleet_df["Powertrain"] == "EV"].copy()
-
-    def calc_ranges(row):
-        kWh = row["Battery Capacity (kWh)"]
-        if pd.isna(kWh):
-            return pd.Series({col: None for col in ["Cold Weather Range", "Average Weather Range", "Warm Weather Range"]})
-
-        if row["Type"] == "A":
-            return pd.Series({
-                "Cold Weather Range": round((kWh * 0.8) / 2, 1),
-                "Average Weather Range": round((kWh * 0.8) / 1.5, 1),
-                "Warm Weather Range": round((kWh * 0.8) / 1.0, 1),
-            })
-        elif row["Type"] == "C":
-            return pd.Series({
-                "Cold Weather Range": round((kWh * 0.8) / 2.5, 1),
-                "Average Weather Range": round((kWh * 0.8) / 1.8, 1),
-                "Warm Weather Range": round((kWh * 0.8) / 1.5, 1),
-            })
-        else:
-            return pd.Series({col: None for col in ["Cold Weather Range", "Average Weather Range", "Warm Weather Range"]})
-
-    range_cols = ["Cold Weather Range", "Average Weather Range", "Warm Weather Range"]
-    ev_fleet[range_cols] = ev_fleet.apply(calc_ranges, axis=1)
-
-    required_cols = ["Name", "Type", "Quantity", "Battery Capacity (kWh)"] + range_cols
-    existing_cols = [col for col in required_cols if col in ev_fleet.columns]
-    return ev_fleet[existing_cols]
-
-def get_route_distance(api_key, origin, waypoints, destination, departure_time=None):
-    # ... (keep existing function logic, including error handling) ...
-    import datetime
-
-    def normalize_location(point):
-        if isinstance(point, (list, tuple)) and len(point) == 2 and all(isinstance(x, (int, float)) for x in point):
-            return point
-        elif isinstance(point, dict) and "location" in point:
-            loc = point["location"]
-            if isinstance(loc, (list, tuple)) and len(loc) == 2 and all(isinstance(x, (int, float)) for x in loc):
-                return loc
-        st.error(f"Invalid location format encountered: {point}")
-        raise ValueError(f"Invalid location format: {point}")
-
-    base_url = "https://maps.googleapis.com/maps/api/directions/json"
-    valid_waypoints = []
-    if waypoints:
-        for wp in waypoints:
-            try:
-                normalized_wp = normalize_location(wp)
-                valid_waypoints.append(f"{normalized_wp[0]},{normalized_wp[1]}")
-            except (ValueError, TypeError, IndexError) as e:
-                st.warning(f"Skipping invalid waypoint format: {wp} due to {e}")
-    waypoints_str = "|".join(valid_waypoints) if valid_waypoints else ""
-
-    try:
-        origin_norm = normalize_location(origin)
-        destination_norm = normalize_location(destination)
-    except (ValueError, TypeError, IndexError) as e:
-         st.error(f"Invalid origin or destination format: Origin={origin}, Dest={destination}, Error: {e}")
-         return None, None, [], None
-
-    departure_unix = "now"
-    if departure_time:
-        try:
-            now = datetime.datetime.now()
-            if isinstance(departure_time, str):
-                 departure_time = datetime.datetime.strptime(departure_time, "%H:%M").time()
-            elif not isinstance(departure_time, datetime.time):
-                 st.warning(f"Unexpected departure_time format: {departure_time}. Using current time.")
-                 departure_time = now.time()
-
-            days_ahead = (0 - now.weekday() + 7) % 7
-            if days_ahead == 0 and now.time() > departure_time : days_ahead = 7
-            elif days_ahead == 0 and now.time() <= departure_time: days_ahead = 0
-            next_monday = now.date() + datetime.timedelta(days=days_ahead)
-            departure_datetime = datetime.datetime.combine(next_monday, departure_time)
-            departure_unix = int(departure_datetime.timestamp())
-        except Exception as e:
-            st.warning(f"Error processing departure time '{departure_time}': {e}. Using default.")
-            departure_unix = "now"
-
-    params = {
-        "origin": f"{origin_norm[0]},{origin_norm[1]}",
-        "destination": f"{destination_norm[0]},{destination_norm[1]}",
-        "waypoints": waypoints_str,
-        "key": api_key,
-        "mode": "driving",
-    }
-    if isinstance(departure_unix, int):
-         params["traffic_model"] = "best_guess"
-         params["departure_time"] = departure_unix
-
-    try:
-        response = requests.get(base_url, params=params, timeout=20)
-        response.raise_for_status()
-        data = response.json()
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error during Google Maps API request: {e}")
-        return None, None, [], None
-    except Exception as e:
-        st.error(f"An unexpected error occurred fetching directions: {e}")
-        return None, None, [], None
-
-    if data["status"] == "OK" and data.get("routes"):
-        route_info = data["routes"][0]
-        legs = route_info.get("legs", [])
-        overview_polyline = route_info.get("overview_polyline", {}).get("points")
-        if not legs:
-             st.warning("Google Maps API returned OK status but no route legs.")
-             return None, None, [], overview_polyline
-
-        total_distance = sum(leg.get("distance", {}).get("value", 0) for leg in legs) / 1609.34
-        total_duration = sum(leg.get("duration", {}).get("value", 0) for leg in legs) / 60
-        leg_details = [{
-            "Start Address": leg.get("start_address", "N/A"),
-            "End Address": leg.get("end_address", "N/A"),
-            "Distance (mi)": round(leg.get("distance", {}).get("value", 0) / 1609.34, 2),
-            "Duration (min)": round(leg.get("duration", {}).get("value", 0) / 60, 1)
-        } for leg in legs]
-        return total_distance, total_duration, leg_details, overview_polyline
-    else:
-        st.warning(f"Google Maps API Error: {data.get('status', 'Unknown Status')}. Message: {data.get('error_message', 'No error message provided.')}")
-        return None, None, [], None
-
-def calculate_dac_overlap(overview_polyline, dac_gdf):
-    # ... (keep existing function logic) ...
-    import polyline
-    from shapely.geometry import LineString, MultiPolygon, Polygon
-    from shapely.errors import GEOSException
-
-    if not overview_polyline or not isinstance(overview_polyline, str): return 0.0
-    if dac_gdf is None or dac_gdf.empty: return 0.0
-
-    try:
-        decoded_coords = polyline.decode(overview_polyline)
-        if not decoded_coords: return 0.0
-        shapely_coords = [(lng, lat) for lat, lng in decoded_coords]
-        route_line = LineString(shapely_coords)
-        if not route_line.is_valid or route_line.is_empty: return 0.0
-
-        # Ensure 'multipolygon' is the correct geometry column name in dac_gdf
-        if 'multipolygon' not in dac_gdf.columns:
-             st.error("DAC GeoDataFrame missing 'multipolygon' geometry column.")
-             return 0.0
-        valid_dac_geoms = dac_gdf[dac_gdf.geometry.is_valid].geometry # Use the geometry accessor
-
-        total_intersection_length = 0.0
-        for dac_geom in valid_dac_geoms:
-            try:
-                 if route_line.intersects(dac_geom):
-                     intersection = route_line.intersection(dac_geom)
-                     if intersection.geom_type in ['LineString', 'MultiLineString']:
-                         total_intersection_length += intersection.length
-            except GEOSException as intersection_error: st.warning(f"Error during intersection: {intersection_error}.")
-            except Exception as general_error: st.warning(f"Unexpected error during intersection: {general_error}")
-
-        route_total_length = route_line.length
-        if route_total_length > 0:
-             overlap_percentage = (total_intersection_length / route_total_length) * 100
-             return max(0.0, min(overlap_percentage, 100.0))
-        else: return 0.0
-    except (ImportError, NameError) as import_error: st.error(f"Missing lib for DAC calc: {import_error}"); return 0.0
-    except ValueError as decode_error: st.warning(f"Error decoding polyline: {decode_error}"); return 0.0
-    except Exception as e: st.warning(f"Unexpected error calculating DAC overlap: {e}"); return 0.0
-
-
-def get_min_temperature(location):
-    # ... (keep existing placeholder function) ...
-    try:
-        if isinstance(location, (list, tuple)) and len(location) == 2 and all(isinstance(x, (int, float)) for x in location):
-            lat = location[0]
-            return 35 if lat < 40 else 45
-        else: return 45
-    except Exception: return 45
-
 def convert_df_to_csv(df): # Helper for download button later
     output = io.StringIO()
     df.to_csv(output, index=False)
     return output.getvalue().encode('utf-8')
 
+def route_summary_row(r, zips=None): # One row of the Tab 2 routes overview; zips from label_route_stops
+    row = {
+        "Route ID": r.get("route_id", "N/A"),
+        "Source": "CSV" if r.get("csv_source") else "Map", # Indicate source
+        "Depot": "Yes" if r.get("depot") else "No",
+        "Pickups": len(r.get("pickups", [])),
+        "Dropoffs": len(r.get("dropoffs", [])),
+        # Safely get bell time from the first dropoff if it exists
+        "Bell Time": r['dropoffs'][0]['bell_time'].strftime("%H:%M")
+                     if r.get('dropoffs') and len(r['dropoffs']) > 0 and r['dropoffs'][0].get('bell_time')
+                     else "N/A",
+    }
+    if zips is not None: row["Stop ZIPs"] = ", ".join(sorted({z for z in zips if z})) or "N/A"
+    return row
+
 # ------------------------ Load Data (Do this once) ---------------------
-@st.cache_data
+# cache_resource: loaded once per process and handed to every session by reference
+# (cache_data would pickle and copy these read-only datasets for each session).
+@st.cache_resource
 def load_spatial_data():
     """
-    Loads zipcode data (lat/lon) from uszips.csv and DAC spatial data.
-    Returns zipcode df, zip lookup dict, and DAC GeoDataFrame (or None).
+    Loads zipcode data (lat/lon) from uszips.csv and DAC spatial data, via the
+    binary stores in .cache/spatial (built from the CSVs on first use or change).
+    Returns the array-backed ZIP index (or None), DAC GeoDataFrame (or None) and the
+    STRtree-backed DAC index used by calculate_dac_overlap (or None).
     """
     #st.write("DEBUG: Entering load_spatial_data...")
-    zipcodes_df = pd.DataFrame()
-    zip_lookup = {}
+    zip_index = None
     # Initialize the variable that will be returned
     dac_locs_gdf = None
+    dac_index = None
 
     try:
         # --- Load and Process New Zipcode Data ---
-        #st.write("DEBUG: Attempting to load zipcode data...")
+        # Sorted int32 ZIPs + float32 centroids, memory-mapped from the binary store (spatial_logic.py)
         zip_file_path = ".data/uszips.csv"
-        zipcodes_df = pd.read_csv(zip_file_path, dtype={'zip': str})
-        #st.write(f"DEBUG: Zipcode file read. Shape: {zipcodes_df.shape}")
-
-        required_zip_cols = ['zip', 'lat', 'lng']
-        if not all(col in zipcodes_df.columns for col in required_zip_cols):
-            missing_cols_str = ", ".join(c for c in required_zip_cols if c not in zipcodes_df.columns)
-            st.error(f"Zipcode file '{zip_file_path}' missing required columns: {missing_cols_str}")
-        else:
-            zipcodes_df['zip'] = zipcodes_df['zip'].astype(str).str.zfill(5)
-            zipcodes_df.rename(columns={'lat': 'latitude', 'lng': 'longitude'}, inplace=True)
-            zip_lookup = zipcodes_df.set_index('zip')[['latitude', 'longitude']].to_dict("index")
-            #st.write("DEBUG: Zipcode processing complete. Lookup created.")
+        try:
+            zip_index = load_zip_index(zip_file_path)
+        except ValueError as zip_error:
+            st.error(str(zip_error))
 
         # --- Load and Process DAC Data ---
-        #st.write("DEBUG: Attempting to load DAC data...")
         dac_file_path = ".data/dac_file.csv"
-        dac_locs_raw = pd.read_csv(dac_file_path)
-        #st.write(f"DEBUG: DAC file read. Shape: {dac_locs_raw.shape}")
-
-        dac_locs = dac_locs_raw[dac_locs_raw['DAC_Designation'] == 'Designated as DAC'].copy()
-        required_dac_cols = ['the_geom', 'GEOID']
-        if not all(col in dac_locs.columns for col in required_dac_cols):
-             st.error(f"DAC file '{dac_file_path}' missing required columns: {required_dac_cols}")
-        else:
-            dac_locs = dac_locs[required_dac_cols]
-            def safe_wkt_load(geom_str):
-                try: return wkt.loads(geom_str)
-                except Exception: return None
-            dac_locs['multipolygon'] = dac_locs['the_geom'].apply(safe_wkt_load)
-            dac_locs = dac_locs.dropna(subset=['multipolygon'])
-            #st.write(f"DEBUG: DAC WKT loaded. Shape after dropna: {dac_locs.shape}")
-
-            if not dac_locs.empty:
+        try:
+            # DAC-designated, valid geometries only; WKT is parsed once at store build time
+            dac_geoids, dac_geometries = load_dac_geometries(dac_file_path)
+            if len(dac_geometries) > 0:
                 try:
-                     # *** FIX: Use dac_locs_gdf consistently ***
-                     temp_gdf = gpd.GeoDataFrame(dac_locs, geometry='multipolygon', crs="EPSG:4326")
-                     # Assign the potentially filtered result to the main variable
-                     dac_locs_gdf = temp_gdf[temp_gdf.is_valid].copy()
-
-                     if dac_locs_gdf.empty:
-                          st.warning("No valid DAC locations after GDF processing.")
-                          #st.write("DEBUG: dac_locs_gdf became empty after .is_valid check.") # DEBUG
-                          # Ensure it's None if empty after filtering
-                          dac_locs_gdf = None
-                     #else:
-                          #st.write(f"DEBUG: DAC GeoDataFrame assigned successfully. Shape: {dac_locs_gdf.shape}") # DEBUG
+                     dac_locs_gdf = gpd.GeoDataFrame({'GEOID': dac_geoids}, geometry=gpd.GeoSeries(dac_geometries, crs="EPSG:4326"), crs="EPSG:4326").rename_geometry('multipolygon')
                 except Exception as gdf_error:
                      st.error(f"Error creating DAC GeoDataFrame: {gdf_error}")
-                     #st.write(f"DEBUG: Error during GDF creation: {gdf_error}") # DEBUG
                      dac_locs_gdf = None # Ensure None on error
             else:
                  st.warning("No valid DAC locations found after initial processing.")
-                 #st.write("DEBUG: dac_locs DataFrame was empty before GDF creation.") # DEBUG
+        except ValueError as dac_error:
+             st.error(str(dac_error))
 
     except FileNotFoundError as e:
         st.error(f"Error loading data file: {e}. Ensure files exist in '.data/'")
         #st.write(f"DEBUG: Caught FileNotFoundError: {e}") # DEBUG
-        return pd.DataFrame(), {}, None
+        return zip_index, None, None
     except ImportError as e:
          st.error(f"Missing required spatial libraries: {e}")
          #st.write(f"DEBUG: Caught ImportError: {e}") # DEBUG
-         return zipcodes_df, zip_lookup, None
+         return zip_index, None, None
     except Exception as e:
         st.error(f"An unexpected error occurred during data loading: {e}")
         #st.write(f"DEBUG: Caught general Exception: {e}") # DEBUG
         st.error(traceback.format_exc())
         # Return current state, dac_locs_gdf might be None
-        return zipcodes_df, zip_lookup, dac_locs_gdf
+        return zip_index, dac_locs_gdf, dac_index
 
     # Final check before returning
     #st.write(f"DEBUG: Exiting load_spatial_data. dac_locs_gdf is None? {dac_locs_gdf is None}")
     #if dac_locs_gdf is not None:
          #st.write(f"DEBUG: Type of dac_locs_gdf: {type(dac_locs_gdf)}, Shape: {dac_locs_gdf.shape}")
 
+    # Build the DAC spatial index once here so route queries never re-validate polygons
+    dac_index = build_dac_index(dac_locs_gdf)
+
     # Return the potentially updated dac_locs_gdf
-    return zipcodes_df, zip_lookup, dac_locs_gdf
+    return zip_index, dac_locs_gdf, dac_index
+
+zip_index, dac_locs_gdf, dac_index = load_spatial_data()
+
+@st.cache_resource
+def load_zip_area_index():
+    """MODZCTA polygon index for offline stop -> ZIP labels, loaded once per process (None if unavailable)."""
+    modzcta_file_path = ".data/Modified_Zip_Code_Tabulation_Areas__MODZCTA_.csv"
+    if not os.path.exists(modzcta_file_path) and not store_is_fresh(os.path.join(SPATIAL_STORE_DIR, "modzcta"), modzcta_file_path): return None
+    try:
+        return load_zip_areas(modzcta_file_path)
+    except Exception as e:
+        st.warning(f"Could not load MODZCTA areas, stops will be labeled by nearest ZIP centroid: {e}")
+        return None
+
+zip_areas = load_zip_area_index()
+
+@st.cache_resource
+def load_dac_overlay():
+    """DAC polygons pre-simplified to GeoJSON per zoom level for the map overlays, built once per process (None if no DAC data)."""
+    if dac_locs_gdf is None or dac_locs_gdf.empty: return None
+    try:
+        return build_dac_overlay(dac_locs_gdf.geometry.values)
+    except Exception as e:
+        st.warning(f"Could not build the DAC map overlay: {e}")
+        return None
+
+dac_overlay = load_dac_overlay()
+
+@st.cache_resource
+def load_climatology_data():
+    """Hourly temperature climatology for the school-year range model, loaded once per process (None if no file)."""
+    if not os.path.exists(CLIMATOLOGY_PATH): return None
+    try:
+        return load_climatology(CLIMATOLOGY_PATH)
+    except Exception as e:
+        st.warning(f"Could not load temperature climatology '{CLIMATOLOGY_PATH}': {e}")
+        return None
+
+@st.cache_resource
+def get_directions_cache():
+    """One on-disk Directions response cache per process, shared by all sessions."""
+    try:
+        return ResponseCache(DIRECTIONS_CACHE_PATH, ttl_seconds=DIRECTIONS_CACHE_TTL_SECONDS, max_entries=DIRECTIONS_CACHE_MAX_ENTRIES)
+    except Exception as e:
+        st.warning(f"Directions cache unavailable, all requests will go to Google: {e}")
+        return None
+
+directions_cache = get_directions_cache()
 
-zipcodes_df, zip_lookup, dac_locs_gdf = load_spatial_data()
+@st.cache_resource
+def load_local_routing_provider():
+    """Offline routing engine over ROAD_GRAPH_PATH, loaded once per process (None if no graph file)."""
+    if not os.path.exists(ROAD_GRAPH_PATH): return None
+    try:
+        return LocalGraphProvider(ROAD_GRAPH_PATH)
+    except Exception as e:
+        st.warning(f"Could not load local road graph '{ROAD_GRAPH_PATH}': {e}")
+        return None
+
+@st.cache_resource
+def get_geocode_cache():
+    """One on-disk geocode cache per process, shared by all sessions and uploads."""
+    try:
+        return ResponseCache(GEOCODE_CACHE_PATH, ttl_seconds=GEOCODE_CACHE_TTL_SECONDS, max_entries=GEOCODE_CACHE_MAX_ENTRIES)
+    except Exception as e:
+        st.warning(f"Geocode cache unavailable, all addresses will be sent to Google: {e}")
+        return None
+
+geocode_cache = get_geocode_cache()
 
 # --- Logo Loading ---
 logo_path = ".data/nycsbus-small-logo.png"
@@ -367,6 +262,26 @@ if "results" not in st.session_state: st.session_state.results = []
 if "selected_route_id_map" not in st.session_state: st.session_state.selected_route_id_map = None
 if "selected_trip_type_map" not in st.session_state: st.session_state.selected_trip_type_map = "AM Trip"
 if "plan_results_df" not in st.session_state: st.session_state.plan_results_df = None # Added this explicitly
+if "assignment_df" not in st.session_state: st.session_state.assignment_df = None # Vehicle-level assignment (plan_logic.assign_vehicles)
+if "stop_matrix" not in st.session_state: st.session_state.stop_matrix = None # routing_logic.StopMatrix from the last bulk-mode run
+if "geometry_cache" not in st.session_state: st.session_state.geometry_cache = GeometryCache() # Decoded result polylines (spatial_logic)
+if "school_year_eval" not in st.session_state: st.session_state.school_year_eval = None # (routes, days, energy) from weather_logic.evaluate_school_year
+if "uploaded_climatology" not in st.session_state: st.session_state.uploaded_climatology = None # (upload id, Climatology), parsed once per uploaded file
+if "soc_simulation" not in st.session_state: st.session_state.soc_simulation = None # (summary, failures) from simulation_logic.simulate_fleet
+if "map_render_cache" not in st.session_state: st.session_state.map_render_cache = MapRenderCache() # Built folium maps, reused across reruns (map_logic)
+if "overview_view" not in st.session_state: st.session_state.overview_view = None # {"center", "zoom"} last reported by the Tab 4 overview map
+if "overview_map_version" not in st.session_state: st.session_state.overview_map_version = 0 # Bumped by "Fit whole plan" to reset the overview map component
+if "charging_plan" not in st.session_state: st.session_state.charging_plan = None # (depots, schedule, load) from charging_logic.plan_charging
+if "sequence_proposal" not in st.session_state: st.session_state.sequence_proposal = None # (routes, summary) from sequence_logic.optimize_routes
+if "pending_routes" not in st.session_state: st.session_state.pending_routes = None # Routes of a CSV upload in progress, swapped into routes when it finishes
+if "stop_zip_labels" not in st.session_state: st.session_state.stop_zip_labels = {} # Stop ZIP labels per route stop locations (spatial_logic.label_route_stops)
+
+PLAN_STATE_KEYS = ["plan_results_df", "assignment_df", "school_year_eval", "soc_simulation", "charging_plan"]
+
+def clear_plan_state():
+    # The plan and every Tab 4 evaluation built on it; cleared whenever routes or distances change.
+    # Add new plan-derived state to PLAN_STATE_KEYS so every reset below drops it
+    for key in PLAN_STATE_KEYS: st.session_state[key] = None
 
 # --- API Key Check (early) ---
 Maps_api_key = st.secrets.get("google_maps_api_key")
@@ -574,53 +489,8 @@ with tab1:
                                 st.session_state.ev_fleet = None
                             else:
                                 # Proceed with detailed validation if required columns exist
-                                errors = [] # Initialize list to collect validation errors
-
-                                try:
-                                    # --- Data Cleaning and Detailed Validation ---
-                                    df_upload['Name'] = df_upload['Name'].astype(str).str.strip()
-                                    df_upload['Powertrain'] = df_upload['Powertrain'].astype(str).str.strip().str.upper()
-                                    df_upload['Type'] = df_upload['Type'].astype(str).str.strip().str.upper()
-
-                                    # Validate 'Powertrain' values
-                                    invalid_powertrains = df_upload[~df_upload['Powertrain'].isin(['EV', 'GAS'])] # Allow GAS or EV
-                                    if not invalid_powertrains.empty:
-                                        errors.append(f"Invalid Powertrain values found: {invalid_powertrains['Powertrain'].unique().tolist()}. Use 'EV' or 'Gas'.")
-
-                                    # Validate 'Type' values
-                                    invalid_types = df_upload[~df_upload['Type'].isin(['A', 'C'])]
-                                    if not invalid_types.empty:
-                                        errors.append(f"Invalid Type values found: {invalid_types['Type'].unique().tolist()}. Use 'A' or 'C'.")
-
-                                    # Validate and convert 'Quantity'
-                                    df_upload['Quantity'] = pd.to_numeric(df_upload['Quantity'], errors='coerce') # Convert, turn errors into NaN
-                                    invalid_quantities = df_upload[df_upload['Quantity'].isna() | (df_upload['Quantity'] <= 0)]
-                                    if not invalid_quantities.empty:
-                                         errors.append("Found rows with missing, invalid, or zero Quantity.")
-                                    # Fill NaN with 0 after check, then convert to int - assumes 0 is acceptable if not invalid
-                                    df_upload['Quantity'] = df_upload['Quantity'].fillna(0).astype(int)
-
-
-                                    # Validate and convert 'Battery Capacity (kWh)'
-                                    if 'Battery Capacity (kWh)' not in actual_cols:
-                                         df_upload['Battery Capacity (kWh)'] = None # Add column as None if missing entirely
-                                         errors.append("Column 'Battery Capacity (kWh)' was missing; added but check EV entries.")
-                                    else:
-                                         # Convert to numeric, coercing errors. Keep as float for potential decimals.
-                                         df_upload['Battery Capacity (kWh)'] = pd.to_numeric(df_upload['Battery Capacity (kWh)'], errors='coerce')
-
-                                    # Ensure non-EVs have None or NaN battery capacity before checking EVs
-                                    df_upload.loc[df_upload['Powertrain'] != 'EV', 'Battery Capacity (kWh)'] = None
-
-                                    # Check if EVs have missing or invalid battery info AFTER setting non-EVs to None
-                                    missing_battery_evs = df_upload[(df_upload['Powertrain'] == 'EV') & (df_upload['Battery Capacity (kWh)'].isna() | (df_upload['Battery Capacity (kWh)'] <= 0))]
-                                    if not missing_battery_evs.empty:
-                                         errors.append("Found EV buses with missing or invalid (>0) 'Battery Capacity (kWh)'.")
-
-                                except Exception as validation_error:
-                                    # Catch errors during the validation/conversion process itself
-                                    errors.append(f"An unexpected error occurred during data validation: {validation_error}")
-                                    st.error(traceback.format_exc()) # Log for debugging
+                                # Cleaning and detailed validation (shared with the headless pipeline)
+                                df_upload, errors = validate_fleet_df(df_upload)
 
                                 # --- Handle Validation Results ---
                                 if errors:
@@ -708,7 +578,7 @@ with tab2:
                      from interactive_map_logic import handle_map_route_input
                      # Execute the map handling logic
                      # This function is assumed to modify st.session_state.routes directly
-                     handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup)
+                     handle_map_route_input(st, folium, st_folium, zip_index, zip_areas, dac_overlay)
 
                      # --- Static Guidance for Map Input ---
                      # This message appears as long as the map mode is selected and loads correctly
@@ -754,8 +624,8 @@ with tab2:
                 preview_df = None # Initialize preview dataframe
 
                 try:
-                    # Read just for preview and column check first
-                    preview_df = pd.read_csv(uploaded_file)
+                    # Preview and column check from the first rows only; the full file is streamed on "Process CSV"
+                    preview_df = pd.read_csv(uploaded_file, nrows=ROUTE_CSV_PREVIEW_ROWS)
                     st.write("Preview of Uploaded CSV:")
                     st.dataframe(preview_df.head())
 
@@ -787,111 +657,40 @@ with tab2:
                 # Button to process the CSV - check disabled status
                 if st.button("Process CSV", key="process_csv_button_tab2", disabled=process_csv_disabled):
                     try:
-                        # Reread the file inside the button click for actual processing
+                        # Stream the file in chunks: each completed, geocoded batch of routes is staged in
+                        # pending_routes and shown right away; the existing routes are replaced only once the
+                        # whole file succeeds, so a failed or interrupted upload doesn't leave a partial plan
                         uploaded_file.seek(0) # Ensure reading from the start
-                        df_upload = pd.read_csv(uploaded_file)
-                        df_upload.columns = [col.strip() for col in df_upload.columns] # Clean column names
+                        st.session_state.pending_routes = []
+                        geocoding_failures = []
 
                         with st.spinner("Geocoding addresses... This may take time."):
-                            route_dict = {}
-                            geocoding_failures = []
-
-                            # Sort by Route and Sequence Number for correct processing order
-                            df_upload = df_upload.sort_values(by=['Route', 'Sequence Number'])
-
-                            for _, row in df_upload.iterrows():
-                                # Standardize data extraction
-                                route_id = str(row['Route']).strip() if pd.notna(row['Route']) else None
-                                location_type = str(row['Location Type']).strip().capitalize() if pd.notna(row['Location Type']) else None
-                                address = str(row['Address']).strip() if pd.notna(row['Address']) else None
-                                time_str = row.get('Time') # Use .get for optional column
-                                sequence = pd.to_numeric(row['Sequence Number'], errors='coerce') # Handle non-numeric sequence
-
-                                # Input validation
-                                if not route_id or not location_type or not address or pd.isna(sequence):
-                                     st.warning(f"Skipping row with missing Route ID, Type, Address, or invalid Sequence: {row.to_dict()}")
-                                     continue
-                                sequence = int(sequence) # Convert to int after validation
-                                if location_type not in ["Depot", "Pickup", "Dropoff"]:
-                                    st.warning(f"Skipping row with invalid Location Type '{location_type}' for Route {route_id}. Use 'Depot', 'Pickup', or 'Dropoff'.")
-                                    continue
-
-                                try:
-                                    # Simple rate limiting for geocoding
-                                    time.sleep(0.05) # 50ms delay
-
-                                    # --- Geocoding API Call ---
-                                    geocode_url = "https://maps.googleapis.com/maps/api/geocode/json"
-                                    params = {"address": address, "key": Maps_api_key}
-                                    response = requests.get(geocode_url, params=params, timeout=10)
-                                    response.raise_for_status() # Check for HTTP errors
-                                    data = response.json()
-
-                                    if data["status"] == "OK" and data.get("results"):
-                                         # Extract coordinates
-                                         location = data["results"][0]["geometry"]["location"]
-                                         coords = (location["lat"], location["lng"])
-
-                                         # Initialize route if not exists
-                                         if route_id not in route_dict:
-                                             route_dict[route_id] = {
-                                                 "route_id": route_id, "depot": None,
-                                                 "pickups": [], # Store as list of dicts: {'location': coords, 'sequence': seq}
-                                                 "dropoffs": [], # Store as list of dicts: {'location': coords, 'sequence': seq, 'bell_time': time}
-                                                 "csv_source": True # Flag origin
-                                             }
-
-                                         # --- Time Parsing (only for the first dropoff encountered for this route) ---
-                                         parsed_time = None
-                                         is_first_dropoff = (location_type == "Dropoff" and not any(d.get('bell_time') for d in route_dict[route_id]["dropoffs"]))
-
-                                         if pd.notna(time_str) and isinstance(time_str, str) and time_str.strip() and is_first_dropoff:
-                                            time_str_cleaned = time_str.strip()
-                                            try:
-                                                parsed_time = datetime.datetime.strptime(time_str_cleaned, "%H:%M").time()
-                                            except ValueError:
-                                                 st.warning(f"Route {route_id}: Invalid time format for address '{address}': '{time_str}'. Expected HH:MM. Bell time ignored.")
-
-                                         # --- Assign to Route Structure ---
-                                         if location_type == "Depot":
-                                             if route_dict[route_id]["depot"] is None:
-                                                 route_dict[route_id]["depot"] = coords
-                                             else:
-                                                  st.warning(f"Route {route_id}: Multiple Depot locations found. Using first at sequence {sequence}.")
-                                         elif location_type == "Pickup":
-                                             route_dict[route_id]["pickups"].append({"location": coords, "sequence": sequence})
-                                         elif location_type == "Dropoff":
-                                              route_dict[route_id]["dropoffs"].append({
-                                                 "location": coords, "sequence": sequence,
-                                                 "bell_time": parsed_time if is_first_dropoff else None # Store time only if it's the first dropoff
-                                                 })
-                                    else:
-                                        # Handle geocoding API errors (ZERO_RESULTS, OVER_QUERY_LIMIT, etc.)
-                                        st.warning(f"Geocoding failed for Route {route_id}, Address '{address}': {data.get('status', 'Unknown Error')}")
-                                        geocoding_failures.append(f"Route {route_id}: {address} ({data.get('status', 'Failed')})")
-
-                                except requests.exceptions.RequestException as req_err:
-                                     st.error(f"Network error geocoding '{address}': {req_err}")
-                                     geocoding_failures.append(f"Route {route_id}: {address} (Network Error)")
-                                     # Consider adding a retry mechanism or stopping processing if too many errors occur
-                                except Exception as geocode_error:
-                                     st.error(f"Unexpected error geocoding '{address}': {geocode_error}")
-                                     st.error(traceback.format_exc()) # Log full trace for debugging
-                                     geocoding_failures.append(f"Route {route_id}: {address} (Processing Error)")
-
-                            # --- Post-Processing after loop ---
-                            processed_routes = []
-                            for route_id, data in route_dict.items():
-                                # Sort pickups and dropoffs by sequence number stored during processing
-                                data["pickups"] = sorted(data["pickups"], key=lambda x: x['sequence'])
-                                data["dropoffs"] = sorted(data["dropoffs"], key=lambda x: x['sequence'])
-                                processed_routes.append(data)
-
-                            # Replace existing routes in session state - typical for CSV upload
-                            st.session_state.routes = processed_routes
+                            ingest_status = st.empty()
+                            staged_preview = st.empty()
+                            def on_csv_chunk(rows_read):
+                                ingest_status.caption(f"Read {rows_read:,} rows, {len(st.session_state.pending_routes):,} routes staged so far...")
+                            for route_batch, batch_failures in iter_route_batches(
+                                    uploaded_file, Maps_api_key, ui=st, cache=geocode_cache, max_workers=GEOCODE_WORKERS,
+                                    rate_per_second=GOOGLE_API_RATE_PER_SECOND, negative_ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS,
+                                    on_chunk=on_csv_chunk):
+                                st.session_state.pending_routes.extend(route_batch)
+                                geocoding_failures.extend(batch_failures)
+                                staged_preview.dataframe(pd.DataFrame([route_summary_row(r) for r in st.session_state.pending_routes[-STAGED_ROUTES_PREVIEW_ROWS:]]),
+                                                         use_container_width=True, hide_index=True)
+                            ingest_status.empty()
+                            staged_preview.empty()
+                            processed_routes = st.session_state.pending_routes
+                            st.session_state.routes = processed_routes # Replace existing routes - typical for CSV upload
+                            st.session_state.pending_routes = None
 
                             # --- Success Message & Specific Guidance ---
                             st.success(f"CSV processed. {len(processed_routes)} routes loaded.")
+                            if geocode_cache is not None:
+                                try:
+                                    geo_stats = geocode_cache.stats()
+                                    st.caption(f"Geocode cache: {geo_stats['hit_ratio']:.0%} hit ratio "
+                                               f"({geo_stats['hits']} hits / {geo_stats['misses']} misses), {geo_stats['entries']} addresses stored.")
+                                except Exception as e: st.caption(f"Geocode cache stats unavailable: {e}")
                             if geocoding_failures:
                                  st.warning("Some addresses could not be geocoded:", icon="⚠️")
                                  st.json(geocoding_failures) # Use json for better list display
@@ -906,24 +705,20 @@ with tab2:
                          st.error(traceback.format_exc())
 
 
+    # --- Routes staged by a CSV upload that didn't finish (failed or interrupted by another click) ---
+    if st.session_state.get("pending_routes"):
+        st.warning(f"{len(st.session_state.pending_routes)} route(s) from an unfinished CSV upload are staged but were not loaded. "
+                   "Process the CSV again to load the whole file.")
+        with st.expander("Staged routes (not loaded)"):
+            st.dataframe(pd.DataFrame([route_summary_row(r) for r in st.session_state.pending_routes]), use_container_width=True, hide_index=True)
+
     # --- Display Defined Routes Overview (common section, shown if routes exist) ---
     if st.session_state.get("routes"):
         st.markdown("---") # Separator before overview
         st.subheader("Defined Routes Overview")
-        routes_summary = []
-        for r in st.session_state.routes:
-            # Build the summary dictionary for each route
-             routes_summary.append({
-                "Route ID": r.get("route_id", "N/A"),
-                "Source": "CSV" if r.get("csv_source") else "Map", # Indicate source
-                "Depot": "Yes" if r.get("depot") else "No",
-                "Pickups": len(r.get("pickups", [])),
-                "Dropoffs": len(r.get("dropoffs", [])),
-                # Safely get bell time from the first dropoff if it exists
-                "Bell Time": r['dropoffs'][0]['bell_time'].strftime("%H:%M")
-                             if r.get('dropoffs') and len(r['dropoffs']) > 0 and r['dropoffs'][0].get('bell_time')
-                             else "N/A"
-            })
+        # ZIP area of every stop in the plan; routes labeled on an earlier rerun come from the session memo
+        stop_zips = label_route_stops(st.session_state.routes, zip_areas, zip_index, memo=st.session_state.stop_zip_labels)
+        routes_summary = [route_summary_row(r, zips) for r, zips in zip(st.session_state.routes, stop_zips)]
         # Display the summary table
         st.dataframe(pd.DataFrame(routes_summary), use_container_width=True)
 # =======================================
@@ -934,112 +729,122 @@ with tab3:
 
     # --- Section A: Calculate Route Details ---
     st.subheader("A. Calculate Route Details")
-    st.markdown("Click the button below to calculate distances, durations, and DAC overlap using the Google Maps API based on your defined routes in Tab 2.")
+    st.markdown("Click the button below to calculate distances, durations, and DAC overlap using the Google Maps API (or the offline road graph, if installed) based on your defined routes in Tab 2.")
+
+    # Routing engine choice: Google is the default; the local graph only appears if its file exists
+    local_routing_provider = load_local_routing_provider()
+    routing_engines = ["Google Directions"] + (["Local road graph"] if local_routing_provider is not None else [])
+    routing_engine = st.radio("Routing engine:", routing_engines, horizontal=True, key="routing_engine_tab3",
+                              help="The local road graph runs offline with no API cost, using free-flow (no traffic) travel times.")
+    use_local_routing = routing_engine == "Local road graph"
 
     # Prerequisites Check
     fleet_ok = st.session_state.get("ev_fleet") is not None and not st.session_state.ev_fleet.empty
     routes_ok = st.session_state.get("routes") is not None and len(st.session_state.routes) > 0
-    api_ok = Maps_api_key is not None
+    api_ok = Maps_api_key is not None or use_local_routing
     results_exist = st.session_state.get("results") is not None and len(st.session_state.results) > 0
-
-    process_ready = fleet_ok and routes_ok and api_ok # Basic readiness check
+    # Only new or edited routes (content hash changed since their last calculation) need work
+    pending_routes = changed_routes(st.session_state.routes) if routes_ok else []
+    if results_exist and routes_ok:
+        # Drop results of routes deleted since the last calculation (no recalculation needed)
+        current_results = merge_results(st.session_state.routes, st.session_state.results, [])
+        if len(current_results) != len(st.session_state.results):
+            st.session_state.results = current_results
+            clear_plan_state()
+            results_exist = len(current_results) > 0
+
+    # Results are matched to routes by Route ID, so IDs must be unique before calculating
+    duplicate_ids = duplicate_route_ids(st.session_state.routes) if routes_ok else []
+    process_ready = fleet_ok and routes_ok and api_ok and not duplicate_ids # Basic readiness check
 
     # Display status messages based on checks
     if not fleet_ok: st.warning("⬅️ Please configure and save your EV fleet in **Tab 1**.")
     if not routes_ok: st.warning("⬅️ Please define routes in **Tab 2**.")
     if not api_ok: st.error("⚠️ Google Maps API Key missing in secrets. Route processing is disabled.")
+    if duplicate_ids: st.error(f"⚠️ Route IDs used by more than one route: {', '.join(duplicate_ids)}. Rename them in **Tab 2** before processing.")
 
-    # Only allow processing if prerequisites met AND results don't already exist
-    allow_processing = process_ready and not results_exist
+    # Only allow processing if prerequisites met AND some routes are new or changed
+    allow_processing = process_ready and len(pending_routes) > 0
 
-    if results_exist:
+    if results_exist and not pending_routes:
          st.success(f"✅ Route details previously calculated for {len(st.session_state.results)} route(s). Proceed to assigning bus types below.")
          # Button is implicitly disabled because allow_processing is False
+    elif results_exist:
+         st.info(f"✏️ {len(pending_routes)} route(s) were added or changed since the last calculation. Only those will be recalculated.")
+
+    # Concurrency control for the Directions calls below
+    st.number_input("Parallel route workers", min_value=1, max_value=ROUTE_WORKERS_MAX, value=ROUTE_WORKERS_DEFAULT, step=1,
+                    key="route_worker_count", disabled=not allow_processing,
+                    help="How many routes are sent to Google Maps at once. Set to 1 to process routes one at a time.")
+    # Bulk mode: one stop-to-stop matrix for all routes instead of two Directions calls per route
+    st.checkbox("Bulk mode (distance matrix)", key="bulk_matrix_mode", disabled=not allow_processing,
+                help="Requests only the stop-to-stop legs the AM and PM trips drive, batched into Distance Matrix requests, and assembles AM/PM distances from them. "
+                     "Much cheaper for large fleets; durations ignore bell-time traffic and DAC overlap uses straight stop-to-stop lines.")
+
+    def make_routing_provider():
+        # The engine picked above; Google requests share one rate limiter per run
+        if use_local_routing: return local_routing_provider
+        return GoogleDirectionsProvider(Maps_api_key, cache=directions_cache,
+                                        rate_limiter=HostRateLimiter(default_rate=GOOGLE_API_RATE_PER_SECOND))
 
     # Calculation Button - Enabled only if ready and not already processed
-    if st.button("⚙️ Process Routes for Electrification", disabled=not allow_processing, type="primary", key="process_electrification_tab3"):
+    process_label = f"⚙️ Process {len(pending_routes)} Changed Route(s)" if results_exist and pending_routes else "⚙️ Process Routes for Electrification"
+    if st.button(process_label, disabled=not allow_processing, type="primary", key="process_electrification_tab3"):
          if process_ready: # Double-check prerequisites before running
              # --- (Route Calculation Logic - Full code from previous versions) ---
              results_list = []
-             routes_to_process = st.session_state.routes
+             indexed_routes = pending_routes # (index in st.session_state.routes, route) for new/edited routes only
+             routes_to_process = [route for _, route in indexed_routes]
              progress_bar = st.progress(0, text="Starting route calculations...")
              total_routes = len(routes_to_process)
              api_errors_encountered = False
 
-             for i, route in enumerate(routes_to_process):
-                 route_id = route.get("route_id", f"Route_{i+1}")
-                 progress_text = f"Processing Route: {route_id} ({i+1}/{total_routes})"
-                 progress_bar.progress((i + 1) / total_routes, text=progress_text)
-
-                 if not route.get("depot"): st.warning(f"Route {route_id}: Skip - Missing Depot."); continue
-                 if not route.get("dropoffs"): st.warning(f"Route {route_id}: Skip - Missing Dropoffs."); continue
-
-                 # Initialize feasibility dict for this route
-                 feasibility_result = {
-                    "Route ID": route_id, "AM Distance (miles)": None, "AM Duration (min)": None, "AM Overview Polyline": None,
-                    "PM Distance (miles)": None, "PM Duration (min)": None, "PM Overview Polyline": None,
-                    "Percent in DAC": 0.0, "Suggested Depot Departure Time": None,
-                    "First School Bell Time": None, "Drive Time to First School (min)": None, "Leg Details": []
-                 }
-
-                 try:
-                     # --- AM Route Calculation ---
-                     am_origin = route["depot"]
-                     if not route["dropoffs"] or not route["dropoffs"][0].get("location"): st.warning(f"Route {route_id}: Skip - Invalid first dropoff."); continue
-                     am_destination = route["dropoffs"][0]["location"]
-                     am_waypoints_data = route.get("pickups", []) + route.get("dropoffs", [])[1:]
-                     am_waypoints = [wp.get("location") for wp in am_waypoints_data if wp.get("location")]
-                     first_bell_time = route["dropoffs"][0].get("bell_time") # Already parsed datetime.time or None
-
-                     am_distance, am_duration, am_leg_details, am_polyline = get_route_distance(Maps_api_key, am_origin, am_waypoints, am_destination, first_bell_time)
-
-                     if am_distance is not None and am_duration is not None:
-                         feasibility_result["AM Distance (miles)"] = round(am_distance, 2)
-                         feasibility_result["AM Duration (min)"] = round(am_duration, 1)
-                         feasibility_result["AM Overview Polyline"] = am_polyline
-                         feasibility_result["Leg Details"] = am_leg_details # Store leg details
-                         feasibility_result["Drive Time to First School (min)"] = round(am_duration, 1)
-                         if first_bell_time:
-                             feasibility_result["First School Bell Time"] = first_bell_time.strftime("%I:%M %p")
-                             try:
-                                 arrival_dt = datetime.datetime.combine(datetime.date.today(), first_bell_time)
-                                 buffer_minutes = 15
-                                 departure_dt = arrival_dt - datetime.timedelta(minutes=am_duration + buffer_minutes)
-                                 feasibility_result["Suggested Depot Departure Time"] = departure_dt.time().strftime("%I:%M %p")
-                             except Exception as e: st.warning(f"Route {route_id}: Error calculating departure time: {e}")
-                         if am_polyline and dac_locs_gdf is not None: feasibility_result["Percent in DAC"] = round(calculate_dac_overlap(am_polyline, dac_locs_gdf), 2)
-                     else:
-                         st.warning(f"Route {route_id}: Failed AM route details calculation (check API key/quota?).")
-                         api_errors_encountered = True
-
-                     # --- PM Route Calculation ---
-                     if not route["dropoffs"] or not route["dropoffs"][-1].get("location"): st.warning(f"Route {route_id}: Skip PM - Invalid last dropoff.");
-                     else:
-                          pm_origin = route["dropoffs"][-1]["location"]
-                          pm_destination = route["depot"]
-                          pm_waypoints_data = route.get("dropoffs", [])[:-1] + route.get("pickups", [])
-                          pm_waypoints_data_sorted = sorted(pm_waypoints_data, key=lambda x: x.get('sequence', 0), reverse=True)
-                          pm_waypoints = [wp.get("location") for wp in pm_waypoints_data_sorted if wp.get("location")]
-                          pm_distance, pm_duration, _, pm_polyline = get_route_distance(Maps_api_key, pm_origin, pm_waypoints, pm_destination, None) # No time needed for PM estimate
-
-                          if pm_distance is not None and pm_duration is not None:
-                             feasibility_result["PM Distance (miles)"] = round(pm_distance, 2)
-                             feasibility_result["PM Duration (min)"] = round(pm_duration, 1)
-                             feasibility_result["PM Overview Polyline"] = pm_polyline
-                          else:
-                             st.warning(f"Route {route_id}: Failed PM route details calculation (check API key/quota?).")
-                             api_errors_encountered = True
-
-                 except Exception as route_calc_error:
-                      st.error(f"Route {route_id}: Unexpected error during calculation: {route_calc_error}")
-                      st.error(traceback.format_exc()) # Log detailed error
-
-                 # Append result for this route, even if parts failed
-                 results_list.append(feasibility_result)
-
-             # After processing all routes
+             # Routes run on a bounded worker pool; results, progress and warnings
+             # are handled here in route order so output matches the serial path.
+             max_workers = int(st.session_state.get("route_worker_count", ROUTE_WORKERS_DEFAULT))
+             routing_provider = make_routing_provider()
+
+             if st.session_state.get("bulk_matrix_mode"):
+                 matrix_progress = st.progress(0, text="Building stop distance matrix...")
+                 def on_matrix_request_done(done, total):
+                     matrix_progress.progress(done / total, text=f"Distance matrix request {done}/{total}")
+                 trips = [trip for route in routes_to_process for trip in route_trip_stops(route)]
+                 stop_matrix, request_count = build_stop_matrix(trips, routing_provider, max_workers=max_workers, on_progress=on_matrix_request_done, ui=st)
+                 matrix_progress.empty()
+                 st.session_state.stop_matrix = stop_matrix
+                 st.caption(f"Distance matrix: {len(stop_matrix)} unique stops, {request_count} requests, {len(stop_matrix.entries)} stop pairs.")
+                 routing_provider = MatrixProvider(stop_matrix) # Route legs below are matrix lookups, no further requests
+
+             geometry_cache = st.session_state.geometry_cache
+             def process_route_worker(indexed_route):
+                 i, route = indexed_route
+                 messages = DeferredMessages() # Replayed on the script thread in on_route_done
+                 result, api_error = calculate_route_feasibility(route, i, routing_provider, dac_index, ui=messages, geometry_cache=geometry_cache)
+                 return result, api_error, messages
+
+             route_run_state = {"api_errors": False}
+             completed_routes = [] # Only routes with a clean result are stamped; skipped/failed ones stay pending
+             def on_route_done(i, outcome):
+                 result, api_error, messages = outcome
+                 route_index, route = indexed_routes[i]
+                 route_id = route.get("route_id", f"Route_{route_index+1}")
+                 progress_bar.progress((i + 1) / total_routes, text=f"Processing Route: {route_id} ({i+1}/{total_routes})")
+                 messages.replay(st)
+                 if api_error: route_run_state["api_errors"] = True
+                 if result is not None: results_list.append(result) # Append even if parts failed
+                 if result is not None and not api_error: completed_routes.append(route)
+
+             run_ordered(process_route_worker, indexed_routes, max_workers=max_workers, on_result=on_route_done)
+             api_errors_encountered = route_run_state["api_errors"]
+
+             # After processing: merge into the existing results and stamp the routes as up to date
              progress_bar.empty() # Clear progress bar
-             st.session_state.results = results_list # Store results in session state
+             recomputed_ids = [route.get("route_id", f"Route_{i+1}") for i, route in indexed_routes]
+             st.session_state.results = merge_results(st.session_state.routes, st.session_state.get("results") or [], results_list, recomputed_ids)
+             mark_routes_calculated(completed_routes)
+             geometry_cache.add_results(st.session_state.results) # Decode every AM/PM line once for Tab 4
+             # Distances changed, so any generated plan and the Tab 4 evaluations built on it are out of date
+             clear_plan_state()
 
              if results_list:
                   st.success(f"Route detail processing complete for {len(results_list)} route(s).")
@@ -1053,6 +858,47 @@ with tab3:
               # This case should ideally not be reached due to disabled button, but as fallback:
               st.error("Cannot process routes. Please ensure prerequisites in Tab 1 and Tab 2 are met.")
 
+    # Directions cache counters (process-wide, so re-runs and resets show up as hits)
+    if directions_cache is not None:
+        try:
+            cache_stats = directions_cache.stats()
+            st.caption(f"Directions cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses "
+                       f"({cache_stats['hit_ratio']:.0%} hit ratio), {cache_stats['entries']} responses stored.")
+        except Exception as e: st.caption(f"Directions cache stats unavailable: {e}")
+
+    # --- Optional: reorder pickups to shorten trips (sequence_logic, over the stop distance matrix) ---
+    if routes_ok and api_ok:
+        with st.expander("🧭 Optimize Stop Order (optional)"):
+            st.markdown("Reorders the pickups on each route to shorten the AM and PM trips. Schools keep their order; "
+                        "pickups always stay before their school in the morning and after it in the afternoon. "
+                        "Needs travel times between every pair of stops on a route; bulk mode only fetches the driven legs, so the full matrix is built here when needed. Shorter trips can make more routes EV-feasible.")
+            st.number_input("Search time per trip (seconds)", min_value=0.05, max_value=5.0, value=0.25, step=0.05, key="sequence_time_budget")
+            if st.button("Find Shorter Stop Orders", key="optimize_stop_order_tab3"):
+                stop_matrix = st.session_state.get("stop_matrix")
+                # The optimizer tries every order, so it needs all stop pairs within each route (bulk mode only fetches the driven legs)
+                route_stops = [route_stop_points(r) for r in st.session_state.routes]
+                if stop_matrix is None or not stop_matrix.covers(route_stops, all_pairs=True):
+                    with st.spinner("Building stop distance matrix..."):
+                        stop_matrix, _ = build_stop_matrix(route_stops, make_routing_provider(), all_pairs=True,
+                                                           max_workers=int(st.session_state.get("route_worker_count", ROUTE_WORKERS_DEFAULT)), ui=st)
+                    st.session_state.stop_matrix = stop_matrix
+                with st.spinner("Optimizing stop order..."):
+                    st.session_state.sequence_proposal = optimize_routes(st.session_state.routes, stop_matrix,
+                                                                         time_budget_seconds=float(st.session_state.sequence_time_budget))
+
+            if st.session_state.get("sequence_proposal") is not None:
+                optimized_routes, sequence_summary = st.session_state.sequence_proposal
+                st.dataframe(sequence_summary, use_container_width=True, hide_index=True)
+                if "Miles Saved" in sequence_summary.columns:
+                    st.metric("Total Daily Miles Saved", f"{sequence_summary['Miles Saved'].sum():.1f} mi")
+                if st.button("Apply Optimized Order", key="apply_stop_order_tab3", type="primary"):
+                    st.session_state.routes = optimized_routes
+                    # Reordered routes get a new content hash and are recalculated on the next run; plans no longer apply
+                    clear_plan_state()
+                    st.session_state.sequence_proposal = None
+                    st.success("Optimized stop order applied. Process the changed routes to see the new distances.")
+                    st.rerun()
+
 
     # --- Section B: Bus Type Assignment (Show only if results exist) ---
     if st.session_state.get("results"): # Check again in case rerun happened
@@ -1104,86 +950,31 @@ with tab3:
         st.subheader("C. Generate Electrification Plan")
         st.markdown("Click below to calculate which routes are feasible with your selected EV fleet and bus type assignments, assuming no midday charging.")
 
+        # Weather band the vehicle assignment must hold for
+        assignment_band_labels = {"Cold Weather Range": "All weather (< 50°F)", "Average Weather Range": "50–70°F", "Warm Weather Range": "70°F+"}
+        assignment_band = st.selectbox("Assign vehicles for weather:", options=list(assignment_band_labels.keys()),
+                                       format_func=assignment_band_labels.get, key="assignment_band_tab3",
+                                       help="Each bus in your fleet (by Quantity) is allocated to at most one route using this range.")
+
         # Button to generate the final plan
         if st.button("⚡ Show Me the Plan!", key="show_plan_button_tab3", type="primary"):
             _calculation_successful = False # Flag for success
-            st.session_state.plan_results_df = None # Clear previous results first
+            clear_plan_state() # Clear previous results first
 
             # --- (Plan Generation Logic - Full code from previous versions) ---
             try:
                 # Ensure EV fleet data is available (should be if we got here)
                 ev_fleet = st.session_state.ev_fleet
-                plan_results_list = []
-
-                # Iterate through route calculation results
-                for result_data in st.session_state.results:
-                     route_id = result_data.get("Route ID")
-                     if not route_id: continue # Skip if missing route ID
-
-                     # Extract necessary data
-                     suggested_time = result_data.get("Suggested Depot Departure Time", "N/A")
-                     percent_in_dac = result_data.get("Percent in DAC", 0.0)
-                     am_miles = result_data.get("AM Distance (miles)", 0.0) or 0.0
-                     pm_miles = result_data.get("PM Distance (miles)", 0.0) or 0.0
-                     round_trip = am_miles + pm_miles
-
-                     # Get the bus type assigned by the user for this route (defaulting if somehow missed)
-                     selected_type = st.session_state.route_bus_types.get(route_id, "A")
-
-                     # Filter the EV fleet to matching type
-                     matching_fleet = ev_fleet[ev_fleet["Type"] == selected_type].copy()
-
-                     # Helper function to find eligible buses based on range
-                     def get_eligible_names(df, range_col_name, required_range):
-                         if range_col_name in df.columns:
-                             # Ensure range comparison handles potential non-numeric data gracefully
-                             eligible_df = df[pd.to_numeric(df[range_col_name], errors='coerce').fillna(0) >= required_range]
-                             names = eligible_df["Name"].dropna().unique()
-                             return ", ".join(names) if len(names) > 0 else "None" # Return "None" string if empty
-                         return "N/A" # Column missing
-
-                     # Calculate eligibility for different weather conditions
-                     cold_buses = get_eligible_names(matching_fleet, "Cold Weather Range", round_trip)
-                     avg_buses = get_eligible_names(matching_fleet, "Average Weather Range", round_trip)
-                     warm_buses = get_eligible_names(matching_fleet, "Warm Weather Range", round_trip)
-
-                     # Append results for this route to the plan list
-                     plan_results_list.append({
-                         "Route ID": route_id, "Type Required": selected_type, "Round Trip (mi)": round(round_trip, 2),
-                         "Eligible Buses < 50°F": cold_buses, "Eligible Buses 50–70°F": avg_buses, "Eligible Buses 70°F+": warm_buses,
-                         "Percent in DAC": percent_in_dac, "Suggested Departure Time": suggested_time
-                     })
-
-                # Process the collected plan results list
-                if plan_results_list:
-                    plan_df = pd.DataFrame(plan_results_list)
-
-                    # --- (Apply Classification and Sorting Logic - Same as before) ---
-                    def classify_eligibility(row):
-                         in_dac = pd.to_numeric(row.get("Percent in DAC"), errors='coerce')
-                         dac_preference = (in_dac is not None and in_dac > 70)
-                         # Check eligibility based on non-"None" and non-"N/A" strings
-                         cold_ok = bool(row.get("Eligible Buses < 50°F") and row["Eligible Buses < 50°F"] not in ["None", "N/A"])
-                         mild_ok = bool(row.get("Eligible Buses 50–70°F") and row["Eligible Buses 50–70°F"] not in ["None", "N/A"])
-                         warm_ok = bool(row.get("Eligible Buses 70°F+") and row["Eligible Buses 70°F+"] not in ["None", "N/A"])
-                         if dac_preference and cold_ok: return "Preferred - All Weather"
-                         elif cold_ok: return "OK in All Weather"
-                         elif mild_ok: return "OK > 50°F Weather"
-                         elif warm_ok: return "OK > 70°F Weather"
-                         else: return "NOT FEASIBLE (No Bus)"
-                    eligibility_order = { "Preferred - All Weather": 0, "OK in All Weather": 1, "OK > 50°F Weather": 2, "OK > 70°F Weather": 3, "NOT FEASIBLE (No Bus)": 4 }
-                    plan_df["EV Eligibility"] = plan_df.apply(classify_eligibility, axis=1)
-                    plan_df["Eligibility Rank"] = plan_df["EV Eligibility"].map(eligibility_order)
-                    plan_df = plan_df.sort_values(by=["Eligibility Rank", "Route ID"]).drop(columns=["Eligibility Rank"])
-                    plan_df.rename(columns={'Type Required': 'Bus Type', 'Percent in DAC': '% in Disadvantaged Community'}, inplace=True)
-                    final_cols_order = [ # Define final column order
-                       'Route ID', 'Bus Type', 'EV Eligibility', 'Suggested Departure Time', '% in Disadvantaged Community', 'Round Trip (mi)',
-                       'Eligible Buses < 50°F', 'Eligible Buses 50–70°F', 'Eligible Buses 70°F+' ]
-                    # Reorder columns, handling potential missing ones defensively (though validation should prevent this)
-                    plan_df_display = plan_df[[col for col in final_cols_order if col in plan_df.columns]]
 
+                # Resolve eligible buses and classify every route in one vectorized pass (plan_logic.build_plan)
+                plan_df_display = build_plan(st.session_state.results, st.session_state.route_bus_types, ev_fleet)
+
+                # Process the collected plan results
+                if plan_df_display is not None:
                     # *** Store successful result in session state ***
                     st.session_state.plan_results_df = plan_df_display
+                    # Allocate actual buses (by Quantity) to routes, DAC-heavy routes first when buses run short
+                    st.session_state.assignment_df = assign_vehicles(st.session_state.results, st.session_state.route_bus_types, ev_fleet, range_col=assignment_band)
                     _calculation_successful = True
 
                     # --- UPDATED GUIDANCE ---
@@ -1192,7 +983,7 @@ with tab3:
                     st.info("➡️ Please click on **Tab 4: Review Plan & Map** above to view the results.")
                     # NO explicit st.rerun() here. Let the natural button rerun happen. User must click Tab 4.
 
-                else: # No results in plan_results_list
+                else: # No routes with an ID in results
                     st.info("No route results available to generate a plan.")
 
             except Exception as e:
@@ -1200,10 +991,10 @@ with tab3:
                  st.error(traceback.format_exc()) # Show detailed error
                  _calculation_successful = False
                  # Ensure plan results are cleared on error
-                 st.session_state.plan_results_df = None
-# Assuming necessary imports like streamlit, pandas, folium, polyline, Icon are done globally
+                 clear_plan_state()
+# Assuming necessary imports like streamlit, pandas, folium, Icon are done globally
 # Assuming plan_df, st.session_state.routes, st.session_state.results,
-# st.session_state.ev_fleet, zip_lookup, zipcodes_df etc. are available
+# st.session_state.ev_fleet, zip_index etc. are available
 
 with tab4:
     st.header("Step 4: Review Electrification Plan & Route Map")
@@ -1220,6 +1011,157 @@ with tab4:
         st.subheader("🚌 EV Route Feasibility Summary")
         st.dataframe(plan_df, use_container_width=True)
 
+        # --- Vehicle Assignment (actual buses, respecting Quantity) ---
+        assignment_df = st.session_state.get("assignment_df")
+        if assignment_df is not None and not assignment_df.empty:
+            st.subheader("🚍 Vehicle Assignment")
+            electric_count = int((assignment_df["Assignment"] == "Electric").sum())
+            diesel_df = assignment_df[assignment_df["Assignment"] != "Electric"]
+            assign_cols = st.columns(2)
+            assign_cols[0].metric("Routes Electrified", electric_count)
+            assign_cols[1].metric("Routes Remaining on Diesel", len(diesel_df))
+            st.dataframe(assignment_df, use_container_width=True)
+            if not diesel_df.empty:
+                st.caption("Remaining on diesel: " + ", ".join(diesel_df["Route ID"].astype(str)))
+
+        # --- School-year feasibility by date (weather_logic range model) ---
+        st.subheader("📅 School-Year Feasibility by Date")
+        st.markdown("Prices every route on every school day at the normal temperature of its depot ZIP during AM and PM service hours, instead of the three weather bands above.")
+        year_cols = st.columns(2)
+        today = datetime.date.today()
+        next_school_year = datetime.date(today.year + (today > datetime.date(today.year, 9, 8)), 9, 8) # Next Sept 8
+        first_school_day = year_cols[0].date_input("First day of school", value=next_school_year, key="first_school_day_tab4")
+        n_school_days = year_cols[1].number_input("School days", min_value=1, max_value=366, value=SCHOOL_YEAR_DAYS, step=1, key="n_school_days_tab4")
+        year_dates = school_days(first_school_day, int(n_school_days))
+        climatology = load_climatology_data()
+        if climatology is None:
+            climatology_upload = st.file_uploader("Upload hourly temperature climatology (CSV)", type="csv", key="climatology_upload_tab4",
+                                                  help="Columns: ZIP, Day of Year (or Date), Hour, Temperature (F)")
+            if climatology_upload is not None:
+                # Parsing and pivoting an hourly file is slow, so do it once per upload, not on every rerun
+                upload_id = getattr(climatology_upload, "file_id", None) or (climatology_upload.name, climatology_upload.size)
+                cached_upload = st.session_state.uploaded_climatology
+                if cached_upload is not None and cached_upload[0] == upload_id:
+                    climatology = cached_upload[1]
+                else:
+                    try:
+                        climatology = load_climatology(climatology_upload)
+                        st.session_state.uploaded_climatology = (upload_id, climatology)
+                    except ValueError as e:
+                        st.error(str(e))
+        def route_depot_zips():
+            # Each route's temperatures come from its depot ZIP (first stop if no depot); labelled
+            # only when an evaluation runs, not on every rerun of the tab
+            stop_zips = label_route_stops(st.session_state.routes, zip_areas, zip_index, memo=st.session_state.stop_zip_labels)
+            return {r.get("route_id"): next((z for z in zips if z), None) for r, zips in zip(st.session_state.routes, stop_zips)}
+        if climatology is None:
+            st.info(f"No temperature climatology found at '{CLIMATOLOGY_PATH}'. Upload one above to evaluate the school year.")
+        else:
+            if st.button("Evaluate School Year", key="evaluate_school_year_tab4"):
+                try:
+                    st.session_state.school_year_eval = evaluate_school_year(
+                        st.session_state.results, st.session_state.route_bus_types, route_depot_zips(),
+                        st.session_state.ev_fleet, climatology, year_dates)
+                except Exception as e:
+                    st.error(f"Error evaluating the school year: {e}")
+                    st.session_state.school_year_eval = None
+            if st.session_state.school_year_eval is not None:
+                year_routes, year_days, year_energy = st.session_state.school_year_eval
+                year_metrics = st.columns(3)
+                year_metrics[0].metric("Routes Feasible Every Day", int((year_routes["Days Not Feasible"] == 0).sum()))
+                year_metrics[1].metric("Routes Feasible Some Days", int(((year_routes["Days Not Feasible"] > 0) & (year_routes["Days Feasible"] > 0)).sum()))
+                year_metrics[2].metric("Routes Never Feasible", int((year_routes["Days Feasible"] == 0).sum()))
+                st.dataframe(year_routes, use_container_width=True)
+                st.line_chart(year_days.set_index("Date")[["Routes Feasible", "Routes Not Feasible"]])
+                with st.expander("Daily detail"):
+                    st.dataframe(year_days, use_container_width=True)
+                st.download_button("Download Daily Energy (kWh) CSV", data=convert_df_to_csv(year_energy.reset_index()),
+                                   file_name="school_year_energy.csv", mime="text/csv", key="download_school_year_tab4")
+
+        # --- State-of-charge simulation (simulation_logic) ---
+        st.subheader("🔋 State-of-Charge Simulation")
+        st.markdown("Steps each vehicle's battery through its day, leg by leg: AM legs and stop dwells, deadhead to the depot, the midday layover, deadhead out and the PM legs. A route fails on a day when its charge drops below the reserve.")
+        sim_cols = st.columns(2)
+        sim_charge_kw = sim_cols[0].number_input("Midday depot charger (kW)", min_value=0.0, value=0.0, step=1.0, key="sim_charge_kw_tab4",
+                                                 help="0 = no charging between the AM and PM runs, as in the plan above.")
+        if climatology is not None:
+            sim_cols[1].caption("Temperatures: climatology by depot ZIP and date.")
+            sim_band = None
+        else:
+            sim_band = sim_cols[1].selectbox("Temperature (no climatology loaded):", options=list(BAND_TEMPERATURES_F.keys()),
+                                             format_func=lambda band: f"{band.replace(' Range', '')} ({BAND_TEMPERATURES_F[band]:.0f}°F)", key="sim_band_tab4")
+        if st.button("Run Simulation", key="run_simulation_tab4"):
+            try:
+                sim_route_ids = [r.get("Route ID") for r in st.session_state.results if r.get("Route ID")]
+                am_temps, pm_temps = route_temperatures(sim_route_ids, route_depot_zips() if climatology is not None else {}, year_dates, climatology,
+                                                        BAND_TEMPERATURES_F[sim_band] if sim_band else None)
+                st.session_state.soc_simulation = simulate_fleet(
+                    st.session_state.results, st.session_state.routes, st.session_state.route_bus_types, st.session_state.ev_fleet,
+                    year_dates, am_temps, pm_temps, assignment_df=st.session_state.get("assignment_df"), charge_kw=sim_charge_kw)
+                st.session_state.soc_simulation_temps = (year_dates, am_temps, pm_temps, sim_charge_kw) # Inputs the timeline must reuse
+            except Exception as e:
+                st.error(f"Error running the simulation: {e}")
+                st.session_state.soc_simulation = None
+        if st.session_state.get("soc_simulation") is not None:
+            sim_summary, sim_failures = st.session_state.soc_simulation
+            sim_metrics = st.columns(2)
+            sim_metrics[0].metric("Routes Failing on Some Day", int((sim_summary["Days Failed"] > 0).sum()))
+            sim_metrics[1].metric("Failing Route-Days", len(sim_failures))
+            st.dataframe(sim_summary, use_container_width=True)
+            if not sim_failures.empty:
+                with st.expander(f"Failing route-days ({len(sim_failures)})"):
+                    st.dataframe(sim_failures, use_container_width=True)
+            # One vehicle's SoC through one day
+            timeline_cols = st.columns(2)
+            timeline_route = timeline_cols[0].selectbox("Route timeline:", sim_summary["Route ID"].tolist(), key="sim_timeline_route_tab4")
+            sim_dates, am_temps, pm_temps, sim_run_charge_kw = st.session_state.soc_simulation_temps
+            timeline_day = timeline_cols[1].selectbox("Date:", list(range(len(sim_dates))), format_func=lambda d: sim_dates[d].strftime("%Y-%m-%d"), key="sim_timeline_day_tab4")
+            if timeline_route is not None and timeline_day is not None:
+                row = sim_summary.index[sim_summary["Route ID"] == timeline_route][0]
+                timeline_result = next(r for r in st.session_state.results if r.get("Route ID") == timeline_route)
+                timeline_df = soc_timeline(
+                    timeline_result, next((r for r in st.session_state.routes if r.get("route_id") == timeline_route), None),
+                    st.session_state.route_bus_types.get(timeline_route, "A"), sim_summary.at[row, "Battery (kWh)"],
+                    am_temps[row, timeline_day], pm_temps[row, timeline_day], charge_kw=sim_run_charge_kw)
+                st.line_chart(timeline_df.set_index("Time")[["SoC (%)", "Reserve (%)"]])
+                st.dataframe(timeline_df, use_container_width=True)
+
+        # --- Overnight depot charging (charging_logic) ---
+        st.subheader("🔌 Overnight Depot Charging")
+        st.markdown("Schedules overnight charging for the buses assigned above, from their PM return to the next morning's departure. With a charger per bus, each bus's energy is spread over its whole window to keep the depot's peak demand as low as possible; "
+                    "with fewer chargers than buses, buses charge at full power in the least-loaded slots so chargers free up quickly. Both respect the grid cap.")
+        charge_band = st.selectbox("Design day temperature:", options=list(BAND_TEMPERATURES_F.keys()),
+                                   format_func=lambda band: f"{band.replace(' Range', '')} ({BAND_TEMPERATURES_F[band]:.0f}°F)", key="charge_band_tab4")
+        # Only the depot list is needed to render the settings; the energy model runs on "Plan Charging"
+        charge_depots = electric_depots(st.session_state.routes, st.session_state.get("assignment_df"))
+        if charge_depots.empty:
+            st.info("No electric buses assigned yet. Assign vehicles above to plan their overnight charging.")
+        else:
+            st.caption("Depot chargers and grid limits (Grid Cap 0 = no limit):")
+            depot_settings = st.data_editor(default_depot_settings(charge_depots), disabled=["Depot"], hide_index=True,
+                                            use_container_width=True, key="depot_settings_tab4")
+            if st.button("Plan Charging", key="plan_charging_tab4"):
+                try:
+                    charge_profiles = day_profiles(st.session_state.results, st.session_state.routes, st.session_state.route_bus_types,
+                                                   BAND_TEMPERATURES_F[charge_band], BAND_TEMPERATURES_F[charge_band])
+                    charge_sessions = charging_sessions(charge_profiles, st.session_state.get("assignment_df"))
+                    st.session_state.charging_plan = plan_charging(charge_sessions, depot_settings)
+                except Exception as e:
+                    st.error(f"Error planning depot charging: {e}")
+                    st.session_state.charging_plan = None
+            if st.session_state.get("charging_plan") is not None:
+                depot_summary, charge_schedule, charge_load = st.session_state.charging_plan
+                st.dataframe(depot_summary, use_container_width=True)
+                if (depot_summary["Shortfall (kWh)"] > 0).any():
+                    st.warning("Some buses cannot be fully charged before departure with these chargers and grid limits.")
+                # Numeric hours keep the two-day axis in order (the HH:MM labels would sort as text)
+                st.line_chart(charge_load.drop(columns="Time").set_index("Hour"))
+                st.caption("Depot load (kW) by hour after midnight of the service day; 24+ is the next morning.")
+                with st.expander(f"Bus charging schedule ({len(charge_schedule)} buses)"):
+                    st.dataframe(charge_schedule, use_container_width=True)
+                st.download_button("Download Charging Schedule CSV", data=convert_df_to_csv(charge_schedule),
+                                   file_name="charging_schedule.csv", mime="text/csv", key="download_charging_tab4")
+
         st.subheader("⚡ EV Fleet Range Summary")
         # Ensure ev_fleet data exists before displaying its summary
         if st.session_state.get("ev_fleet") is not None:
@@ -1243,206 +1185,264 @@ with tab4:
                  # Handle case where plan exists but has no routes (unlikely but possible)
                  st.info("No routes found in the generated plan to display on map.")
              else:
-                 # --- Map Controls (Route and Trip Type Selection) ---
-                 # Ensure selection state exists and is valid, default to first route if not
-                 current_selection = st.session_state.get("selected_route_id_map")
-                 if current_selection not in route_ids_in_plan:
-                     st.session_state.selected_route_id_map = route_ids_in_plan[0] # Default to first
-
-                 # Use columns for controls layout
-                 col1, col2 = st.columns([1, 1])
-                 with col1:
-                    # Find index safely for selectbox default
-                    try: current_index = route_ids_in_plan.index(st.session_state.selected_route_id_map)
-                    except ValueError: current_index = 0 # Default to 0 if ID not found (shouldn't happen)
-
-                    # Route ID selector dropdown
-                    st.session_state.selected_route_id_map = st.selectbox(
-                        "Select Route ID to Display:",
-                        options=route_ids_in_plan,
-                        key="map_route_selector_tab4", # Unique key
-                        index=current_index
-                    )
-                 with col2:
-                     # Trip type selector radio buttons
-                     trip_options = ["AM Trip", "PM Trip", "Round Trip"]
-                     # Default to "AM Trip" if state is missing or invalid
-                     current_trip_type = st.session_state.get("selected_trip_type_map", "AM Trip")
-                     if current_trip_type not in trip_options: current_trip_type = "AM Trip"
-                     try: trip_index = trip_options.index(current_trip_type)
-                     except ValueError: trip_index = 0 # Default to AM Trip index
-
-                     st.session_state.selected_trip_type_map = st.radio(
-                        "Select Trip Type:",
-                        options=trip_options,
-                        key="map_trip_type_selector_tab4", # Unique key
-                        index=trip_index,
-                        horizontal=True
-                     )
-
-                 # --- Find Selected Route Data ---
-                 # Get the original route definition (for stops)
-                 selected_route_original_data = next((r for r in st.session_state.get("routes", []) if r.get("route_id") == st.session_state.selected_route_id_map), None)
-                 # Get the calculated feasibility results (for polylines, distances etc.)
-                 selected_feasibility_data = next((res for res in st.session_state.get("results", []) if res.get("Route ID") == st.session_state.selected_route_id_map), None)
-
-                 # Proceed only if both original route data and feasibility data were found
-                 if selected_route_original_data and selected_feasibility_data:
-                    # Use columns for Map and Info Panel layout
-                    map_col, info_col = st.columns([3, 2]) # Adjust ratio as needed (3 parts map, 2 parts info)
-
-                    with map_col:
-                        # --- Map Creation ---
-                        # Find a default center point - fit_bounds will override this later
-                        depot_loc = selected_route_original_data.get("depot")
-                        pickups_list = selected_route_original_data.get("pickups", []) # Get lists safely
-                        dropoffs_list = selected_route_original_data.get("dropoffs", [])
-                        first_pickup = pickups_list[0].get("location") if pickups_list else None
-                        first_dropoff = dropoffs_list[0].get("location") if dropoffs_list else None
-                        # Determine initial center for map creation
-                        map_center = depot_loc or first_pickup or first_dropoff or [40.7128, -74.0060] # Fallback
-
-                        # Initialize map - start slightly zoomed out, fit_bounds will adjust
-                        m = folium.Map(location=map_center, zoom_start=11, tiles="cartodbpositron", control_scale=True)
-
-                        # --- Prepare ALL points for bounds fitting ---
-                        points_to_fit = []
-                        # Add depot location if valid
-                        if depot_loc and isinstance(depot_loc, (list, tuple)) and len(depot_loc) == 2:
-                             points_to_fit.append(depot_loc)
-                        # Add all pickup locations if valid
-                        for pickup in pickups_list:
-                             loc = pickup.get("location")
-                             if loc and isinstance(loc, (list, tuple)) and len(loc) == 2: points_to_fit.append(loc)
-                        # Add all dropoff locations if valid
-                        for dropoff in dropoffs_list:
-                             loc = dropoff.get("location")
-                             if loc and isinstance(loc, (list, tuple)) and len(loc) == 2: points_to_fit.append(loc)
-
-                        # --- Add Markers ---
-                        # Helper function to add markers safely
-                        def add_marker(loc, pop, tip, ico_name, ico_color):
-                            if loc and isinstance(loc, (list, tuple)) and len(loc) == 2:
-                                try:
-                                     # Use Icon from folium directly
-                                     folium.Marker(location=loc, popup=pop, tooltip=tip, icon=folium.Icon(color=ico_color, icon=ico_name, prefix='fa')).add_to(m)
-                                except Exception as marker_err:
-                                     # Log warning but continue
-                                     st.warning(f"Could not add marker for '{tip}': {marker_err}")
-
-                        # Add markers for depot, pickups, dropoffs
-                        add_marker(depot_loc, f"Depot ({selected_route_original_data.get('route_id', 'N/A')})", "Depot", 'bus', DEPOT_COLOR) # Uses constant
-                        for i, pickup in enumerate(pickups_list): add_marker(pickup.get("location"), f"Pickup {i+1}", f"Pickup {i+1}", 'user-plus', PICKUP_COLOR) # Uses constant
-                        for i, dropoff in enumerate(dropoffs_list):
-                             # Include bell time in popup for first dropoff
-                             bell_time_str = f" (Bell: {selected_feasibility_data.get('First School Bell Time', 'N/A')})" if i == 0 and selected_feasibility_data.get('First School Bell Time') else ""
-                             add_marker(dropoff.get("location"), f"Dropoff {i+1}{bell_time_str}", f"Dropoff {i+1}", 'school', DROPOFF_COLOR) # Uses constant
-
-
-                        # --- Add Polylines AND collect their points for bounds ---
-                        # Helper function to add polyline and return decoded points
-                        def add_polyline_to_map(map_obj, encoded_polyline, color, weight, opacity, tooltip):
-                             # Make sure polyline library is available
-                             if 'polyline' not in globals() or not encoded_polyline or not isinstance(encoded_polyline, str): return []
-                             try:
-                                 decoded_points = polyline.decode(encoded_polyline) # Use imported polyline library
-                                 if decoded_points:
-                                     folium.PolyLine(locations=decoded_points, color=color, weight=weight, opacity=opacity, tooltip=tooltip).add_to(map_obj)
-                                     return decoded_points # Return points for bounds calculation
-                             except Exception as poly_err:
-                                 st.warning(f"Could not decode/add polyline '{tooltip}': {poly_err}")
-                             return []
-
-                        # Get polylines from feasibility results
-                        am_poly = selected_feasibility_data.get("AM Overview Polyline")
-                        pm_poly = selected_feasibility_data.get("PM Overview Polyline")
-
-                        # Add selected polylines and collect their points for fitting bounds
-                        if st.session_state.selected_trip_type_map in ["AM Trip", "Round Trip"]:
-                             decoded_am_points = add_polyline_to_map(m, am_poly, AM_ROUTE_COLOR, 4, 0.7, "AM Route")
-                             if decoded_am_points: points_to_fit.extend(decoded_am_points) # Add points to list
-                        if st.session_state.selected_trip_type_map in ["PM Trip", "Round Trip"]:
-                             decoded_pm_points = add_polyline_to_map(m, pm_poly, PM_ROUTE_COLOR, 4, 0.7, "PM Route")
-                             if decoded_pm_points: points_to_fit.extend(decoded_pm_points) # Add points to list
-
-
-                        # --- Fit Bounds Using ALL Collected Points ---
-                        # Check if we have enough unique points to make bounds meaningful
-                        # Use set() to find unique points before checking length
-                        if len(set(map(tuple, points_to_fit))) >= 2: # Need at least 2 distinct points for bounds
-                            try:
-                                m.location = map_center
-                                m.zoom_start = 11 # Increased padding
-                            except Exception as bounds_err:
-                                 st.warning(f"Could not automatically fit map bounds: {bounds_err}")
-                                 # Fallback: Center on the initial map_center if bounds fail
-                                 m.location = map_center
-                                 m.zoom_start = 11 # Reset zoom if bounds fail
-                        elif len(points_to_fit) == 1: # Center on single point if only one exists
-                             m.location = points_to_fit[0]
-                             m.zoom_start = 11 # Zoom closer for single point
-                        # If points_to_fit is empty, the initial map center/zoom calculated earlier remains
-
-
-                        # --- Display Map ---
-                        # Use a unique key for the map component within the tab
-                        st_folium(m, width='100%', height=500, key="route_map_display_tab4")
-
-                    # --- Info Panel Column ---
-                    with info_col:
-                        st.subheader(f"Route Details: {st.session_state.selected_route_id_map}")
-
-                        # Display distances/durations based on selected trip type
-                        am_dist = selected_feasibility_data.get("AM Distance (miles)")
-                        pm_dist = selected_feasibility_data.get("PM Distance (miles)")
-                        am_dur = selected_feasibility_data.get("AM Duration (min)")
-                        pm_dur = selected_feasibility_data.get("PM Duration (min)")
-
-                        st.markdown(f"**Trip Type Shown:** {st.session_state.selected_trip_type_map}")
-                        # Use st.metric for nice display
-                        if st.session_state.selected_trip_type_map == "AM Trip":
-                            st.metric("AM Distance", f"{am_dist:.1f} mi" if am_dist else "N/A")
-                            st.metric("AM Duration", f"{am_dur:.0f} min" if am_dur else "N/A")
-                        elif st.session_state.selected_trip_type_map == "PM Trip":
-                            st.metric("PM Distance", f"{pm_dist:.1f} mi" if pm_dist else "N/A")
-                            st.metric("PM Duration", f"{pm_dur:.0f} min" if pm_dur else "N/A")
-                        else: # Round Trip
-                             rt_dist = (am_dist or 0) + (pm_dist or 0)
-                             rt_dur = (am_dur or 0) + (pm_dur or 0)
-                             st.metric("Round Trip Distance", f"{rt_dist:.1f} mi")
-                             st.metric("Round Trip Duration", f"{rt_dur:.0f} min")
-
-                        st.divider() # Visual separator
-                        # Display other route details
-                        st.markdown(f"**Suggested Depot Departure:** {selected_feasibility_data.get('Suggested Depot Departure Time', 'N/A')}")
-                        dac_percent = selected_feasibility_data.get('Percent in DAC')
-                        st.markdown(f"**% Route in DAC:** {dac_percent:.1f}%" if dac_percent is not None else "N/A")
-
-                        # --- Display Eligibility from Plan DataFrame ---
-                        # Find the row in the plan_df for the selected route
-                        route_plan_info = plan_df[plan_df['Route ID'] == st.session_state.selected_route_id_map]
-                        # Check if info was found (it should be if route_id is valid)
-                        if not route_plan_info.empty:
-                            route_info_row = route_plan_info.iloc[0] # Get the first (and only) row
-                            eligibility = route_info_row.get('EV Eligibility', 'N/A')
-                            bus_type = route_info_row.get('Bus Type', 'N/A')
-
-                            # Determine which list of eligible buses to display based on weather
-                            eligible_bus_names = ""
-                            if eligibility in ["Preferred - All Weather", "OK in All Weather"]: eligible_bus_names = route_info_row.get('Eligible Buses < 50°F', '')
-                            elif eligibility == "OK > 50°F Weather": eligible_bus_names = route_info_row.get('Eligible Buses 50–70°F', '')
-                            elif eligibility == "OK > 70°F Weather": eligible_bus_names = route_info_row.get('Eligible Buses 70°F+', '')
-
-                            # Format the display string
-                            eligibility_display = f"**EV Eligibility:** {eligibility}"
-                            # Add bus names only if they are not empty/'None'/'N/A'
-                            if eligible_bus_names and isinstance(eligible_bus_names, str) and eligible_bus_names not in ["None", "N/A", ""]:
-                                eligibility_display += f" (with: *{eligible_bus_names}*)"
-
-                            st.markdown(f"**Assigned Bus Type:** {bus_type}")
-                            st.markdown(eligibility_display) # Display the combined string
-                        else:
-                             st.markdown("**EV Eligibility Status:** Not found in plan details.")
-
-                 else: # Handle case where original route data or feasibility data wasn't found
-                     st.warning(f"Could not retrieve all necessary data for Route ID: {st.session_state.selected_route_id_map} to display map/details.")
\ No newline at end of file
+                 # --- Map mode: one route in detail, or the whole plan at once (map_logic) ---
+                 map_mode_cols = st.columns([3, 1])
+                 map_mode = map_mode_cols[0].radio("Map view:", ["Single route", "All routes overview"], horizontal=True, key="map_mode_tab4")
+                 # Precomputed DAC GeoJSON (map_logic.DacOverlay); toggling it only changes the map cache key
+                 show_dac_tab4 = map_mode_cols[1].checkbox("Show DAC areas", key="show_dac_tab4", disabled=dac_overlay is None,
+                                                           help="Disadvantaged Community tracts used for 'Percent in DAC'.")
+                 show_dac_tab4 = show_dac_tab4 and dac_overlay is not None
+                 if map_mode == "All routes overview":
+                     overview_cols = st.columns([2, 1])
+                     overview_trip = overview_cols[0].radio("Trips:", ["AM Trip", "PM Trip", "Round Trip"], horizontal=True, key="overview_trip_tab4")
+                     if overview_cols[1].button("Fit whole plan", key="overview_reset_tab4"):
+                         st.session_state.overview_view = None
+                         # A fresh map component, so the old view it still holds isn't written back over the fitted one
+                         st.session_state.overview_map_version += 1
+                     # Last view reported by the map; lines are re-simplified and clipped for it
+                     overview_view = st.session_state.get("overview_view") or {}
+                     try:
+                         overview_key = ("overview", overview_trip, show_dac_tab4, str(overview_view), make_cache_key(
+                             plan_df[["Route ID", "EV Eligibility"]].values.tolist(),
+                             [route_stops_key(r) for r in st.session_state.get("routes", [])],
+                             [(r.get("AM Overview Polyline"), r.get("PM Overview Polyline")) for r in st.session_state.results]))
+                         overview_map, overview_stats = st.session_state.map_render_cache.get_or_build(overview_key, lambda: build_overview_map(
+                             plan_df, st.session_state.get("routes", []), st.session_state.results, st.session_state.geometry_cache,
+                             overview_trip, center=overview_view.get("center"), zoom=overview_view.get("zoom"),
+                             dac_overlay=dac_overlay if show_dac_tab4 else None))
+                         overview_output = st_folium(overview_map, width='100%', height=550, key=f"overview_map_tab4_{st.session_state.overview_map_version}",
+                                                     returned_objects=["center", "zoom"])
+                         st.markdown(" ".join(f"<span style='color:{color}'>━━</span> {label}" for label, color in ELIGIBILITY_COLORS.items()), unsafe_allow_html=True)
+                         st.caption(f"{overview_stats['lines']} trip lines ({overview_stats['vertices']:,} points) and {overview_stats['clusters']} stop clusters "
+                                    f"({overview_stats['stops']:,} stops in plan) drawn at zoom {overview_stats['zoom']}. Zoom in for more detail.")
+                         # Rebuild for the new view once the user pans/zooms far enough to need it
+                         if overview_output and overview_output.get("zoom") is not None and overview_output.get("center"):
+                             new_view = {"center": [overview_output["center"]["lat"], overview_output["center"]["lng"]], "zoom": clamp_zoom(overview_output["zoom"])}
+                             if new_view != overview_view and (not overview_view or view_needs_rebuild(overview_stats["center"], overview_stats["zoom"], new_view["center"], new_view["zoom"])):
+                                 st.session_state.overview_view = new_view
+                                 st.rerun()
+                     except Exception as e:
+                         st.error(f"Could not build the overview map: {e}")
+                 else:
+                     # --- Map Controls (Route and Trip Type Selection) ---
+                     # Ensure selection state exists and is valid, default to first route if not
+                     current_selection = st.session_state.get("selected_route_id_map")
+                     if current_selection not in route_ids_in_plan:
+                         st.session_state.selected_route_id_map = route_ids_in_plan[0] # Default to first
+
+                     # Use columns for controls layout
+                     col1, col2 = st.columns([1, 1])
+                     with col1:
+                        # Find index safely for selectbox default
+                        try: current_index = route_ids_in_plan.index(st.session_state.selected_route_id_map)
+                        except ValueError: current_index = 0 # Default to 0 if ID not found (shouldn't happen)
+
+                        # Route ID selector dropdown
+                        st.session_state.selected_route_id_map = st.selectbox(
+                            "Select Route ID to Display:",
+                            options=route_ids_in_plan,
+                            key="map_route_selector_tab4", # Unique key
+                            index=current_index
+                        )
+                     with col2:
+                         # Trip type selector radio buttons
+                         trip_options = ["AM Trip", "PM Trip", "Round Trip"]
+                         # Default to "AM Trip" if state is missing or invalid
+                         current_trip_type = st.session_state.get("selected_trip_type_map", "AM Trip")
+                         if current_trip_type not in trip_options: current_trip_type = "AM Trip"
+                         try: trip_index = trip_options.index(current_trip_type)
+                         except ValueError: trip_index = 0 # Default to AM Trip index
+
+                         st.session_state.selected_trip_type_map = st.radio(
+                            "Select Trip Type:",
+                            options=trip_options,
+                            key="map_trip_type_selector_tab4", # Unique key
+                            index=trip_index,
+                            horizontal=True
+                         )
+
+                     # --- Find Selected Route Data ---
+                     # Get the original route definition (for stops)
+                     selected_route_original_data = next((r for r in st.session_state.get("routes", []) if r.get("route_id") == st.session_state.selected_route_id_map), None)
+                     # Get the calculated feasibility results (for polylines, distances etc.)
+                     selected_feasibility_data = next((res for res in st.session_state.get("results", []) if res.get("Route ID") == st.session_state.selected_route_id_map), None)
+
+                     # Proceed only if both original route data and feasibility data were found
+                     if selected_route_original_data and selected_feasibility_data:
+                        # Use columns for Map and Info Panel layout
+                        map_col, info_col = st.columns([3, 2]) # Adjust ratio as needed (3 parts map, 2 parts info)
+
+                        with map_col:
+                            # --- Map Creation ---
+                            # Find a default center point - fit_bounds will override this later
+                            depot_loc = selected_route_original_data.get("depot")
+                            pickups_list = selected_route_original_data.get("pickups", []) # Get lists safely
+                            dropoffs_list = selected_route_original_data.get("dropoffs", [])
+                            first_pickup = pickups_list[0].get("location") if pickups_list else None
+                            first_dropoff = dropoffs_list[0].get("location") if dropoffs_list else None
+                            # Determine initial center for map creation
+                            map_center = depot_loc or first_pickup or first_dropoff or [40.7128, -74.0060] # Fallback
+
+                            # Built maps are cached per session by stops, polylines and trip type, so reruns
+                            # from other widgets reuse the map instead of rebuilding markers and lines (map_logic).
+                            # Warnings go to messages and are cached with the map, so they stay on screen with it
+                            def build_route_map(messages):
+                                # Initialize map - start slightly zoomed out, fit_bounds will adjust
+                                m = folium.Map(location=map_center, zoom_start=11, tiles="cartodbpositron", control_scale=True)
+                                if show_dac_tab4: dac_overlay.add_to(m, 11) # Below the route lines and markers
+
+                                # --- Prepare ALL points for bounds fitting ---
+                                points_to_fit = []
+                                # Add depot location if valid
+                                if depot_loc and isinstance(depot_loc, (list, tuple)) and len(depot_loc) == 2:
+                                     points_to_fit.append(depot_loc)
+                                # Add all pickup locations if valid
+                                for pickup in pickups_list:
+                                     loc = pickup.get("location")
+                                     if loc and isinstance(loc, (list, tuple)) and len(loc) == 2: points_to_fit.append(loc)
+                                # Add all dropoff locations if valid
+                                for dropoff in dropoffs_list:
+                                     loc = dropoff.get("location")
+                                     if loc and isinstance(loc, (list, tuple)) and len(loc) == 2: points_to_fit.append(loc)
+
+                                # --- Add Markers ---
+                                # Helper function to add markers safely
+                                def add_marker(loc, pop, tip, ico_name, ico_color):
+                                    if loc and isinstance(loc, (list, tuple)) and len(loc) == 2:
+                                        try:
+                                             # Use Icon from folium directly
+                                             folium.Marker(location=loc, popup=pop, tooltip=tip, icon=folium.Icon(color=ico_color, icon=ico_name, prefix='fa')).add_to(m)
+                                        except Exception as marker_err:
+                                             # Log warning but continue
+                                             messages.warning(f"Could not add marker for '{tip}': {marker_err}")
+
+                                # Add markers for depot, pickups, dropoffs
+                                add_marker(depot_loc, f"Depot ({selected_route_original_data.get('route_id', 'N/A')})", "Depot", 'bus', DEPOT_COLOR) # Uses constant
+                                for i, pickup in enumerate(pickups_list): add_marker(pickup.get("location"), f"Pickup {i+1}", f"Pickup {i+1}", 'user-plus', PICKUP_COLOR) # Uses constant
+                                for i, dropoff in enumerate(dropoffs_list):
+                                     # Include bell time in popup for first dropoff
+                                     bell_time_str = f" (Bell: {selected_feasibility_data.get('First School Bell Time', 'N/A')})" if i == 0 and selected_feasibility_data.get('First School Bell Time') else ""
+                                     add_marker(dropoff.get("location"), f"Dropoff {i+1}{bell_time_str}", f"Dropoff {i+1}", 'school', DROPOFF_COLOR) # Uses constant
+
+
+                                # --- Add Polylines AND collect their end points for bounds ---
+                                # Helper function to add polyline; geometry comes from the session geometry cache (decoded once)
+                                def add_polyline_to_map(map_obj, encoded_polyline, color, weight, opacity, tooltip):
+                                     if not encoded_polyline or not isinstance(encoded_polyline, str): return []
+                                     try:
+                                         geometry = st.session_state.geometry_cache.get(encoded_polyline)
+                                         if geometry is not None and len(geometry.coords):
+                                             folium.PolyLine(locations=geometry.locations, color=color, weight=weight, opacity=opacity, tooltip=tooltip).add_to(map_obj)
+                                             return [tuple(geometry.coords[0]), tuple(geometry.coords[-1])] # End points for bounds calculation
+                                     except Exception as poly_err:
+                                         messages.warning(f"Could not decode/add polyline '{tooltip}': {poly_err}")
+                                     return []
+
+                                # Get polylines from feasibility results
+                                am_poly = selected_feasibility_data.get("AM Overview Polyline")
+                                pm_poly = selected_feasibility_data.get("PM Overview Polyline")
+
+                                # Add selected polylines and collect their points for fitting bounds
+                                if st.session_state.selected_trip_type_map in ["AM Trip", "Round Trip"]:
+                                     decoded_am_points = add_polyline_to_map(m, am_poly, AM_ROUTE_COLOR, 4, 0.7, "AM Route")
+                                     if decoded_am_points: points_to_fit.extend(decoded_am_points) # Add points to list
+                                if st.session_state.selected_trip_type_map in ["PM Trip", "Round Trip"]:
+                                     decoded_pm_points = add_polyline_to_map(m, pm_poly, PM_ROUTE_COLOR, 4, 0.7, "PM Route")
+                                     if decoded_pm_points: points_to_fit.extend(decoded_pm_points) # Add points to list
+
+
+                                # --- Fit Bounds Using ALL Collected Points ---
+                                # Check if we have enough unique points to make bounds meaningful
+                                # Use set() to find unique points before checking length
+                                if len(set(map(tuple, points_to_fit))) >= 2: # Need at least 2 distinct points for bounds
+                                    try:
+                                        m.location = map_center
+                                        m.zoom_start = 11 # Increased padding
+                                    except Exception as bounds_err:
+                                         messages.warning(f"Could not automatically fit map bounds: {bounds_err}")
+                                         # Fallback: Center on the initial map_center if bounds fail
+                                         m.location = map_center
+                                         m.zoom_start = 11 # Reset zoom if bounds fail
+                                elif len(points_to_fit) == 1: # Center on single point if only one exists
+                                     m.location = points_to_fit[0]
+                                     m.zoom_start = 11 # Zoom closer for single point
+                                # If points_to_fit is empty, the initial map center/zoom calculated earlier remains
+                                return m
+
+                            route_map_key = ("route", route_stops_key(selected_route_original_data), st.session_state.selected_trip_type_map, show_dac_tab4,
+                                             make_cache_key(selected_feasibility_data.get("AM Overview Polyline"), selected_feasibility_data.get("PM Overview Polyline"),
+                                                            selected_feasibility_data.get("First School Bell Time")))
+                            m = st.session_state.map_render_cache.get_or_build(route_map_key, build_route_map, ui=st) # Builder warnings replay on every rerun
+
+                            # --- Display Map ---
+                            # Use a unique key for the map component within the tab
+                            st_folium(m, width='100%', height=500, key="route_map_display_tab4")
+
+                        # --- Info Panel Column ---
+                        with info_col:
+                            st.subheader(f"Route Details: {st.session_state.selected_route_id_map}")
+
+                            # Display distances/durations based on selected trip type
+                            am_dist = selected_feasibility_data.get("AM Distance (miles)")
+                            pm_dist = selected_feasibility_data.get("PM Distance (miles)")
+                            am_dur = selected_feasibility_data.get("AM Duration (min)")
+                            pm_dur = selected_feasibility_data.get("PM Duration (min)")
+
+                            st.markdown(f"**Trip Type Shown:** {st.session_state.selected_trip_type_map}")
+                            # Use st.metric for nice display
+                            if st.session_state.selected_trip_type_map == "AM Trip":
+                                st.metric("AM Distance", f"{am_dist:.1f} mi" if am_dist else "N/A")
+                                st.metric("AM Duration", f"{am_dur:.0f} min" if am_dur else "N/A")
+                            elif st.session_state.selected_trip_type_map == "PM Trip":
+                                st.metric("PM Distance", f"{pm_dist:.1f} mi" if pm_dist else "N/A")
+                                st.metric("PM Duration", f"{pm_dur:.0f} min" if pm_dur else "N/A")
+                            else: # Round Trip
+                                 rt_dist = (am_dist or 0) + (pm_dist or 0)
+                                 rt_dur = (am_dur or 0) + (pm_dur or 0)
+                                 st.metric("Round Trip Distance", f"{rt_dist:.1f} mi")
+                                 st.metric("Round Trip Duration", f"{rt_dur:.0f} min")
+
+                            st.divider() # Visual separator
+                            # Display other route details
+                            st.markdown(f"**Suggested Depot Departure:** {selected_feasibility_data.get('Suggested Depot Departure Time', 'N/A')}")
+                            dac_percent = selected_feasibility_data.get('Percent in DAC')
+                            st.markdown(f"**% Route in DAC:** {dac_percent:.1f}%" if dac_percent is not None else "N/A")
+
+                            # --- Display Eligibility from Plan DataFrame ---
+                            # Find the row in the plan_df for the selected route
+                            route_plan_info = plan_df[plan_df['Route ID'] == st.session_state.selected_route_id_map]
+                            # Check if info was found (it should be if route_id is valid)
+                            if not route_plan_info.empty:
+                                route_info_row = route_plan_info.iloc[0] # Get the first (and only) row
+                                eligibility = route_info_row.get('EV Eligibility', 'N/A')
+                                bus_type = route_info_row.get('Bus Type', 'N/A')
+
+                                # Determine which list of eligible buses to display based on weather
+                                eligible_bus_names = ""
+                                if eligibility in ["Preferred - All Weather", "OK in All Weather"]: eligible_bus_names = route_info_row.get('Eligible Buses < 50°F', '')
+                                elif eligibility == "OK > 50°F Weather": eligible_bus_names = route_info_row.get('Eligible Buses 50–70°F', '')
+                                elif eligibility == "OK > 70°F Weather": eligible_bus_names = route_info_row.get('Eligible Buses 70°F+', '')
+
+                                # Format the display string
+                                eligibility_display = f"**EV Eligibility:** {eligibility}"
+                                # Add bus names only if they are not empty/'None'/'N/A'
+                                if eligible_bus_names and isinstance(eligible_bus_names, str) and eligible_bus_names not in ["None", "N/A", ""]:
+                                    eligibility_display += f" (with: *{eligible_bus_names}*)"
+
+                                st.markdown(f"**Assigned Bus Type:** {bus_type}")
+                                st.markdown(eligibility_display) # Display the combined string
+                            else:
+                                 st.markdown("**EV Eligibility Status:** Not found in plan details.")
+
+                     else: # Handle case where original route data or feasibility data wasn't found
+                         st.warning(f"Could not retrieve all necessary data for Route ID: {st.session_state.selected_route_id_map} to display map/details.")
+
+# --- Shared data diagnostics (process-wide datasets from load_spatial_data) ---
+st.markdown("---")
+with st.expander("🧠 Shared Spatial Data Memory Report"):
+    st.caption("These datasets are loaded once per server process and shared by all sessions. Sizes are estimates.")
+    try:
+        st.dataframe(memory_report({"zip_index": zip_index, "zip_areas": zip_areas, "dac_locs_gdf": dac_locs_gdf, "dac_index": dac_index,
+                                   "dac_overlay": dac_overlay.geojson_by_zoom if dac_overlay is not None else None}), use_container_width=True)
+    except Exception as e:
+        st.warning(f"Could not build memory report: {e}")
@@ -0,0 +1,159 @@
+import contextlib
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+# Small on-disk cache for billed Google API responses. One SQLite file per
+# cache, shared by every session/worker on the machine, so re-runs and
+# "Reset Application" don't pay for the same request twice.
+
+DEFAULT_CACHE_DIR = ".cache"
+# Settings for the two Google API caches, shared by app.py and the pipeline CLI,
+# which read and write the same SQLite files
+DIRECTIONS_CACHE_PATH = os.path.join(DEFAULT_CACHE_DIR, "directions.sqlite")
+DIRECTIONS_CACHE_TTL_SECONDS = 7 * 24 * 3600 # Traffic estimates drift, so don't keep answers forever
+DIRECTIONS_CACHE_MAX_ENTRIES = 20000
+GEOCODE_CACHE_PATH = os.path.join(DEFAULT_CACHE_DIR, "geocode.sqlite")
+GEOCODE_CACHE_TTL_SECONDS = 90 * 24 * 3600 # School and depot addresses rarely move
+GEOCODE_NEGATIVE_TTL_SECONDS = 24 * 3600 # Retry ZERO_RESULTS addresses after a day
+GEOCODE_CACHE_MAX_ENTRIES = 200000
+CACHE_LOW_WATER = 0.9 # Eviction trims to 90% of the limits, so it runs about once per 10% of max_entries writes
+CACHE_RECOUNT_WRITES = 1000 # Running totals are re-read from the file this often (other processes write to it too)
+
+
+def make_cache_key(*parts):
+    """Content-addressed key: sha256 of the JSON-normalized parts."""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed key/value cache with TTL expiry and LRU size eviction.
+    Values are stored as JSON. Safe to share between threads. Row count and total
+    size are tracked as running totals, so a write doesn't scan the table; once
+    over a limit, the least recently used rows are dropped down to CACHE_LOW_WATER.
+
+    Args:
+        path: SQLite file path (parent directory is created if missing).
+        ttl_seconds: Entries older than this are treated as misses and removed.
+        max_entries: Upper bound on the number of rows kept.
+        max_bytes: Upper bound on the total size of the stored values.
+    """
+
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, max_entries=20000, max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._count, self._bytes, self._writes_since_recount = None, None, 0
+        parent = os.path.dirname(path)
+        if parent: os.makedirs(parent, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER NOT NULL, ttl REAL)"
+            )
+            # Files created before per-entry TTLs existed lack the ttl column
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(entries)")]
+            if "ttl" not in columns: conn.execute("ALTER TABLE entries ADD COLUMN ttl REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed_at)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn: # commits on success, rolls back on error
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """Returns the cached value or None. Counts a hit or a miss."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, created_at, ttl FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at, entry_ttl = row
+            ttl = entry_ttl if entry_ttl is not None else self.ttl_seconds
+            if ttl is not None and now - created_at > ttl:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if self._count is not None: self._count -= 1; self._bytes -= len(value)
+                self.misses += 1
+                return None
+            conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value, ttl_seconds=None):
+        """
+        Stores value (must be JSON-serializable) and evicts old entries if over size.
+        ttl_seconds overrides the cache-wide TTL for this entry (e.g. shorter for negative results).
+        """
+        payload = json.dumps(value, separators=(",", ":"))
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            if self._count is None or self._writes_since_recount >= CACHE_RECOUNT_WRITES: self._recount(conn)
+            old = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at, size, ttl) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, payload, now, now, len(payload), ttl_seconds),
+            )
+            if old is None: self._count += 1
+            self._bytes += len(payload) - (old[0] if old else 0)
+            self._writes_since_recount += 1
+            if self._count > self.max_entries or self._bytes > self.max_bytes:
+                self._evict(conn)
+
+    def _recount(self, conn):
+        self._count, self._bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        self._writes_since_recount = 0
+
+    def _evict(self, conn):
+        # The running totals may miss other processes' writes: confirm before deleting anything
+        self._recount(conn)
+        if self._count <= self.max_entries and self._bytes <= self.max_bytes:
+            return
+        # Drop expired rows first, then least recently used down to the low-water mark
+        conn.execute("DELETE FROM entries WHERE created_at + COALESCE(ttl, ?) < ?",
+                     (self.ttl_seconds if self.ttl_seconds is not None else float("inf"), time.time()))
+        self._recount(conn)
+        drop = max(0, self._count - math.ceil(self.max_entries * CACHE_LOW_WATER))
+        excess_bytes = self._bytes - math.floor(self.max_bytes * CACHE_LOW_WATER)
+        if self._bytes > self.max_bytes and excess_bytes > 0:
+            # Oldest rows needed to free excess_bytes
+            (rows_for_bytes,) = conn.execute(
+                "SELECT COUNT(*) FROM (SELECT size, SUM(size) OVER (ORDER BY accessed_at, key ROWS UNBOUNDED PRECEDING) AS freed"
+                " FROM entries) WHERE freed - size < ?", (excess_bytes,)).fetchone()
+            drop = max(drop, rows_for_bytes)
+        if drop:
+            conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at, key LIMIT ?)", (drop,))
+            self._recount(conn)
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM entries")
+            self._count, self._bytes, self._writes_since_recount = 0, 0, 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Hit/miss counters for this process plus the current on-disk size."""
+        with self._lock, self._connect() as conn:
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "entries": count, "bytes": total,
+        }
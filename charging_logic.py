@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+
+from simulation_logic import CHARGER_EFFICIENCY, depot_key
+
+# Overnight depot charging scheduler. Buses plug in when they return from the
+# PM run and must be charged before the next morning's departure. Each depot
+# has a number of chargers (one bus per charger at a time), a per-charger kW
+# limit and an optional grid cap. Buses are scheduled most-constrained first.
+# With a charger for every bus, each bus's energy is water-filled over its
+# window: it raises the lowest points of the depot load curve to a common level,
+# trickle-charging where there is time, so the peak only grows when it must.
+# With fewer chargers than buses, each bus instead charges at full power in the
+# least loaded slots, so it frees its charger for others as soon as possible
+# (a charger-time heuristic; the peak is lowered only as a side effect).
+# Pure pandas/NumPy, no Streamlit.
+
+SLOT_MINUTES = 15
+HORIZON_MINUTES = 2 * 1440 # Day of service plus the following morning
+DEFAULT_CHARGER_KW = 19.2 # Level 2 depot charger
+
+
+def format_clock(minutes):
+    """Minutes after midnight of the service day as HH:MM, with (+1d) for the next morning."""
+    if minutes is None or not np.isfinite(minutes): return "N/A"
+    day, minute_of_day = divmod(int(round(minutes)), 1440)
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}" + (f" (+{day}d)" if day else "")
+
+
+def depot_label(depot):
+    """Display name for a depot point key (None -> "Unknown depot")."""
+    return f"Depot ({depot[0]:.5f}, {depot[1]:.5f})" if depot else "Unknown depot"
+
+
+def charging_sessions(profiles, assignment_df=None):
+    """
+    One charging session per electric bus from simulation_logic.day_profiles: plug in at
+    the PM return, ready by the next AM departure (+1 day), needing the day's energy back
+    from the grid. Only routes assigned an electric bus in assignment_df (plan_logic.
+    assign_vehicles) are kept, so without an assignment there are no sessions.
+    """
+    if assignment_df is not None and not assignment_df.empty:
+        electric = assignment_df[assignment_df["Assignment"] == "Electric"]
+    else:
+        electric = pd.DataFrame({"Route ID": pd.Series([], dtype=object), "Assigned Vehicle": pd.Series([], dtype=object)})
+    sessions = profiles[profiles["Route ID"].isin(electric["Route ID"])]
+    sessions = sessions.merge(electric[["Route ID", "Assigned Vehicle"]], on="Route ID", how="left")
+    return pd.DataFrame({
+        "Route ID": sessions["Route ID"].to_numpy(),
+        "Vehicle": sessions["Assigned Vehicle"].to_numpy(),
+        "Depot": [depot_label(d) for d in sessions["Depot"]],
+        "Plug In (min)": sessions["Return (min)"].to_numpy(dtype=float),
+        "Ready By (min)": sessions["Departure (min)"].to_numpy(dtype=float) + 1440,
+        "Energy Needed (kWh)": sessions["Energy Used (kWh)"].to_numpy(dtype=float) / CHARGER_EFFICIENCY,
+    })
+
+
+def electric_depots(routes, assignment_df):
+    """
+    DataFrame with the Depot label of every route assigned an electric bus, without the
+    energy model: enough for default_depot_settings before any charging is planned.
+    """
+    if assignment_df is None or assignment_df.empty: return pd.DataFrame({"Depot": pd.Series([], dtype=object)})
+    electric_ids = set(assignment_df.loc[assignment_df["Assignment"] == "Electric", "Route ID"])
+    routes_by_id = {r.get("route_id"): r for r in routes or []}
+    return pd.DataFrame({"Depot": pd.Series([depot_label(depot_key(routes_by_id.get(rid))) for rid in assignment_df["Route ID"] if rid in electric_ids], dtype=object)})
+
+
+def _fill_lowest_slots(base, cap, energy_kwh, slot_hours):
+    """
+    Power per slot (kW) delivering energy_kwh, using the least loaded slots (base) first at
+    their full cap, so a bus holds a charger for as few slots as possible. Ties go to the
+    earliest slot. Returns (power, undelivered kWh).
+    """
+    power = np.zeros(len(base))
+    remaining = max(0.0, float(energy_kwh))
+    for slot in np.argsort(base, kind="stable"):
+        if remaining <= 1e-9: break
+        if cap[slot] <= 0: continue
+        power[slot] = min(cap[slot], remaining / slot_hours)
+        remaining -= power[slot] * slot_hours
+    return power, remaining
+
+
+def _water_fill(base, cap, energy_kwh, slot_hours):
+    """
+    Power per slot (kW) delivering energy_kwh by raising the least loaded slots (base)
+    to one common level, within each slot's cap: the lowest peak this bus can add.
+    Returns (power, undelivered kWh).
+    """
+    power = np.zeros(len(base))
+    energy = max(0.0, float(energy_kwh))
+    usable = cap > 0
+    if energy <= 1e-9 or not usable.any(): return power, energy
+    if cap.sum() * slot_hours <= energy: return cap.astype(float), energy - cap.sum() * slot_hours
+    lo, hi = base[usable].min(), (base + cap)[usable].max()
+    for _ in range(60): # Bisection on the water level
+        level = (lo + hi) / 2
+        if np.clip(level - base, 0, cap).sum() * slot_hours < energy: lo = level
+        else: hi = level
+    power = np.clip(hi - base, 0, cap)
+    return power * (energy / (power.sum() * slot_hours)), 0.0
+
+
+def schedule_depot(sessions, chargers, charger_kw=DEFAULT_CHARGER_KW, grid_cap_kw=None, slot_minutes=SLOT_MINUTES):
+    """
+    Charging plan for the buses of one depot: water-filled (peak-minimizing) when there is
+    a charger per bus, otherwise full power in the least loaded slots (see module comment).
+
+    Args:
+        sessions: Rows of charging_sessions() for this depot.
+        chargers: Number of chargers (buses charging at once).
+        charger_kw: Power limit per charger.
+        grid_cap_kw: Depot-wide power limit, or None for no limit.
+
+    Returns:
+        (per-bus power array (buses x slots) in kW, undelivered kWh per bus).
+    """
+    n_slots = HORIZON_MINUTES // slot_minutes
+    slot_hours = slot_minutes / 60
+    n = len(sessions)
+    power = np.zeros((n, n_slots))
+    shortfall = np.zeros(n)
+    load = np.zeros(n_slots)
+    occupancy = np.zeros(n_slots, dtype=int)
+    grid_cap = np.inf if not grid_cap_kw else float(grid_cap_kw)
+
+    first = np.clip(np.ceil(sessions["Plug In (min)"].to_numpy(dtype=float) / slot_minutes), 0, n_slots).astype(int)
+    last = np.clip(np.floor(sessions["Ready By (min)"].to_numpy(dtype=float) / slot_minutes), 0, n_slots).astype(int)
+    energy = np.nan_to_num(sessions["Energy Needed (kWh)"].to_numpy(dtype=float))
+    # Least slack first: buses that need most of their window at full power
+    slack = (last - first) * slot_hours - energy / max(charger_kw, 1e-9)
+    fill = _water_fill if chargers >= n else _fill_lowest_slots
+    for i in np.argsort(slack, kind="stable"):
+        window = slice(first[i], max(first[i], last[i]))
+        free = occupancy[window] < chargers
+        cap = np.where(free, np.clip(np.minimum(charger_kw, grid_cap - load[window]), 0, None), 0.0)
+        slot_power, shortfall[i] = fill(load[window], cap, energy[i], slot_hours)
+        power[i, window] = slot_power
+        load[window] += slot_power
+        occupancy[window] += slot_power > 1e-6
+    return power, shortfall
+
+
+def unmanaged_peak_kw(sessions, charger_kw=DEFAULT_CHARGER_KW, slot_minutes=SLOT_MINUTES):
+    """Peak depot load if every bus charged at full power from plug-in (the baseline being improved on)."""
+    n_slots = HORIZON_MINUTES // slot_minutes
+    slot_hours = slot_minutes / 60
+    load = np.zeros(n_slots)
+    first = np.clip(np.ceil(sessions["Plug In (min)"].to_numpy(dtype=float) / slot_minutes), 0, n_slots).astype(int)
+    slots_needed = np.ceil(np.nan_to_num(sessions["Energy Needed (kWh)"].to_numpy(dtype=float)) / (charger_kw * slot_hours)).astype(int)
+    for start, k in zip(first, slots_needed):
+        load[start:start + k] += charger_kw
+    return float(load.max()) if n_slots else 0.0
+
+
+def plan_charging(sessions, depot_settings, slot_minutes=SLOT_MINUTES):
+    """
+    Schedules every depot.
+
+    Args:
+        sessions: charging_sessions() output.
+        depot_settings: DataFrame with Depot, Chargers, Charger kW and Grid Cap (kW) (0 = none).
+
+    Returns:
+        (depot summary DataFrame, per-bus schedule DataFrame, load profile DataFrame in kW
+        with one column per depot, a Time label column and a numeric Hour column (hours
+        after midnight of the service day, 24+ for the next morning) to plot against).
+    """
+    settings = depot_settings.set_index("Depot")
+    n_slots = HORIZON_MINUTES // slot_minutes
+    slot_hours = slot_minutes / 60
+    times = np.arange(n_slots) * slot_minutes
+    summary_rows, schedules, profile = [], [], {"Time": [format_clock(t) for t in times], "Hour": times / 60}
+    for depot, depot_sessions in sessions.groupby("Depot", sort=True):
+        chargers = int(settings.at[depot, "Chargers"]) if depot in settings.index else len(depot_sessions)
+        charger_kw = float(settings.at[depot, "Charger kW"]) if depot in settings.index else DEFAULT_CHARGER_KW
+        grid_cap = float(settings.at[depot, "Grid Cap (kW)"]) if depot in settings.index else 0.0
+        power, shortfall = schedule_depot(depot_sessions, chargers, charger_kw, grid_cap or None, slot_minutes)
+        load = power.sum(axis=0)
+        charging = power > 1e-6
+        any_charging = charging.any(axis=1)
+        start = np.where(any_charging, np.argmax(charging, axis=1) * slot_minutes, np.nan)
+        end = np.where(any_charging, (n_slots - np.argmax(charging[:, ::-1], axis=1)) * slot_minutes, np.nan)
+        schedules.append(pd.DataFrame({
+            "Route ID": depot_sessions["Route ID"].to_numpy(),
+            "Vehicle": depot_sessions["Vehicle"].to_numpy(),
+            "Depot": depot,
+            "Plug In": [format_clock(m) for m in depot_sessions["Plug In (min)"]],
+            "Ready By": [format_clock(m) for m in depot_sessions["Ready By (min)"]],
+            "Charge Start": [format_clock(m) for m in start],
+            "Charge End": [format_clock(m) for m in end],
+            "Energy Needed (kWh)": np.round(depot_sessions["Energy Needed (kWh)"].to_numpy(dtype=float), 1),
+            "Energy Delivered (kWh)": np.round(power.sum(axis=1) * slot_hours, 1),
+            "Shortfall (kWh)": np.round(shortfall, 1),
+            "Max Power (kW)": np.round(power.max(axis=1), 1) if n_slots else 0.0,
+        }))
+        summary_rows.append({
+            "Depot": depot, "Buses": len(depot_sessions), "Chargers": chargers, "Charger kW": charger_kw,
+            "Grid Cap (kW)": grid_cap or None,
+            "Energy (kWh)": round(float(load.sum() * slot_hours), 1),
+            "Managed Peak (kW)": round(float(load.max()), 1) if n_slots else 0.0,
+            "Unmanaged Peak (kW)": round(unmanaged_peak_kw(depot_sessions, charger_kw, slot_minutes), 1),
+            "Max Chargers in Use": int(charging.sum(axis=0).max()) if n_slots and len(depot_sessions) else 0,
+            "Buses Short": int((shortfall > 0.05).sum()),
+            "Shortfall (kWh)": round(float(shortfall.sum()), 1),
+        })
+        profile[depot] = np.round(load, 1)
+    schedule_df = pd.concat(schedules, ignore_index=True) if schedules else pd.DataFrame()
+    return pd.DataFrame(summary_rows), schedule_df, pd.DataFrame(profile)
+
+
+def default_depot_settings(sessions, charger_kw=DEFAULT_CHARGER_KW):
+    """One settings row per depot in sessions (or electric_depots()): a charger per bus, no grid cap."""
+    counts = sessions.groupby("Depot").size()
+    return pd.DataFrame({"Depot": counts.index, "Chargers": counts.to_numpy(), "Charger kW": charger_kw, "Grid Cap (kW)": 0.0})
@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# Helpers for running the blocking Google API calls from a worker pool.
+# Streamlit calls only work on the script thread, so workers record their
+# messages in a DeferredMessages object and the script thread replays them.
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available.
+
+    Args:
+        rate: Tokens added per second.
+        capacity: Burst size (defaults to rate).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1.0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """
+    One TokenBucket per host name, created on first use.
+
+    Args:
+        default_rate: Requests per second for hosts not listed in rates.
+        rates: Optional {host: requests_per_second} overrides.
+    """
+
+    def __init__(self, default_rate=10.0, rates=None):
+        self.default_rate = default_rate
+        self.rates = dict(rates or {})
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urlparse(url).netloc or url
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rates.get(host, self.default_rate))
+        bucket.acquire()
+
+
+class DeferredMessages:
+    """
+    Stand-in for the `st` module inside worker threads. Records warning/error/
+    info calls so they can be replayed in order on the script thread.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def warning(self, body, **kwargs): self.messages.append(("warning", body, kwargs))
+    def error(self, body, **kwargs): self.messages.append(("error", body, kwargs))
+    def info(self, body, **kwargs): self.messages.append(("info", body, kwargs))
+
+    def replay(self, st):
+        for level, body, kwargs in self.messages:
+            getattr(st, level)(body, **kwargs)
+        self.messages = []
+
+
+class LogMessages:
+    """Stand-in for the `st` module outside Streamlit: forwards messages to logging."""
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("ev_calc")
+
+    def warning(self, body, **kwargs): self.logger.warning(body)
+    def error(self, body, **kwargs): self.logger.error(body)
+    def info(self, body, **kwargs): self.logger.info(body)
+
+
+def run_ordered(func, items, max_workers=1, on_result=None):
+    """
+    Runs func(item) for every item and returns the results in input order.
+    With max_workers <= 1 this is a plain loop. on_result(index, result) is
+    called on the calling thread, in input order, as results become ready.
+    """
+    results = []
+    if max_workers <= 1:
+        for i, item in enumerate(items):
+            result = func(item)
+            results.append(result)
+            if on_result: on_result(i, result)
+        return results
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        for i, future in enumerate(futures):
+            result = future.result()
+            results.append(result)
+            if on_result: on_result(i, result)
+    return results
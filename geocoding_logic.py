@@ -0,0 +1,349 @@
+import datetime
+import random
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import requests
+
+from cache_logic import GEOCODE_NEGATIVE_TTL_SECONDS, make_cache_key
+from concurrency_logic import HostRateLimiter, LogMessages, run_ordered
+
+# Geocoding stage for the Tab 2 route CSV upload. Addresses are deduplicated
+# before any request goes out, looked up on a worker pool under a token-bucket
+# rate limit, and transient failures are retried with exponential backoff.
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+# Statuses worth retrying; everything else (ZERO_RESULTS, REQUEST_DENIED, ...) is final
+TRANSIENT_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+# Statuses remembered in the geocode cache as "this address does not resolve"
+NEGATIVE_CACHE_STATUSES = {"ZERO_RESULTS"}
+ROUTE_CSV_CHUNK_ROWS = 50000 # Rows read per chunk when streaming a route CSV
+RECENT_ADDRESS_MEMO_SIZE = 20000 # Geocode results kept in memory across chunks
+
+
+def normalize_address(address):
+    """Dedupe/cache key for an address: trimmed, single-spaced, case-folded."""
+    if address is None: return ""
+    return re.sub(r"\s+", " ", str(address)).strip().casefold()
+
+
+def geocode_address(address, api_key, rate_limiter=None, max_retries=3, backoff_seconds=0.5, timeout=10):
+    """
+    Geocodes one address with the Google Geocoding API.
+
+    Returns a dict with:
+        coords: (lat, lng) or None
+        status: API status string ("OK", "ZERO_RESULTS", ...) or None on network/processing errors
+        error: None, "Network Error" or "Processing Error"
+        message: Error text for network/processing errors
+    """
+    params = {"address": address, "key": api_key}
+    attempt = 0
+    while True:
+        try:
+            if rate_limiter is not None: rate_limiter.acquire(GEOCODE_URL)
+            response = requests.get(GEOCODE_URL, params=params, timeout=timeout)
+            if response.status_code >= 500 or response.status_code == 429:
+                # Server side / throttling: retry like a transient status
+                raise requests.exceptions.HTTPError(f"{response.status_code} Server Error", response=response)
+            response.raise_for_status()
+            data = response.json()
+            status = data.get("status", "Unknown Error")
+            if status == "OK" and data.get("results"):
+                location = data["results"][0]["geometry"]["location"]
+                return {"coords": (location["lat"], location["lng"]), "status": "OK", "error": None, "message": None}
+            if status in TRANSIENT_STATUSES and attempt < max_retries:
+                attempt += 1; _sleep_backoff(attempt, backoff_seconds); continue
+            return {"coords": None, "status": status, "error": None, "message": None}
+        except requests.exceptions.RequestException as req_err:
+            retryable = not isinstance(req_err, requests.exceptions.HTTPError) or (
+                req_err.response is not None and (req_err.response.status_code >= 500 or req_err.response.status_code == 429))
+            if retryable and attempt < max_retries:
+                attempt += 1; _sleep_backoff(attempt, backoff_seconds); continue
+            return {"coords": None, "status": None, "error": "Network Error", "message": str(req_err)}
+        except Exception as geocode_error:
+            return {"coords": None, "status": None, "error": "Processing Error", "message": str(geocode_error)}
+
+
+def _sleep_backoff(attempt, backoff_seconds):
+    # Exponential backoff with a little jitter so workers don't retry in lockstep
+    time.sleep(backoff_seconds * (2 ** (attempt - 1)) * (1 + random.random() * 0.25))
+
+
+def geocode_cache_key(normalized_address):
+    return make_cache_key("geocode", normalized_address)
+
+
+def geocode_addresses(addresses, api_key, max_workers=8, rate_per_second=40, max_retries=3, on_progress=None,
+                      cache=None, negative_ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS, ui=None):
+    """
+    Geocodes a list of addresses, issuing one request per unique normalized address.
+    With a cache (cache_logic.ResponseCache) only addresses not already cached go
+    out; OK answers use the cache TTL and ZERO_RESULTS use negative_ttl_seconds.
+
+    Args:
+        addresses: Iterable of raw address strings (duplicates welcome).
+        api_key: Google Maps API key.
+        max_workers: Concurrent requests in flight.
+        rate_per_second: Token-bucket ceiling for the Geocoding host.
+        max_retries: Retries per address for transient failures.
+        on_progress: Optional callback(done, total) on the calling thread.
+        cache: Optional persistent geocode cache shared across sessions.
+        negative_ttl_seconds: How long a ZERO_RESULTS answer is trusted.
+        ui: st / DeferredMessages-like sink for cache warnings, or None to log.
+
+    Returns:
+        Dict mapping normalize_address(address) -> result dict from geocode_address.
+    """
+    ui = ui or LogMessages()
+    unique = {}
+    for address in addresses:
+        key = normalize_address(address)
+        if key and key not in unique: unique[key] = address # Send the first spelling we saw
+
+    results = {}
+    if cache is not None:
+        try:
+            for key in unique:
+                cached = cache.get(geocode_cache_key(key))
+                if cached is not None:
+                    if cached.get("coords") is not None: cached["coords"] = tuple(cached["coords"])
+                    results[key] = cached
+        except Exception as cache_err:
+            # An unreadable cache file is treated as a miss; whatever wasn't read is fetched live
+            ui.warning(f"Could not read geocode cache: {cache_err}")
+
+    rate_limiter = HostRateLimiter(default_rate=rate_per_second)
+    keys = [key for key in unique if key not in results]
+    total = len(keys)
+
+    def lookup(key):
+        return geocode_address(unique[key], api_key, rate_limiter=rate_limiter, max_retries=max_retries)
+
+    def progress(i, _result):
+        if on_progress: on_progress(i + 1, total)
+
+    fetched = run_ordered(lookup, keys, max_workers=max_workers, on_result=progress)
+    for key, result in zip(keys, fetched):
+        results[key] = result
+        if cache is None: continue
+        # Network/processing errors and transient statuses are never cached
+        try:
+            if result["status"] == "OK":
+                cache.set(geocode_cache_key(key), result)
+            elif result["status"] in NEGATIVE_CACHE_STATUSES:
+                cache.set(geocode_cache_key(key), result, ttl_seconds=negative_ttl_seconds)
+        except Exception as cache_err:
+            # A locked or full cache file shouldn't abort the upload; stop writing for this batch
+            ui.warning(f"Could not write geocode cache: {cache_err}")
+            cache = None
+    return results
+
+
+def _clean_text(series):
+    # str(value).strip() for present values, None for missing ones
+    return series.astype(str).str.strip().where(series.notna(), None)
+
+
+def extract_route_rows(df_upload, ui):
+    """
+    Validates and standardizes the rows of a route CSV (sorted by Route and
+    Sequence Number). Invalid rows are reported through ui.warning and skipped.
+    Returns a list of dicts with route_id, location_type, address, time_str, sequence.
+    """
+    if df_upload.empty: return []
+    # Standardize data extraction column-wise; only invalid rows are visited one by one
+    route_ids = _clean_text(df_upload['Route'])
+    location_types = _clean_text(df_upload['Location Type']).str.capitalize()
+    addresses = _clean_text(df_upload['Address'])
+    time_strs = df_upload['Time'] if 'Time' in df_upload.columns else pd.Series([None] * len(df_upload), index=df_upload.index, dtype=object) # Optional column
+    sequences = pd.to_numeric(df_upload['Sequence Number'], errors='coerce') # Handle non-numeric sequence
+
+    # Input validation
+    missing = (route_ids.isna() | route_ids.eq("") | location_types.isna() | location_types.eq("")
+               | addresses.isna() | addresses.eq("") | sequences.isna()).to_numpy()
+    bad_type = ~missing & ~location_types.isin(["Depot", "Pickup", "Dropoff"]).to_numpy()
+    for pos in np.flatnonzero(missing | bad_type): # Warnings keep file order
+        if missing[pos]:
+            ui.warning(f"Skipping row with missing Route ID, Type, Address, or invalid Sequence: {df_upload.iloc[pos].to_dict()}")
+        else:
+            ui.warning(f"Skipping row with invalid Location Type '{location_types.iloc[pos]}' for Route {route_ids.iloc[pos]}. Use 'Depot', 'Pickup', or 'Dropoff'.")
+
+    keep = ~(missing | bad_type)
+    return [{"route_id": route_id, "location_type": location_type, "address": address, "time_str": time_str, "sequence": int(sequence)}
+            for route_id, location_type, address, time_str, sequence in zip(
+                route_ids[keep], location_types[keep], addresses[keep], time_strs[keep], sequences[keep])]
+
+
+ROUTE_CSV_TEXT_COLS = ['Route', 'Location Type', 'Address', 'Time'] # Read as str, so "101" never becomes 101.0
+
+
+def _rewind(source):
+    # File-like sources are read more than once (header, contiguity check, rows)
+    if hasattr(source, "seek"): source.seek(0)
+
+
+def _text_dtypes(source):
+    # dtype mapping for the text columns under their raw (possibly padded) header names
+    header = pd.read_csv(source, nrows=0)
+    _rewind(source)
+    return {col: str for col in header.columns if col.strip() in ROUTE_CSV_TEXT_COLS}
+
+
+def routes_are_contiguous(source, chunksize=ROUTE_CSV_CHUNK_ROWS):
+    """
+    Reads only the Route column of a route CSV and returns True if each route's rows
+    form one contiguous block (blank Route cells are ignored).
+    """
+    finished, current = set(), None
+    for chunk in pd.read_csv(source, chunksize=chunksize, dtype=str, usecols=lambda c: c.strip() == "Route"):
+        route_ids = chunk.iloc[:, 0].dropna().str.strip()
+        route_ids = route_ids[route_ids != ""]
+        for route_id in route_ids[route_ids.ne(route_ids.shift())]: # First row of each run
+            if route_id == current: continue
+            if route_id in finished: return False
+            if current is not None: finished.add(current)
+            current = route_id
+    return True
+
+
+def iter_route_batches(source, api_key, ui=None, chunksize=ROUTE_CSV_CHUNK_ROWS, cache=None, max_workers=8,
+                       rate_per_second=40, negative_ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS, on_chunk=None):
+    """
+    Streams a route CSV in chunks of rows and yields (routes, geocoding_failures)
+    as soon as a group of routes is complete and geocoded, so memory stays bounded
+    and the first routes are available long before the file is finished.
+
+    A route is complete once a row for a different route follows it, which holds
+    when each route's rows are contiguous (any order within a route). A quick pass
+    over the Route column checks this first; files in any other order (e.g. all
+    depots, then all pickups) are buffered whole in memory and yielded as one batch
+    at the end, so only contiguous files get the bounded-memory streaming.
+
+    Routes come out in the order they first appear in the file, with each route's
+    rows ordered by Sequence Number.
+
+    Args:
+        source: Path or seekable file-like object.
+        api_key: Google Maps API key.
+        ui: st / DeferredMessages-like sink, or None to log.
+        chunksize: Rows read per chunk.
+        cache: Optional persistent geocode cache (cache_logic.ResponseCache).
+        max_workers, rate_per_second, negative_ttl_seconds: As for geocode_addresses.
+        on_chunk: Optional callback(rows_read) after each chunk.
+    """
+    ui = ui or LogMessages()
+    pending = []
+    recent = OrderedDict() # Small in-memory memo so shared depots/schools are geocoded once even without a cache
+    rows_read = 0
+    _rewind(source)
+    dtypes = _text_dtypes(source)
+    streaming = routes_are_contiguous(source, chunksize)
+    _rewind(source)
+
+    def finish(rows):
+        # Routes in first-seen order (not string order on Route), rows by Sequence Number, then geocode and assemble
+        first_seen = {}
+        for r in rows: first_seen.setdefault(r["route_id"], len(first_seen))
+        rows = sorted(rows, key=lambda r: (first_seen[r["route_id"]], r["sequence"]))
+        keys = {normalize_address(r["address"]) for r in rows}
+        geocoded = {k: recent[k] for k in keys if k in recent}
+        todo = [r["address"] for r in rows if normalize_address(r["address"]) not in geocoded]
+        geocoded.update(geocode_addresses(todo, api_key, max_workers=max_workers, rate_per_second=rate_per_second,
+                                          cache=cache, negative_ttl_seconds=negative_ttl_seconds, ui=ui))
+        for k, result in geocoded.items():
+            if result["coords"] is None: continue # Failures (e.g. a transient network error) are retried for later routes
+            recent[k] = result; recent.move_to_end(k)
+        while len(recent) > RECENT_ADDRESS_MEMO_SIZE: recent.popitem(last=False)
+        route_dict, failures = build_route_dict(rows, geocoded, ui)
+        routes = []
+        for data in route_dict.values():
+            data["pickups"] = sorted(data["pickups"], key=lambda x: x['sequence'])
+            data["dropoffs"] = sorted(data["dropoffs"], key=lambda x: x['sequence'])
+            routes.append(data)
+        return routes, failures
+
+    for chunk in pd.read_csv(source, chunksize=chunksize, dtype=dtypes):
+        chunk.columns = [col.strip() for col in chunk.columns]
+        rows_read += len(chunk)
+        rows = pending + extract_route_rows(chunk, ui)
+        if rows and streaming:
+            open_route = rows[-1]["route_id"] # May continue in the next chunk
+            complete = [r for r in rows if r["route_id"] != open_route]
+            pending = [r for r in rows if r["route_id"] == open_route]
+            if complete: yield finish(complete)
+        else:
+            pending = rows # Out-of-order file: every route stays open until the end
+        if on_chunk: on_chunk(rows_read)
+    if pending:
+        yield finish(pending)
+
+
+def build_route_dict(rows, geocoded, ui, route_dict=None, geocoding_failures=None):
+    """
+    Assembles the session route structure from validated rows and geocode results
+    (as returned by geocode_addresses). Rows are applied in order, exactly as the
+    original one-request-per-row loop did. Returns (route_dict, geocoding_failures).
+    """
+    if route_dict is None: route_dict = {}
+    if geocoding_failures is None: geocoding_failures = []
+    for row in rows:
+        route_id, location_type, address = row["route_id"], row["location_type"], row["address"]
+        time_str, sequence = row["time_str"], row["sequence"]
+        result = geocoded.get(normalize_address(address))
+        if result is None:
+            ui.error(f"Unexpected error geocoding '{address}': no result")
+            geocoding_failures.append(f"Route {route_id}: {address} (Processing Error)")
+            continue
+        if result["error"] == "Network Error":
+            ui.error(f"Network error geocoding '{address}': {result['message']}")
+            geocoding_failures.append(f"Route {route_id}: {address} (Network Error)")
+            continue
+        if result["error"]:
+            ui.error(f"Unexpected error geocoding '{address}': {result['message']}")
+            geocoding_failures.append(f"Route {route_id}: {address} (Processing Error)")
+            continue
+        if result["coords"] is None:
+            # Handle geocoding API errors (ZERO_RESULTS, OVER_QUERY_LIMIT, etc.)
+            ui.warning(f"Geocoding failed for Route {route_id}, Address '{address}': {result['status'] or 'Unknown Error'}")
+            geocoding_failures.append(f"Route {route_id}: {address} ({result['status'] or 'Failed'})")
+            continue
+
+        coords = tuple(result["coords"])
+        # Initialize route if not exists
+        if route_id not in route_dict:
+            route_dict[route_id] = {
+                "route_id": route_id, "depot": None,
+                "pickups": [], # Store as list of dicts: {'location': coords, 'sequence': seq}
+                "dropoffs": [], # Store as list of dicts: {'location': coords, 'sequence': seq, 'bell_time': time}
+                "csv_source": True # Flag origin
+            }
+
+        # --- Time Parsing (only for the first dropoff encountered for this route) ---
+        parsed_time = None
+        is_first_dropoff = (location_type == "Dropoff" and not any(d.get('bell_time') for d in route_dict[route_id]["dropoffs"]))
+
+        if pd.notna(time_str) and isinstance(time_str, str) and time_str.strip() and is_first_dropoff:
+           time_str_cleaned = time_str.strip()
+           try:
+               parsed_time = datetime.datetime.strptime(time_str_cleaned, "%H:%M").time()
+           except ValueError:
+                ui.warning(f"Route {route_id}: Invalid time format for address '{address}': '{time_str}'. Expected HH:MM. Bell time ignored.")
+
+        # --- Assign to Route Structure ---
+        if location_type == "Depot":
+            if route_dict[route_id]["depot"] is None:
+                route_dict[route_id]["depot"] = coords
+            else:
+                 ui.warning(f"Route {route_id}: Multiple Depot locations found. Using first at sequence {sequence}.")
+        elif location_type == "Pickup":
+            route_dict[route_id]["pickups"].append({"location": coords, "sequence": sequence})
+        elif location_type == "Dropoff":
+             route_dict[route_id]["dropoffs"].append({
+                "location": coords, "sequence": sequence,
+                "bell_time": parsed_time if is_first_dropoff else None # Store time only if it's the first dropoff
+                })
+    return route_dict, geocoding_failures
@@ -3,11 +3,13 @@ import streamlit as st
 import folium
 from streamlit_folium import st_folium # Ensure this is imported
 
-# Assume zipcodes_df and zip_lookup are loaded globally before this function is called
-# and passed as arguments.
-# zip_lookup format: {'zip_string': {'latitude': lat, 'longitude': lon}}
+from map_logic import MapRenderCache, route_stops_key
+from spatial_logic import label_route_stops
 
-def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
+# Assume zip_index (spatial_logic.ZipIndex) and zip_areas (spatial_logic.ZipAreaIndex) are loaded globally before this function is called
+# and passed as an argument.
+
+def handle_map_route_input(st, folium, st_folium, zip_index, zip_areas=None, dac_overlay=None):
     """
     Handles interactive route definition using a Folium map within Streamlit.
     Allows adding/selecting routes, adding stops via map click, setting bell times,
@@ -18,8 +20,9 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
         st: The Streamlit module.
         folium: The Folium module.
         st_folium: The streamlit_folium component function.
-        zipcodes_df: DataFrame related to zipcodes (used minimally now).
-        zip_lookup: Dictionary mapping 5-digit zip string to {'latitude': lat, 'longitude': lon}.
+        zip_index: spatial_logic.ZipIndex of ZIP centroids (ZIP jump and nearest-ZIP stop labels), or None.
+        zip_areas: spatial_logic.ZipAreaIndex of MODZCTA polygons for stop labels, or None.
+        dac_overlay: map_logic.DacOverlay for the optional DAC areas layer, or None.
     """
     import datetime # Ensure datetime is available inside the function
 
@@ -28,6 +31,7 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
     if "selected_route_index" not in st.session_state: st.session_state.selected_route_index = 0
     if "last_processed_click" not in st.session_state: st.session_state.last_processed_click = None # To prevent double processing
     if "center_on_next_run" not in st.session_state: st.session_state.center_on_next_run = None # Stores [lat, lon] for ZIP jump
+    if "map_render_cache" not in st.session_state: st.session_state.map_render_cache = MapRenderCache() # Built folium maps (map_logic)
 
     # --- UI Elements ---
 
@@ -117,14 +121,10 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
                 try:
                     zip_code_str = zip_input_value.zfill(5)
                     # st.write(f"DEBUG [Button]: Padded ZIP: '{zip_code_str}'") # DEBUG
-                    # st.write(f"DEBUG [Button]: Checking if '{zip_code_str}' in zip_lookup keys...") # DEBUG
-                    if not isinstance(zip_lookup, dict) or not zip_lookup:
-                         st.error("DEBUG [Button]: zip_lookup is invalid or empty!")
-                    elif zip_code_str in zip_lookup:
-                        # st.write(f"DEBUG [Button]: ZIP Found in lookup!") # DEBUG
-                        zip_data = zip_lookup[zip_code_str]
-                        lat = zip_data.get('latitude')
-                        lon = zip_data.get('longitude')
+                    if zip_index is None or len(zip_index) == 0:
+                         st.error("ZIP code data is not loaded.")
+                    elif zip_code_str in zip_index:
+                        lat, lon = zip_index.lookup(zip_code_str) # Binary search over the sorted ZIP array
                         if lat is not None and lon is not None:
                             # st.write(f"DEBUG [Button]: Setting center_on_next_run to: {[lat, lon]}") # DEBUG
                             st.session_state.center_on_next_run = [lat, lon]
@@ -132,7 +132,9 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
                             # st.write("DEBUG [Button]: Triggering rerun...") # DEBUG
                             st.rerun() # Rerun to apply centering
                         else: st.warning(f"Coords not found for ZIP {zip_code_str}.")
-                    else: st.warning(f"ZIP {zip_code_str} not found.")
+                    else:
+                        similar = zip_index.with_prefix(zip_code_str[:3], limit=8)
+                        st.warning(f"ZIP {zip_code_str} not found." + (f" Nearby ZIPs: {', '.join(similar)}" if similar else ""))
                 except Exception as e: st.warning(f"Error processing ZIP: {e}")
             else: st.warning("Please enter a ZIP code.")
     # --- End Map Controls ---
@@ -164,20 +166,31 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
 
         # st.write(f"DEBUG: Base Map Center Reason: {centering_reason}, Center: {center}, Zoom: {zoom_start}")
 
-        # Create the map using the determined default/stop-based center
-        m = folium.Map(location=center, zoom_start=zoom_start, tiles="cartodbpositron", control_scale=True)
-
-        # --- Add Markers ---
-        marker_group = folium.FeatureGroup(name=f"Stops for Route {current_route['route_id']}")
-        def create_map_marker(loc, tip, icon, color): # Simplified helper
-            if not (isinstance(loc, (list, tuple)) and len(loc)==2): return None
-            try: return folium.Marker(location=loc, tooltip=tip, icon=folium.Icon(color=color, icon=icon, prefix='fa'))
-            except Exception: return None
-        # Add markers safely
-        if current_route.get("depot"): marker_group.add_child(create_map_marker(current_route["depot"], "Depot", "bus", "red"))
-        for i, p_data in enumerate(current_route.get("pickups",[])): marker_group.add_child(create_map_marker(p_data.get("location"), f"Pickup {i+1}", "user-plus", "blue"))
-        for i, d_data in enumerate(current_route.get("dropoffs",[])): marker_group.add_child(create_map_marker(d_data.get("location"), f"Dropoff {i+1}", "school", "green"))
-        m.add_child(marker_group)
+        # Optional DAC layer, precomputed once per process (map_logic.DacOverlay)
+        show_dac = st.checkbox("Show DAC areas", key="map_input_show_dac", disabled=dac_overlay is None,
+                               help="Disadvantaged Community tracts used for 'Percent in DAC'.") and dac_overlay is not None
+
+        # Built maps are cached per session by stop locations and view, so reruns from
+        # bell-time inputs and other widgets reuse the map instead of rebuilding it
+        def build_editor_map():
+            m = folium.Map(location=center, zoom_start=zoom_start, tiles="cartodbpositron", control_scale=True)
+            if show_dac: dac_overlay.add_to(m, zoom_start)
+
+            # --- Add Markers ---
+            marker_group = folium.FeatureGroup(name=f"Stops for Route {current_route['route_id']}")
+            def create_map_marker(loc, tip, icon, color): # Simplified helper
+                if not (isinstance(loc, (list, tuple)) and len(loc)==2): return None
+                try: return folium.Marker(location=loc, tooltip=tip, icon=folium.Icon(color=color, icon=icon, prefix='fa'))
+                except Exception: return None
+            # Add markers safely
+            if current_route.get("depot"): marker_group.add_child(create_map_marker(current_route["depot"], "Depot", "bus", "red"))
+            for i, p_data in enumerate(current_route.get("pickups",[])): marker_group.add_child(create_map_marker(p_data.get("location"), f"Pickup {i+1}", "user-plus", "blue"))
+            for i, d_data in enumerate(current_route.get("dropoffs",[])): marker_group.add_child(create_map_marker(d_data.get("location"), f"Dropoff {i+1}", "school", "green"))
+            m.add_child(marker_group)
+            return m
+
+        m = st.session_state.map_render_cache.get_or_build(
+            ("editor", route_stops_key(current_route), tuple(center), zoom_start, show_dac), build_editor_map)
 
         # --- Prepare Overrides for st_folium based on ZIP Jump State ---
         # Check the temporary state variable JUST BEFORE calling st_folium
@@ -235,6 +248,15 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
                     st.rerun()
 
     # --- Display Stops List & Actions Below Map (Remains Outside Container) ---
+    # ZIP of every stop on this route: MODZCTA area containing it, else the closest ZIP centroid
+    depot_zip, *stop_zips = label_route_stops([current_route], zip_areas, zip_index)[0]
+    pickup_zips = stop_zips[:len(current_route.get("pickups", []))]
+    dropoff_zips = stop_zips[len(pickup_zips):]
+
+    def stop_label(loc, zip_code):
+        # Coordinates plus the stop's ZIP, e.g. "(40.81, -73.91) · ZIP 10455"
+        return f"{loc} · ZIP {zip_code}" if zip_code else f"{loc}"
+
     st.markdown("---")
     st.subheader(f"Stops for Route: {current_route['route_id']}")
 
@@ -242,7 +264,7 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
     st.markdown("**Depot:**")
     if current_route.get("depot"):
         depot_cols = st.columns([4, 1])
-        depot_cols[0].write(f"📍 {current_route['depot']}")
+        depot_cols[0].write(f"📍 {stop_label(current_route['depot'], depot_zip)}")
         if depot_cols[1].button("Remove Depot", key=f"remove_depot_{current_index}", type="secondary"):
             current_route["depot"] = None; st.session_state.last_processed_click = None; st.session_state.center_on_next_run = None; st.rerun()
     else: st.caption("No depot added yet.")
@@ -254,7 +276,7 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
         for i, pt_data in enumerate(pickups_list):
             pickup_loc = pt_data.get("location")
             pickup_cols = st.columns([4, 1])
-            pickup_cols[0].write(f" P{i+1}: {pickup_loc}")
+            pickup_cols[0].write(f" P{i+1}: {stop_label(pickup_loc, pickup_zips[i])}")
             if pickup_cols[1].button(f"Remove P{i+1}", key=f"remove_pickup_{current_index}_{i}", type="secondary"):
                 current_route["pickups"].pop(i); st.session_state.last_processed_click = None; st.session_state.center_on_next_run = None; st.rerun()
     else: st.caption("No pickups added yet.")
@@ -266,7 +288,7 @@ def handle_map_route_input(st, folium, st_folium, zipcodes_df, zip_lookup):
         for i, pt_data in enumerate(dropoffs_list):
             dropoff_loc = pt_data.get("location")
             dropoff_cols = st.columns([4, 1])
-            dropoff_cols[0].write(f" D{i+1}: {dropoff_loc}")
+            dropoff_cols[0].write(f" D{i+1}: {stop_label(dropoff_loc, dropoff_zips[i])}")
             if dropoff_cols[1].button(f"Remove D{i+1}", key=f"remove_dropoff_{current_index}_{i}", type="secondary"):
                 current_route["dropoffs"].pop(i); st.session_state.last_processed_click = None; st.session_state.center_on_next_run = None; st.rerun()
     else: st.caption("No dropoffs added yet.")
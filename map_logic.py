@@ -0,0 +1,321 @@
+import math
+from collections import OrderedDict
+
+import folium
+import numpy as np
+import shapely
+
+from cache_logic import make_cache_key
+from concurrency_logic import DeferredMessages
+
+# Tab 4 "all routes" overview map. Everything heavy happens here, server-side,
+# so the browser only receives what is visible at the current zoom: route lines
+# are Douglas-Peucker simplified to about a pixel (spatial_logic.GeometryCache
+# memoizes each zoom's result), only lines and stops near the current view are
+# sent, stops are binned into screen-space clusters, and all routes go out as
+# one GeoJSON layer coloured by EV Eligibility.
+
+ELIGIBILITY_COLORS = {
+    "Preferred - All Weather": "#1a9850",
+    "OK in All Weather": "#66bd63",
+    "OK > 50°F Weather": "#fdae61",
+    "OK > 70°F Weather": "#f46d43",
+    "NOT FEASIBLE (No Bus)": "#d73027",
+}
+UNKNOWN_ELIGIBILITY_COLOR = "#808080"
+STOP_KIND_COLORS = {"Depot": "red", "Pickup": "blue", "Dropoff": "green"} # Same as the single-route markers
+
+SIMPLIFY_PIXELS = 1.5 # Douglas-Peucker tolerance in screen pixels at the current zoom
+CLUSTER_CELL_PIXELS = 48 # Stops closer than this on screen share one cluster marker
+MIN_ZOOM, MAX_ZOOM = 3, 18
+MAP_WIDTH_PIXELS, MAP_HEIGHT_PIXELS = 800, 500 # Nominal map size used to fit the plan
+VIEW_MARGIN = 0.5 # Send lines/stops up to half a screen beyond each edge, so short pans need no reload
+COORD_DECIMALS = 5 # ~1 m; keeps the GeoJSON small
+DEFAULT_CENTER = [40.7128, -74.0060]
+MAP_RENDER_CACHE_SIZE = 16 # Built maps kept per session
+
+
+def meters_per_pixel(zoom, latitude):
+    """Web Mercator ground resolution at a zoom level and latitude."""
+    return 156543.03392 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+
+def simplify_tolerance(zoom, latitude):
+    """Douglas-Peucker tolerance (degrees) worth SIMPLIFY_PIXELS at this zoom, snapped to whole zoom levels."""
+    zoom = int(round(zoom))
+    return round(SIMPLIFY_PIXELS * meters_per_pixel(zoom, latitude) / 111320.0, 8)
+
+
+def clamp_zoom(zoom):
+    """Whole zoom level within MIN_ZOOM..MAX_ZOOM, the range the overview map allows."""
+    return int(min(max(round(zoom), MIN_ZOOM), MAX_ZOOM))
+
+
+def fit_zoom(lats, lons, width_px=MAP_WIDTH_PIXELS, height_px=MAP_HEIGHT_PIXELS):
+    """Largest zoom at which all points fit in a width_px x height_px map."""
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    if len(lats) == 0: return 11
+    x, y = _mercator_pixels(lats, lons, 0)
+    span_x, span_y = max(x.max() - x.min(), 1e-9), max(y.max() - y.min(), 1e-9)
+    zoom = math.floor(min(math.log2(width_px / span_x), math.log2(height_px / span_y)))
+    return clamp_zoom(zoom)
+
+
+def view_bounds(center, zoom, width_px=MAP_WIDTH_PIXELS, height_px=MAP_HEIGHT_PIXELS, margin=VIEW_MARGIN):
+    """(south, west, north, east) of the map view at center/zoom, padded by margin view sizes per side."""
+    x, y = _mercator_pixels(np.array([center[0]]), np.array([center[1]]), zoom)
+    half_w, half_h = width_px * (0.5 + margin), height_px * (0.5 + margin)
+    scale = 256 * 2 ** zoom
+    west, east = (x[0] - half_w) / scale * 360.0 - 180.0, (x[0] + half_w) / scale * 360.0 - 180.0
+    def latitude_of(pixel_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * pixel_y / scale))))
+    return latitude_of(y[0] + half_h), float(west), latitude_of(y[0] - half_h), float(east)
+
+
+def _mercator_pixels(lats, lons, zoom):
+    # Web Mercator world pixel coordinates (256 px tiles)
+    scale = 256 * 2 ** zoom
+    lat_rad = np.radians(np.clip(lats, -85.0511, 85.0511))
+    x = (np.asarray(lons) + 180.0) / 360.0 * scale
+    y = (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2 * scale
+    return x, y
+
+
+def cluster_points(lats, lons, zoom, cell_pixels=CLUSTER_CELL_PIXELS):
+    """
+    Grid clustering in screen space: points in the same cell_pixels square at this zoom
+    become one cluster. Returns (centroid lats, centroid lons, counts).
+    """
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    if len(lats) == 0: return lats, lons, np.zeros(0, dtype=int)
+    x, y = _mercator_pixels(lats, lons, int(round(zoom)))
+    cells = np.stack([np.floor(x / cell_pixels), np.floor(y / cell_pixels)], axis=1)
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.ravel()
+    return np.bincount(cluster, lats) / counts, np.bincount(cluster, lons) / counts, counts
+
+
+def plan_stops(routes):
+    """(kind, lat, lng) arrays for every depot/pickup/dropoff of the routes (invalid entries skipped)."""
+    kinds, points = [], []
+    for route in routes:
+        stops = [("Depot", route.get("depot"))] + [("Pickup", p.get("location")) for p in route.get("pickups", [])] + [("Dropoff", d.get("location")) for d in route.get("dropoffs", [])]
+        for kind, loc in stops:
+            if isinstance(loc, (list, tuple)) and len(loc) == 2:
+                kinds.append(kind); points.append(loc)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    return np.array(kinds, dtype=object), points[:, 0], points[:, 1]
+
+
+def _in_view(bounds, rows, geometry_cache):
+    # Rows whose line bounding box overlaps bounds (south, west, north, east)
+    lines = []
+    for _, _, encoded in rows:
+        try: geometry = geometry_cache.get(encoded)
+        except (ValueError, IndexError): geometry = None
+        lines.append(geometry.line if geometry is not None else None)
+    if not lines: return rows
+    west, south, east, north = shapely.bounds(np.array(lines, dtype=object)).T # NaN for missing lines
+    keep = (west <= bounds[3]) & (east >= bounds[1]) & (south <= bounds[2]) & (north >= bounds[0])
+    return [row for row, k in zip(rows, keep) if k]
+
+
+def overview_features(plan_df, results, geometry_cache, zoom, latitude, trip_type="AM Trip", bounds=None):
+    """
+    GeoJSON features (one per route trip) with the simplified line and its Route ID,
+    EV Eligibility, Trip and colour, limited to lines overlapping bounds if given.
+    Returns (features, total vertices sent).
+    """
+    eligibility = dict(zip(plan_df["Route ID"], plan_df["EV Eligibility"])) if "EV Eligibility" in plan_df.columns else {}
+    keys = [("AM", "AM Overview Polyline")] * (trip_type in ("AM Trip", "Round Trip")) + [("PM", "PM Overview Polyline")] * (trip_type in ("PM Trip", "Round Trip"))
+    rows = [(r.get("Route ID"), trip, r.get(key)) for r in results if r.get("Route ID") in eligibility for trip, key in keys if r.get(key)]
+    if bounds is not None: rows = _in_view(bounds, rows, geometry_cache)
+    simplified = geometry_cache.simplified([encoded for _, _, encoded in rows], simplify_tolerance(zoom, latitude))
+    features, vertices = [], 0
+    for (route_id, trip, _), coords in zip(rows, simplified):
+        if coords is None or len(coords) < 2: continue
+        label = eligibility.get(route_id, "N/A")
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "LineString", "coordinates": np.round(coords[:, ::-1], COORD_DECIMALS).tolist()},
+            "properties": {"Route ID": str(route_id), "Trip": trip, "EV Eligibility": label,
+                           "color": ELIGIBILITY_COLORS.get(label, UNKNOWN_ELIGIBILITY_COLOR)},
+        })
+        vertices += len(coords)
+    return features, vertices
+
+
+def build_overview_map(plan_df, routes, results, geometry_cache, trip_type="AM Trip", center=None, zoom=None, dac_overlay=None):
+    """
+    folium.Map of every route in plan_df. center/zoom are the current view (e.g. from
+    st_folium's last output); when omitted the map is fitted to all stops.
+    Only lines and stops in (or near) that view are sent to the browser.
+    dac_overlay (a DacOverlay) adds the DAC polygons at the matching detail level.
+    Returns (map, stats dict with center, routes, lines, vertices, stops, clusters, zoom).
+    """
+    plan_ids = set(plan_df["Route ID"])
+    plan_routes = [r for r in routes if r.get("route_id") in plan_ids]
+    kinds, lats, lons = plan_stops(plan_routes)
+    if zoom is None:
+        zoom = fit_zoom(lats, lons)
+    if center is None:
+        center = [float((lats.min() + lats.max()) / 2), float((lons.min() + lons.max()) / 2)] if len(lats) else DEFAULT_CENTER
+    zoom = clamp_zoom(zoom)
+
+    # Leaflet gets the same zoom limits, so the view it reports back is one this map can be built for
+    m = folium.Map(location=center, zoom_start=zoom, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, tiles="cartodbpositron", control_scale=True, prefer_canvas=True)
+    if dac_overlay is not None: dac_overlay.add_to(m, zoom)
+    bounds = view_bounds(center, zoom)
+    features, vertices = overview_features(plan_df, results, geometry_cache, zoom, center[0], trip_type, bounds)
+    if features:
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features}, name="Routes",
+            style_function=lambda feature: {"color": feature["properties"]["color"], "weight": 3, "opacity": 0.75},
+            tooltip=folium.GeoJsonTooltip(fields=["Route ID", "Trip", "EV Eligibility"]),
+        ).add_to(m)
+
+    n_clusters = 0
+    visible = (lats >= bounds[0]) & (lats <= bounds[2]) & (lons >= bounds[1]) & (lons <= bounds[3])
+    for kind, color in STOP_KIND_COLORS.items():
+        mask = (kinds == kind) & visible
+        c_lats, c_lons, counts = cluster_points(lats[mask], lons[mask], zoom)
+        n_clusters += len(counts)
+        for lat, lon, count in zip(c_lats, c_lons, counts):
+            folium.CircleMarker(
+                location=[round(float(lat), COORD_DECIMALS), round(float(lon), COORD_DECIMALS)],
+                radius=4 + 3 * math.log2(count), color=color, weight=1, fill=True, fill_opacity=0.6,
+                tooltip=f"{count} {kind.lower()}{'s' if count > 1 else ''}",
+            ).add_to(m)
+    stats = {"center": list(center), "routes": len(plan_routes), "lines": len(features), "vertices": vertices, "stops": len(lats), "clusters": n_clusters, "zoom": zoom}
+    return m, stats
+
+
+def view_needs_rebuild(built_center, built_zoom, center, zoom):
+    """True once the user has zoomed, or panned the view center out of the area sent at build time."""
+    if int(round(zoom)) != int(built_zoom): return True
+    south, west, north, east = view_bounds(built_center, built_zoom, margin=0)
+    return not (south <= center[0] <= north and west <= center[1] <= east)
+
+
+# --- Per-session cache of built folium maps ---
+
+class MapRenderCache:
+    """
+    Small LRU of built folium.Map objects, keyed by what the map shows (see
+    route_stops_key), so reruns triggered by unrelated widgets (bell times, radios,
+    other tabs) reuse the map instead of rebuilding every marker and line.
+    One instance per session: maps hold session data and folium objects aren't shared.
+    Warnings a builder raised are kept with its map and shown again on every hit.
+    """
+
+    def __init__(self, max_entries=MAP_RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._maps)
+
+    def get_or_build(self, key, build, ui=None):
+        """
+        The cached result of build() for key, calling build() only on a miss.
+        With ui (e.g. st), build is called as build(messages) with a DeferredMessages
+        for its warnings; they are stored with the result and replayed to ui on every call.
+        """
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            self.hits += 1
+            value, messages = self._maps[key]
+        else:
+            self.misses += 1
+            messages = DeferredMessages() if ui is not None else None
+            value = build(messages) if ui is not None else build()
+            self._maps[key] = (value, messages)
+            while len(self._maps) > self.max_entries:
+                self._maps.popitem(last=False)
+        if ui is not None and messages is not None:
+            for level, body, kwargs in messages.messages: getattr(ui, level)(body, **kwargs) # Kept for the next hit, unlike replay()
+        return value
+
+    def clear(self):
+        self._maps.clear()
+
+
+def _rounded_point(point):
+    # Rounded (lat, lng) like the routing cache keys, or None for missing/invalid entries
+    if isinstance(point, (list, tuple)) and len(point) == 2:
+        try: return [round(float(point[0]), 6), round(float(point[1]), 6)]
+        except (TypeError, ValueError): return None
+    return None
+
+
+def route_stops_key(route):
+    """Key of what a route contributes to a map: its ID and stop locations, in order (not bell times)."""
+    return make_cache_key(
+        "map-stops", route.get("route_id"), _rounded_point(route.get("depot")),
+        [_rounded_point(p.get("location")) for p in route.get("pickups", [])],
+        [_rounded_point(d.get("location")) for d in route.get("dropoffs", [])],
+    )
+
+
+# --- DAC polygon overlay ---
+# The DAC tracts behind "Percent in DAC" drawn as one translucent layer. The
+# tracts are dissolved and simplified once per process, for a few fixed zoom
+# levels, straight into GeoJSON strings; adding the layer to a map is then a
+# dictionary lookup, with no geometry work on any rerun.
+
+DAC_OVERLAY_ZOOMS = (9, 11, 13, 15) # Precomputed detail levels; a map uses the finest one at or below its zoom
+DAC_OVERLAY_STYLE = {"color": "#6a3d9a", "weight": 0.5, "fillColor": "#6a3d9a", "fillOpacity": 0.2}
+
+
+class DacOverlay:
+    """
+    Pre-simplified DAC polygons as GeoJSON FeatureCollection strings, one per zoom
+    level in DAC_OVERLAY_ZOOMS. Read-only once built, so one instance is shared by
+    every session.
+
+    Args:
+        geojson_by_zoom: {zoom level: GeoJSON string}.
+        vertices_by_zoom: {zoom level: vertex count of that level}.
+    """
+
+    def __init__(self, geojson_by_zoom, vertices_by_zoom):
+        self.geojson_by_zoom = dict(geojson_by_zoom)
+        self.vertices_by_zoom = dict(vertices_by_zoom)
+        self.zooms = sorted(self.geojson_by_zoom)
+
+    def level(self, zoom):
+        """The precomputed level used at zoom: the finest one not above it (the coarsest if zoom is below all)."""
+        below = [z for z in self.zooms if z <= zoom]
+        return below[-1] if below else self.zooms[0]
+
+    def add_to(self, m, zoom):
+        """Adds the DAC layer for zoom to folium map m (add it before route lines so they draw on top)."""
+        folium.GeoJson(
+            self.geojson_by_zoom[self.level(zoom)], name="Disadvantaged Communities",
+            style_function=lambda _: DAC_OVERLAY_STYLE, tooltip="Disadvantaged Community (DAC)",
+        ).add_to(m)
+        return m
+
+
+def build_dac_overlay(geometries, zooms=DAC_OVERLAY_ZOOMS):
+    """
+    Builds a DacOverlay from the DAC (Multi)Polygons (lng/lat, e.g. dac_locs_gdf.geometry.values):
+    adjacent tracts are dissolved, then simplified to about SIMPLIFY_PIXELS at each zoom and
+    snapped to COORD_DECIMALS. Returns None if there are no polygons.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    geometries = geometries[~shapely.is_missing(geometries)] if len(geometries) else geometries
+    if len(geometries) == 0: return None
+    dissolved = shapely.union_all(geometries)
+    west, south, east, north = shapely.bounds(dissolved)
+    latitude = (south + north) / 2
+    geojson_by_zoom, vertices_by_zoom = {}, {}
+    for zoom in zooms:
+        simplified = shapely.simplify(dissolved, simplify_tolerance(zoom, latitude), preserve_topology=True)
+        simplified = shapely.set_precision(simplified, 10 ** -COORD_DECIMALS)
+        geojson_by_zoom[zoom] = ('{"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": '
+                                 + shapely.to_geojson(simplified) + '}]}')
+        vertices_by_zoom[zoom] = int(shapely.get_num_coordinates(simplified))
+    return DacOverlay(geojson_by_zoom, vertices_by_zoom)
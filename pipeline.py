@@ -0,0 +1,494 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+
+import pandas as pd
+from shapely.errors import GEOSException
+
+from cache_logic import (DIRECTIONS_CACHE_MAX_ENTRIES, DIRECTIONS_CACHE_PATH, DIRECTIONS_CACHE_TTL_SECONDS, GEOCODE_CACHE_MAX_ENTRIES,
+                         GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL_SECONDS, GEOCODE_NEGATIVE_TTL_SECONDS, ResponseCache, make_cache_key)
+from concurrency_logic import DeferredMessages, HostRateLimiter, LogMessages, run_ordered
+from geocoding_logic import ROUTE_CSV_CHUNK_ROWS, iter_route_batches
+from plan_logic import PLAN_COLUMNS, build_plan, process_fleet_data
+from routing_logic import GoogleDirectionsProvider, LocalGraphProvider
+from sequence_logic import pm_waypoint_stops
+from spatial_logic import SPATIAL_STORE_DIR, DACIndex, GeometryCache, load_dac_geometries, store_is_fresh
+
+# The feasibility pipeline without Streamlit: fleet CSV -> EV ranges, route CSV ->
+# geocoded routes -> AM/PM distances + DAC overlap -> plan rows. app.py uses the
+# same functions with ui=st; the CLI below runs them headless for batch jobs:
+#
+#   python pipeline.py --fleet fleet.csv --routes routes.csv --out plan.parquet
+
+DAC_FILE_PATH = os.path.join(".data", "dac_file.csv")
+ROAD_GRAPH_PATH = os.path.join(".data", "road_graph.npz") # Optional offline routing graph (routing_logic.RoadGraph)
+DEFAULT_CHUNK_SIZE = 500 # Routes evaluated and written per batch
+DEFAULT_WORKERS = 8
+GOOGLE_API_RATE_PER_SECOND = 40 # Per-host request ceiling across all workers
+FLEET_REQUIRED_COLS = ['Name', 'Powertrain', 'Type', 'Quantity']
+ROUTE_REQUIRED_COLS = ['Route', 'Location Type', 'Address', 'Sequence Number']
+
+logger = logging.getLogger("ev_calc")
+
+
+# --- Route calculations (shared with app.py Tab 3) ---
+
+def calculate_dac_overlap(overview_polyline, dac_index, ui=None, geometry_cache=None):
+    # dac_index is a spatial_logic.DACIndex, built once per process
+    # geometry_cache: optional spatial_logic.GeometryCache so the decoded line is kept for the map
+    ui = ui or LogMessages()
+
+    if not overview_polyline or not isinstance(overview_polyline, str): return 0.0
+    if dac_index is None or len(dac_index) == 0: return 0.0
+
+    try:
+        geometry = (geometry_cache if geometry_cache is not None else GeometryCache()).get(overview_polyline)
+        if geometry is None or geometry.line is None: return 0.0
+        route_line = geometry.line
+        if not route_line.is_valid or route_line.is_empty: return 0.0
+
+        # Only the DAC polygons whose bounding boxes the route touches are tested
+        try:
+            total_intersection_length = dac_index.intersection_length(
+                route_line, on_error=lambda error: ui.warning(f"Error during intersection: {error}."))
+        except GEOSException as intersection_error:
+            ui.warning(f"Error during intersection: {intersection_error}.")
+            total_intersection_length = 0.0
+
+        route_total_length = route_line.length
+        if route_total_length > 0:
+             overlap_percentage = (total_intersection_length / route_total_length) * 100
+             return max(0.0, min(overlap_percentage, 100.0))
+        else: return 0.0
+    except (ImportError, NameError) as import_error: ui.error(f"Missing lib for DAC calc: {import_error}"); return 0.0
+    except ValueError as decode_error: ui.warning(f"Error decoding polyline: {decode_error}"); return 0.0
+    except Exception as e: ui.warning(f"Unexpected error calculating DAC overlap: {e}"); return 0.0
+
+
+def calculate_route_feasibility(route, index, provider, dac_index, ui=None, geometry_cache=None):
+    """
+    Calculates AM/PM distances, durations, departure time and DAC overlap for one route,
+    using provider (a routing_logic.RoutingProvider: Google Directions or the local graph).
+    Safe to call from a worker thread when ui is a DeferredMessages; ui=None logs.
+    geometry_cache (spatial_logic.GeometryCache) keeps the decoded AM line for later use.
+    Returns (feasibility_result or None if the route was skipped, api_error_flag).
+    """
+    ui = ui or LogMessages()
+    route_id = route.get("route_id", f"Route_{index+1}")
+    api_errors_encountered = False
+
+    if not route.get("depot"): ui.warning(f"Route {route_id}: Skip - Missing Depot."); return None, False
+    if not route.get("dropoffs"): ui.warning(f"Route {route_id}: Skip - Missing Dropoffs."); return None, False
+
+    # Initialize feasibility dict for this route
+    feasibility_result = {
+       "Route ID": route_id, "AM Distance (miles)": None, "AM Duration (min)": None, "AM Overview Polyline": None,
+       "PM Distance (miles)": None, "PM Duration (min)": None, "PM Overview Polyline": None,
+       "Percent in DAC": 0.0, "Suggested Depot Departure Time": None,
+       "First School Bell Time": None, "Drive Time to First School (min)": None, "Leg Details": [], "PM Leg Details": []
+    }
+
+    try:
+        # --- AM Route Calculation ---
+        am_origin = route["depot"]
+        if not route["dropoffs"] or not route["dropoffs"][0].get("location"): ui.warning(f"Route {route_id}: Skip - Invalid first dropoff."); return None, False
+        am_destination = route["dropoffs"][0]["location"]
+        am_waypoints_data = route.get("pickups", []) + route.get("dropoffs", [])[1:]
+        am_waypoints = [wp.get("location") for wp in am_waypoints_data if wp.get("location")]
+        first_bell_time = route["dropoffs"][0].get("bell_time") # Already parsed datetime.time or None
+
+        am_distance, am_duration, am_leg_details, am_polyline = provider.route(am_origin, am_waypoints, am_destination, first_bell_time, ui=ui)
+
+        if am_distance is not None and am_duration is not None:
+            feasibility_result["AM Distance (miles)"] = round(am_distance, 2)
+            feasibility_result["AM Duration (min)"] = round(am_duration, 1)
+            feasibility_result["AM Overview Polyline"] = am_polyline
+            feasibility_result["Leg Details"] = am_leg_details # Store leg details
+            feasibility_result["Drive Time to First School (min)"] = round(am_duration, 1)
+            if first_bell_time:
+                feasibility_result["First School Bell Time"] = first_bell_time.strftime("%I:%M %p")
+                try:
+                    arrival_dt = datetime.datetime.combine(datetime.date.today(), first_bell_time)
+                    buffer_minutes = 15
+                    departure_dt = arrival_dt - datetime.timedelta(minutes=am_duration + buffer_minutes)
+                    feasibility_result["Suggested Depot Departure Time"] = departure_dt.time().strftime("%I:%M %p")
+                except Exception as e: ui.warning(f"Route {route_id}: Error calculating departure time: {e}")
+            if am_polyline and dac_index is not None: feasibility_result["Percent in DAC"] = round(calculate_dac_overlap(am_polyline, dac_index, ui=ui, geometry_cache=geometry_cache), 2)
+        else:
+            ui.warning(f"Route {route_id}: Failed AM route details calculation (check API key/quota?).")
+            api_errors_encountered = True
+
+        # --- PM Route Calculation ---
+        if not route["dropoffs"] or not route["dropoffs"][-1].get("location"): ui.warning(f"Route {route_id}: Skip PM - Invalid last dropoff.");
+        else:
+             pm_origin = route["dropoffs"][-1]["location"]
+             pm_destination = route["depot"]
+             pm_waypoints_data_sorted = pm_waypoint_stops(route) # Optimized order if set in Tab 3, else reverse sequence
+             pm_waypoints = [wp.get("location") for wp in pm_waypoints_data_sorted if wp.get("location")]
+             pm_distance, pm_duration, pm_leg_details, pm_polyline = provider.route(pm_origin, pm_waypoints, pm_destination, None, ui=ui) # No time needed for PM estimate
+
+             if pm_distance is not None and pm_duration is not None:
+                feasibility_result["PM Distance (miles)"] = round(pm_distance, 2)
+                feasibility_result["PM Duration (min)"] = round(pm_duration, 1)
+                feasibility_result["PM Overview Polyline"] = pm_polyline
+                feasibility_result["PM Leg Details"] = pm_leg_details # Per-leg input for the SoC simulation
+             else:
+                ui.warning(f"Route {route_id}: Failed PM route details calculation (check API key/quota?).")
+                api_errors_encountered = True
+
+    except Exception as route_calc_error:
+         ui.error(f"Route {route_id}: Unexpected error during calculation: {route_calc_error}")
+         ui.error(traceback.format_exc()) # Log detailed error
+
+    return feasibility_result, api_errors_encountered
+
+
+def route_trip_stops(route):
+    """
+    The stops of a route's AM and PM trips in the order calculate_route_feasibility
+    drives them (the PM trip follows pm_pickup_order when set); [] without a depot or dropoffs.
+    """
+    dropoffs = route.get("dropoffs", [])
+    if not route.get("depot") or not dropoffs: return []
+    am_trip = [route["depot"]] + [wp for wp in route.get("pickups", []) + dropoffs[1:] if wp.get("location")] + [dropoffs[0]]
+    pm_trip = [dropoffs[-1]] + [wp for wp in pm_waypoint_stops(route) if wp.get("location")] + [route["depot"]]
+    return [am_trip, pm_trip]
+
+
+# --- Incremental recomputation (dirty tracking per route) ---
+
+def _point_repr(point):
+    # Rounded location (as in the routing cache keys), or None for missing/invalid entries
+    if isinstance(point, dict): point = point.get("location")
+    if isinstance(point, (list, tuple)) and len(point) == 2:
+        try: return [round(float(point[0]), 6), round(float(point[1]), 6)]
+        except (TypeError, ValueError): return None
+    return None
+
+
+def route_content_hash(route):
+    """
+    Hash of everything calculate_route_feasibility reads from a route: depot, pickups and
+    dropoffs (location, sequence, in order), bell times and the optimized PM order.
+    """
+    return make_cache_key(
+        "route", route.get("route_id"), _point_repr(route.get("depot")),
+        [[_point_repr(p), p.get("sequence")] for p in route.get("pickups", [])],
+        [[_point_repr(d), d.get("sequence"), d.get("bell_time")] for d in route.get("dropoffs", [])],
+        route.get("pm_pickup_order"),
+    )
+
+
+def changed_routes(routes):
+    """
+    (index, route) pairs that are new or edited since they were last calculated, i.e. whose
+    stored route["content_hash"] (set by mark_routes_calculated) no longer matches.
+    """
+    return [(i, route) for i, route in enumerate(routes) if route.get("content_hash") != route_content_hash(route)]
+
+
+def mark_routes_calculated(routes):
+    """Stamps each route with its current content hash after its results were (re)computed."""
+    for route in routes:
+        route["content_hash"] = route_content_hash(route)
+
+
+def duplicate_route_ids(routes):
+    """Route IDs used by more than one route. Results are matched to routes by ID, so these must be renamed first."""
+    counts = Counter(route.get("route_id", f"Route_{i+1}") for i, route in enumerate(routes))
+    return sorted((str(route_id) for route_id, n in counts.items() if n > 1))
+
+
+def merge_results(routes, results, new_results, recomputed_ids=()):
+    """
+    Results in route order: freshly computed ones replace old ones with the same Route ID,
+    and results for routes that no longer exist are dropped. Old results of every route in
+    recomputed_ids are dropped too, so a route that was recalculated but produced no result
+    (skipped or failed) doesn't keep its stale distances. Route IDs must be unique
+    (see duplicate_route_ids).
+    """
+    recomputed = set(recomputed_ids)
+    by_id = {r.get("Route ID"): r for r in results if r.get("Route ID") not in recomputed}
+    by_id.update({r.get("Route ID"): r for r in new_results})
+    merged = []
+    for i, route in enumerate(routes):
+        result = by_id.pop(route.get("route_id", f"Route_{i+1}"), None)
+        if result is not None: merged.append(result)
+    return merged
+
+
+# --- Fleet input (shared with app.py Tab 1) ---
+
+def validate_fleet_df(df_upload):
+    """
+    Cleans a copy of an uploaded fleet DataFrame and checks Powertrain, Type,
+    Quantity and EV battery values. Assumes FLEET_REQUIRED_COLS exist.
+    Returns (cleaned DataFrame, list of error strings).
+    """
+    df_upload = df_upload.copy()
+    errors = []
+    try:
+        df_upload['Name'] = df_upload['Name'].astype(str).str.strip()
+        df_upload['Powertrain'] = df_upload['Powertrain'].astype(str).str.strip().str.upper()
+        df_upload['Type'] = df_upload['Type'].astype(str).str.strip().str.upper()
+
+        # Validate 'Powertrain' values
+        invalid_powertrains = df_upload[~df_upload['Powertrain'].isin(['EV', 'GAS'])] # Allow GAS or EV
+        if not invalid_powertrains.empty:
+            errors.append(f"Invalid Powertrain values found: {invalid_powertrains['Powertrain'].unique().tolist()}. Use 'EV' or 'Gas'.")
+
+        # Validate 'Type' values
+        invalid_types = df_upload[~df_upload['Type'].isin(['A', 'C'])]
+        if not invalid_types.empty:
+            errors.append(f"Invalid Type values found: {invalid_types['Type'].unique().tolist()}. Use 'A' or 'C'.")
+
+        # Validate and convert 'Quantity'
+        df_upload['Quantity'] = pd.to_numeric(df_upload['Quantity'], errors='coerce') # Convert, turn errors into NaN
+        invalid_quantities = df_upload[df_upload['Quantity'].isna() | (df_upload['Quantity'] <= 0)]
+        if not invalid_quantities.empty:
+             errors.append("Found rows with missing, invalid, or zero Quantity.")
+        # Fill NaN with 0 after check, then convert to int - assumes 0 is acceptable if not invalid
+        df_upload['Quantity'] = df_upload['Quantity'].fillna(0).astype(int)
+
+        # Validate and convert 'Battery Capacity (kWh)'
+        if 'Battery Capacity (kWh)' not in df_upload.columns:
+             df_upload['Battery Capacity (kWh)'] = None # Add column as None if missing entirely
+             errors.append("Column 'Battery Capacity (kWh)' was missing; added but check EV entries.")
+        else:
+             # Convert to numeric, coercing errors. Keep as float for potential decimals.
+             df_upload['Battery Capacity (kWh)'] = pd.to_numeric(df_upload['Battery Capacity (kWh)'], errors='coerce')
+
+        # Ensure non-EVs have None or NaN battery capacity before checking EVs
+        df_upload.loc[df_upload['Powertrain'] != 'EV', 'Battery Capacity (kWh)'] = None
+
+        # Check if EVs have missing or invalid battery info AFTER setting non-EVs to None
+        missing_battery_evs = df_upload[(df_upload['Powertrain'] == 'EV') & (df_upload['Battery Capacity (kWh)'].isna() | (df_upload['Battery Capacity (kWh)'] <= 0))]
+        if not missing_battery_evs.empty:
+             errors.append("Found EV buses with missing or invalid (>0) 'Battery Capacity (kWh)'.")
+    except Exception as validation_error:
+        # Catch errors during the validation/conversion process itself
+        errors.append(f"An unexpected error occurred during data validation: {validation_error}")
+    return df_upload, errors
+
+
+def load_fleet(fleet_csv):
+    """Reads and validates a fleet CSV; returns the processed EV fleet. Raises ValueError on invalid data."""
+    df_upload = pd.read_csv(fleet_csv)
+    df_upload.columns = [col.strip() for col in df_upload.columns]
+    missing_cols = [col for col in FLEET_REQUIRED_COLS if col not in df_upload.columns]
+    if missing_cols:
+        raise ValueError(f"Fleet CSV is missing required columns: {', '.join(missing_cols)}")
+    fleet_df, errors = validate_fleet_df(df_upload)
+    if errors:
+        raise ValueError("Errors found in fleet CSV: " + "; ".join(errors))
+    fleet_df = fleet_df[fleet_df['Name'].ne('')]
+    if fleet_df.empty:
+        raise ValueError("No valid fleet data rows found (check for empty names).")
+    return process_fleet_data(fleet_df)
+
+
+# --- Batch evaluation ---
+
+def evaluate_routes(routes, provider, dac_index, max_workers=DEFAULT_WORKERS, on_result=None):
+    """
+    Runs calculate_route_feasibility over routes on a worker pool, in route order.
+    Worker messages are logged from the calling thread. on_result(i, result, api_error)
+    is called in order as routes finish. Returns the list of results (skipped routes omitted).
+    """
+    log = LogMessages()
+
+    def worker(indexed_route):
+        i, route = indexed_route
+        messages = DeferredMessages()
+        result, api_error = calculate_route_feasibility(route, i, provider, dac_index, ui=messages)
+        return result, api_error, messages
+
+    results = []
+    def on_done(i, outcome):
+        result, api_error, messages = outcome
+        messages.replay(log)
+        if result is not None: results.append(result)
+        if on_result: on_result(i, result, api_error)
+
+    run_ordered(worker, list(enumerate(routes)), max_workers=max_workers, on_result=on_done)
+    return results
+
+
+class PlanWriter:
+    """
+    Appends plan chunks to a CSV or Parquet file as they are produced, so memory
+    stays flat however many routes are evaluated. Parquet needs pyarrow.
+
+    Args:
+        path: Output file; the format follows the extension (.parquet / .csv).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = "parquet" if path.lower().endswith((".parquet", ".pq")) else "csv"
+        self.rows_written = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, plan_df):
+        if plan_df is None or plan_df.empty: return
+        plan_df = plan_df[[c for c in PLAN_COLUMNS if c in plan_df.columns]]
+        if self.format == "csv":
+            plan_df.to_csv(self.path, mode="w" if self.rows_written == 0 else "a", header=self.rows_written == 0, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._schema is None:
+                # Text columns are pinned to string so all-None chunks keep the same schema
+                self._schema = pa.schema([(c, pa.float64() if pd.api.types.is_float_dtype(plan_df[c]) else pa.string()) for c in plan_df.columns])
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            plan_df = plan_df.astype({f.name: object for f in self._schema if f.type == pa.string()})
+            self._writer.write_table(pa.Table.from_pandas(plan_df, schema=self._schema, preserve_index=False))
+        self.rows_written += len(plan_df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        elif self.rows_written == 0 and self.format == "csv":
+            pd.DataFrame(columns=PLAN_COLUMNS).to_csv(self.path, index=False) # Header-only file for empty runs
+
+
+def iter_chunks(routes, chunk_size, route_batches=None):
+    """
+    Yields lists of at most chunk_size routes, from a route list or from an
+    iterable of route batches (e.g. geocoding_logic.iter_route_batches).
+    """
+    buffer = []
+    for batch in ([routes] if route_batches is None else route_batches):
+        buffer.extend(batch)
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size]; buffer = buffer[chunk_size:]
+    if buffer: yield buffer
+
+
+def run_pipeline(ev_fleet, routes, provider, dac_index, out_path, route_bus_types=None, default_bus_type="A",
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_workers=DEFAULT_WORKERS, log_every=100, route_batches=None):
+    """
+    Evaluates routes chunk by chunk and streams the plan to out_path.
+    Each chunk's plan is sorted by eligibility within the chunk (the app sorts the whole plan).
+
+    Args:
+        ev_fleet: Processed EV fleet (load_fleet / process_fleet_data).
+        routes: Route dicts (the app's session routes), or None with route_batches.
+        provider: routing_logic.RoutingProvider.
+        dac_index: spatial_logic.DACIndex or None.
+        out_path: .csv or .parquet output.
+        route_bus_types: Optional {route_id: "A" | "C"}; missing routes use default_bus_type.
+        chunk_size: Routes per evaluated/written batch.
+        max_workers: Concurrent route calculations.
+        log_every: Progress log interval in routes.
+        route_batches: Optional iterable of route lists consumed as they arrive (streamed ingestion).
+
+    Returns:
+        Summary dict (routes, evaluated, plan_rows, api_errors, seconds).
+    """
+    route_bus_types = route_bus_types or {}
+    writer = PlanWriter(out_path)
+    started = time.monotonic()
+    total = len(routes) if route_batches is None else None # Unknown until a stream is exhausted
+    seen, evaluated, api_errors = 0, 0, 0
+    try:
+        for chunk in iter_chunks(routes, chunk_size, route_batches):
+            seen += len(chunk)
+
+            def on_result(i, result, api_error):
+                nonlocal evaluated, api_errors
+                evaluated += 1
+                if api_error: api_errors += 1
+                if evaluated % log_every == 0 or evaluated == total:
+                    elapsed = time.monotonic() - started
+                    done = f"{evaluated}/{total} ({evaluated / total:.0%})" if total else f"{evaluated}"
+                    logger.info(f"Routes {done}, {evaluated / max(elapsed, 1e-9):.1f} routes/s, {api_errors} with routing errors")
+
+            results = evaluate_routes(chunk, provider, dac_index, max_workers=max_workers, on_result=on_result)
+            bus_types = {r.get("Route ID"): route_bus_types.get(r.get("Route ID"), default_bus_type) for r in results}
+            writer.write(build_plan(results, bus_types, ev_fleet, default_type=default_bus_type))
+    finally:
+        writer.close()
+    return {"routes": seen, "evaluated": evaluated, "plan_rows": writer.rows_written, "api_errors": api_errors,
+            "seconds": round(time.monotonic() - started, 1)}
+
+
+def load_dac_index(dac_csv=DAC_FILE_PATH):
+    """DACIndex over the DAC-designated polygons (via the spatial_logic binary store), or None if none are valid."""
+    _, geometries = load_dac_geometries(dac_csv)
+    return DACIndex(geometries) if len(geometries) else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless EV route feasibility: fleet CSV + route CSV -> plan CSV/Parquet.")
+    parser.add_argument("--fleet", required=True, help="Fleet CSV (Name, Powertrain, Type, Quantity, Battery Capacity (kWh)).")
+    parser.add_argument("--routes", required=True, help="Route CSV (Route, Location Type, Address, Sequence Number, optional Time).")
+    parser.add_argument("--out", required=True, help="Output plan file (.csv or .parquet).")
+    parser.add_argument("--bus-types", help="Optional CSV with Route and Bus Type (A/C) columns.")
+    parser.add_argument("--default-bus-type", default="A", choices=["A", "C"])
+    parser.add_argument("--engine", default="google", choices=["google", "local"], help="Routing engine (local needs --road-graph).")
+    parser.add_argument("--road-graph", default=ROAD_GRAPH_PATH)
+    parser.add_argument("--dac-file", default=DAC_FILE_PATH)
+    parser.add_argument("--api-key", default=os.environ.get("GOOGLE_MAPS_API_KEY"), help="Defaults to $GOOGLE_MAPS_API_KEY.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Routes evaluated and written per batch.")
+    parser.add_argument("--csv-chunk-rows", type=int, default=ROUTE_CSV_CHUNK_ROWS, help="Route CSV rows read per chunk.")
+    parser.add_argument("--no-cache", action="store_true", help="Skip the on-disk geocode/directions caches.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if not args.api_key:
+        parser.error("A Google Maps API key is required for geocoding (--api-key or $GOOGLE_MAPS_API_KEY).")
+    try:
+        ev_fleet = load_fleet(args.fleet)
+        logger.info(f"Fleet: {len(ev_fleet)} EV bus type(s)")
+
+        header = pd.read_csv(args.routes, nrows=0)
+        missing_cols = [col for col in ROUTE_REQUIRED_COLS if col not in [c.strip() for c in header.columns]]
+        if missing_cols:
+            raise ValueError(f"Route CSV is missing required columns: {', '.join(missing_cols)}")
+        geocode_cache = None if args.no_cache else ResponseCache(GEOCODE_CACHE_PATH, ttl_seconds=GEOCODE_CACHE_TTL_SECONDS, max_entries=GEOCODE_CACHE_MAX_ENTRIES)
+        geocoding_failures = []
+        def streamed_routes():
+            # Routes are geocoded chunk by chunk and evaluated as soon as they are complete
+            for batch, failures in iter_route_batches(args.routes, args.api_key, cache=geocode_cache, max_workers=args.workers,
+                                                      chunksize=args.csv_chunk_rows, negative_ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS,
+                                                      on_chunk=lambda rows: logger.info(f"Read {rows:,} route CSV rows")):
+                for failure in failures: logger.warning(f"Geocoding failed: {failure}")
+                geocoding_failures.extend(failures)
+                yield batch
+
+        route_bus_types = {}
+        if args.bus_types:
+            types_df = pd.read_csv(args.bus_types, dtype=str)
+            route_bus_types = dict(zip(types_df["Route"].str.strip(), types_df["Bus Type"].str.strip().str.upper()))
+
+        if args.engine == "local":
+            provider = LocalGraphProvider(args.road_graph)
+        else:
+            directions_cache = None if args.no_cache else ResponseCache(DIRECTIONS_CACHE_PATH, ttl_seconds=DIRECTIONS_CACHE_TTL_SECONDS, max_entries=DIRECTIONS_CACHE_MAX_ENTRIES)
+            provider = GoogleDirectionsProvider(args.api_key, cache=directions_cache,
+                                                rate_limiter=HostRateLimiter(default_rate=GOOGLE_API_RATE_PER_SECOND))
+        dac_available = os.path.exists(args.dac_file) or store_is_fresh(os.path.join(SPATIAL_STORE_DIR, "dac"), args.dac_file)
+        dac_index = load_dac_index(args.dac_file) if dac_available else None
+        if dac_index is None: logger.warning("No DAC data loaded; Percent in DAC will be 0.")
+
+        summary = run_pipeline(ev_fleet, None, provider, dac_index, args.out, route_bus_types=route_bus_types,
+                               default_bus_type=args.default_bus_type, chunk_size=args.chunk_size, max_workers=args.workers,
+                               route_batches=streamed_routes())
+    except (OSError, ValueError) as e:
+        logger.error(str(e))
+        return 1
+    logger.info(f"Done: {summary['routes']} routes, {summary['plan_rows']} plan rows written to {args.out} in {summary['seconds']}s "
+                f"({summary['api_errors']} route(s) with routing errors, {len(geocoding_failures)} stop(s) not geocoded)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
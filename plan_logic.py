@@ -0,0 +1,300 @@
+import bisect
+
+import numpy as np
+import pandas as pd
+
+# Fleet range and electrification plan calculations. Pure pandas/NumPy,
+# no Streamlit, so Tab 1/Tab 3 and any batch tooling share one implementation.
+
+RANGE_COLS = ["Cold Weather Range", "Average Weather Range", "Warm Weather Range"]
+USABLE_BATTERY_FRACTION = 0.8 # Only 80% of nameplate capacity is planned for
+
+# kWh consumed per mile, by bus type and weather band (same order as RANGE_COLS)
+EFFICIENCY_KWH_PER_MILE = pd.DataFrame(
+    {
+        "Cold Weather Range": {"A": 2.0, "C": 2.5},
+        "Average Weather Range": {"A": 1.5, "C": 1.8},
+        "Warm Weather Range": {"A": 1.0, "C": 1.5},
+    }
+)
+
+
+def round_half_even_exact(values, ndigits=1):
+    """
+    Rounds an array exactly like Python's round(). np.round scales by 10**ndigits
+    first, which can land on the other side of a tie, so near-tie elements
+    fall back to round() and everything else stays vectorized.
+    """
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, ndigits)
+    scaled = values * (10 ** ndigits)
+    near_tie = np.isfinite(values) & np.isclose(np.abs(scaled - np.trunc(scaled)), 0.5, rtol=0, atol=1e-6)
+    if near_tie.any():
+        rounded[near_tie] = [round(v, ndigits) for v in values[near_tie]]
+    return rounded
+
+
+def process_fleet_data(fleet_df, efficiency_table=EFFICIENCY_KWH_PER_MILE):
+    """
+    Filters the fleet to EVs and adds Cold/Average/Warm weather ranges (miles).
+    Range = usable kWh / (kWh per mile) for the bus Type, computed column-wise.
+    Unknown types or missing battery capacity give NaN ranges.
+    """
+    ev_fleet = fleet_df[fleet_df["Powertrain"] == "EV"].copy()
+
+    kwh = pd.to_numeric(ev_fleet["Battery Capacity (kWh)"], errors="coerce").to_numpy(dtype=float)
+    # Per-row kWh/mile divisors; types not in the table become NaN
+    divisors = efficiency_table.reindex(ev_fleet["Type"].to_numpy())[RANGE_COLS].to_numpy(dtype=float)
+    usable = (kwh * USABLE_BATTERY_FRACTION)[:, None]
+    ranges = round_half_even_exact(usable / divisors, 1)
+    for j, col in enumerate(RANGE_COLS):
+        ev_fleet[col] = ranges[:, j]
+
+    required_cols = ["Name", "Type", "Quantity", "Battery Capacity (kWh)"] + RANGE_COLS
+    existing_cols = [col for col in required_cols if col in ev_fleet.columns]
+    return ev_fleet[existing_cols]
+
+
+# --- Electrification plan ("Show Me the Plan!") ---
+# Plan column for each weather band, in RANGE_COLS order
+ELIGIBLE_COLS = {
+    "Cold Weather Range": "Eligible Buses < 50°F",
+    "Average Weather Range": "Eligible Buses 50–70°F",
+    "Warm Weather Range": "Eligible Buses 70°F+",
+}
+ELIGIBILITY_ORDER = {"Preferred - All Weather": 0, "OK in All Weather": 1, "OK > 50°F Weather": 2, "OK > 70°F Weather": 3, "NOT FEASIBLE (No Bus)": 4}
+DAC_PREFERENCE_PERCENT = 70 # Routes more than this % inside DACs are preferred for electrification
+PLAN_COLUMNS = [
+    'Route ID', 'Bus Type', 'EV Eligibility', 'Suggested Departure Time', '% in Disadvantaged Community', 'Round Trip (mi)',
+    'Eligible Buses < 50°F', 'Eligible Buses 50–70°F', 'Eligible Buses 70°F+']
+
+
+class RangeIndex:
+    """
+    Pre-sorted ranges for one bus type and weather band. The buses that can
+    cover a distance are always the top-k of the sorted ranges, so a whole
+    column of required distances resolves with one searchsorted call, and the
+    eligible-name string is built once per distinct k.
+
+    Args:
+        names: Bus names in fleet order (NaN names are never listed).
+        ranges: Ranges in fleet order (non-numeric treated as 0, like the old filter).
+    """
+
+    def __init__(self, names, ranges):
+        ranges = pd.to_numeric(pd.Series(ranges), errors='coerce').fillna(0).to_numpy(dtype=float)
+        self.order = np.argsort(ranges, kind="stable") # Ascending
+        self.sorted_ranges = ranges[self.order]
+        names = pd.Series(names, dtype=object)
+        self.codes, self.uniques = pd.factorize(names) # NaN names get code -1
+        self.n = len(ranges)
+
+    def eligible_counts(self, required):
+        """Number of buses with range >= required, for an array of required distances."""
+        required = np.asarray(required, dtype=float)
+        return self.n - np.searchsorted(self.sorted_ranges, required, side="left")
+
+    def names_for_counts(self, counts):
+        """Comma-joined eligible names (fleet order, unique) for each count; "None" when empty."""
+        labels = {}
+        mask = np.zeros(self.n, dtype=bool)
+        filled = 0
+        # Grow the eligible set from the longest ranges down, labelling each distinct count once
+        for k in np.unique(counts):
+            k = int(k)
+            if k > filled:
+                mask[self.order[self.n - k:self.n - filled]] = True
+                filled = k
+            codes = self.codes[mask]
+            codes = codes[codes >= 0]
+            if len(codes) == 0:
+                labels[k] = "None"
+                continue
+            _, first_pos = np.unique(codes, return_index=True)
+            ordered = codes[np.sort(first_pos)]
+            labels[k] = ", ".join(self.uniques[ordered])
+        return np.array([labels[int(k)] for k in counts], dtype=object)
+
+
+def classify_eligibility(plan_df):
+    """Vectorized EV Eligibility label from DAC share and the eligible-bus columns."""
+    in_dac = pd.to_numeric(plan_df["Percent in DAC"], errors='coerce')
+    dac_preference = (in_dac > DAC_PREFERENCE_PERCENT).to_numpy()
+
+    def has_bus(col):
+        values = plan_df[col].fillna("")
+        return (values.ne("") & ~values.isin(["None", "N/A"])).to_numpy()
+
+    cold_ok, mild_ok, warm_ok = (has_bus(ELIGIBLE_COLS[col]) for col in RANGE_COLS)
+    return np.select(
+        [dac_preference & cold_ok, cold_ok, mild_ok, warm_ok],
+        ["Preferred - All Weather", "OK in All Weather", "OK > 50°F Weather", "OK > 70°F Weather"],
+        default="NOT FEASIBLE (No Bus)",
+    )
+
+
+def build_plan(results, route_bus_types, ev_fleet, default_type="A"):
+    """
+    Builds the electrification plan for all routes in one vectorized pass.
+
+    Args:
+        results: st.session_state.results (list of per-route feasibility dicts).
+        route_bus_types: {route_id: "A" | "C"} selections from Tab 3 section B.
+        ev_fleet: Output of process_fleet_data.
+
+    Returns:
+        Plan DataFrame in PLAN_COLUMNS order sorted by eligibility, or None if no routes.
+    """
+    rows = [r for r in results if r.get("Route ID")]
+    if not rows:
+        return None
+
+    plan_df = pd.DataFrame({
+        "Route ID": [r.get("Route ID") for r in rows],
+        "Type Required": [route_bus_types.get(r.get("Route ID"), default_type) for r in rows],
+        "Round Trip (mi)": [(r.get("AM Distance (miles)", 0.0) or 0.0) + (r.get("PM Distance (miles)", 0.0) or 0.0) for r in rows],
+        "Percent in DAC": [r.get("Percent in DAC", 0.0) for r in rows],
+        "Suggested Departure Time": [r.get("Suggested Depot Departure Time", "N/A") for r in rows],
+    })
+    round_trip = plan_df["Round Trip (mi)"].to_numpy(dtype=float)
+
+    for range_col in RANGE_COLS:
+        out = np.full(len(plan_df), "None", dtype=object)
+        if range_col not in ev_fleet.columns:
+            out[:] = "N/A" # Column missing
+        else:
+            for bus_type, type_rows in plan_df.groupby("Type Required", sort=False).indices.items():
+                type_fleet = ev_fleet[ev_fleet["Type"] == bus_type]
+                index = RangeIndex(type_fleet["Name"].to_numpy(), type_fleet[range_col].to_numpy())
+                counts = index.eligible_counts(round_trip[type_rows])
+                out[type_rows] = index.names_for_counts(counts)
+        plan_df[ELIGIBLE_COLS[range_col]] = out
+
+    plan_df["Round Trip (mi)"] = round_half_even_exact(round_trip, 2)
+    plan_df["EV Eligibility"] = classify_eligibility(plan_df)
+    plan_df["Eligibility Rank"] = plan_df["EV Eligibility"].map(ELIGIBILITY_ORDER)
+    plan_df = plan_df.sort_values(by=["Eligibility Rank", "Route ID"]).drop(columns=["Eligibility Rank"])
+    plan_df = plan_df.rename(columns={'Type Required': 'Bus Type', 'Percent in DAC': '% in Disadvantaged Community'})
+    return plan_df[[col for col in PLAN_COLUMNS if col in plan_df.columns]]
+
+
+# --- Vehicle assignment (respects fleet Quantity) ---
+DAC_PRIORITY_WEIGHT = 0.5 # Extra weight for a route fully inside DACs when vehicles are scarce
+ASSIGNMENT_COLUMNS = ['Route ID', 'Bus Type', 'Assignment', 'Assigned Vehicle', 'Battery (kWh)', 'Vehicle Range (mi)', 'Round Trip (mi)', '% in Disadvantaged Community']
+
+
+def expand_vehicles(ev_fleet, range_col):
+    """One row per physical bus (Quantity copies of each fleet row), with its range for range_col and nameplate kWh."""
+    if ev_fleet is None or ev_fleet.empty or range_col not in ev_fleet.columns:
+        return pd.DataFrame({"Vehicle": pd.Series(dtype=object), "Type": pd.Series(dtype=object), "Range": pd.Series(dtype=float),
+                             "Battery (kWh)": pd.Series(dtype=float)})
+    quantity = pd.to_numeric(ev_fleet.get("Quantity", 1), errors='coerce').fillna(0).clip(lower=0).astype(int).to_numpy()
+    rows = np.repeat(np.arange(len(ev_fleet)), quantity)
+    # Number copies of the same model 1..Quantity so every bus has a readable ID
+    copy_no = np.arange(len(rows)) - np.repeat(np.cumsum(quantity) - quantity, quantity) + 1
+    names = ev_fleet["Name"].astype(str).to_numpy()[rows]
+    return pd.DataFrame({
+        "Vehicle": [f"{n} #{k}" for n, k in zip(names, copy_no)],
+        "Type": ev_fleet["Type"].to_numpy()[rows],
+        "Range": pd.to_numeric(ev_fleet[range_col], errors='coerce').fillna(0).to_numpy(dtype=float)[rows],
+        "Battery (kWh)": pd.to_numeric(ev_fleet["Battery Capacity (kWh)"], errors='coerce').to_numpy(dtype=float)[rows],
+    })
+
+
+def _select_routes(distances, weights, vehicle_ranges):
+    """
+    Picks the set of routes to electrify for one bus type. A route can use any
+    vehicle whose range covers it, so feasible sets form a matroid and taking
+    routes by descending weight while the set stays matchable (Hall's condition
+    over distance thresholds) gives the maximum number of routes, with DAC
+    weight deciding which routes win when vehicles run out.
+    Returns a boolean array of selected routes.
+    """
+    n = len(distances)
+    selected = np.zeros(n, dtype=bool)
+    if n == 0 or len(vehicle_ranges) == 0:
+        return selected
+    thresholds = np.unique(distances) # Ascending
+    sorted_ranges = np.sort(vehicle_ranges)
+    # slack[t] = vehicles covering thresholds[t] - selected routes needing at least thresholds[t]
+    slack = len(sorted_ranges) - np.searchsorted(sorted_ranges, thresholds, side="left")
+    position = np.searchsorted(thresholds, distances)
+    # Highest weight first; shorter routes first on ties so more of them fit
+    for i in np.lexsort((distances, -weights)):
+        q = position[i]
+        if slack[:q + 1].min() > 0:
+            slack[:q + 1] -= 1
+            selected[i] = True
+    return selected
+
+
+def _match_vehicles(distances, vehicle_ranges):
+    """Assigns each (selected) route the shortest-range vehicle that still covers it. Returns vehicle positions."""
+    order = np.argsort(vehicle_ranges, kind="stable")
+    available = list(vehicle_ranges[order]) # Ascending, shrinks as buses are used
+    available_idx = list(order)
+    matched = np.full(len(distances), -1)
+    for i in np.argsort(-distances, kind="stable"): # Longest routes pick first
+        j = bisect.bisect_left(available, distances[i])
+        if j < len(available):
+            matched[i] = available_idx[j]
+            del available[j]; del available_idx[j]
+    return matched
+
+
+def assign_vehicles(results, route_bus_types, ev_fleet, range_col="Cold Weather Range", dac_weight=DAC_PRIORITY_WEIGHT, default_type="A"):
+    """
+    Allocates actual buses (respecting Quantity) to routes, one bus per route
+    for its AM + PM round trip with no midday charging.
+
+    Args:
+        results: st.session_state.results.
+        route_bus_types: {route_id: "A" | "C"} from Tab 3 section B.
+        ev_fleet: Output of process_fleet_data.
+        range_col: Weather band to plan against (one of RANGE_COLS).
+        dac_weight: Route weight is 1 + dac_weight * (% in DAC / 100).
+
+    Returns:
+        DataFrame in ASSIGNMENT_COLUMNS order (electrified routes first), or None if no routes.
+    """
+    rows = [r for r in results if r.get("Route ID")]
+    if not rows:
+        return None
+    route_ids = np.array([r.get("Route ID") for r in rows], dtype=object)
+    types = np.array([route_bus_types.get(rid, default_type) for rid in route_ids], dtype=object)
+    distances = np.array([(r.get("AM Distance (miles)", 0.0) or 0.0) + (r.get("PM Distance (miles)", 0.0) or 0.0) for r in rows], dtype=float)
+    dac = pd.to_numeric(pd.Series([r.get("Percent in DAC", 0.0) for r in rows]), errors='coerce').fillna(0).to_numpy(dtype=float)
+    weights = 1.0 + dac_weight * np.clip(dac, 0, 100) / 100.0
+
+    vehicles = expand_vehicles(ev_fleet, range_col)
+    assigned_vehicle = np.full(len(rows), None, dtype=object)
+    vehicle_range = np.full(len(rows), np.nan)
+    vehicle_kwh = np.full(len(rows), np.nan)
+    assignment = np.full(len(rows), "Diesel - No Bus In Range", dtype=object)
+
+    for bus_type in pd.unique(types):
+        route_pos = np.flatnonzero(types == bus_type)
+        type_vehicles = vehicles[vehicles["Type"] == bus_type]
+        ranges = type_vehicles["Range"].to_numpy(dtype=float)
+        names = type_vehicles["Vehicle"].to_numpy()
+        kwh = type_vehicles["Battery (kWh)"].to_numpy(dtype=float)
+        in_range = distances[route_pos] <= (ranges.max() if len(ranges) else -np.inf)
+        assignment[route_pos[in_range]] = "Diesel - Vehicles Exhausted"
+
+        selected = _select_routes(distances[route_pos], weights[route_pos], ranges)
+        chosen = route_pos[selected]
+        matched = _match_vehicles(distances[chosen], ranges)
+        ok = matched >= 0 # Always true for a Hall-feasible selection
+        assigned_vehicle[chosen[ok]] = names[matched[ok]]
+        vehicle_range[chosen[ok]] = ranges[matched[ok]]
+        vehicle_kwh[chosen[ok]] = kwh[matched[ok]]
+        assignment[chosen[ok]] = "Electric"
+
+    assignment_df = pd.DataFrame({
+        "Route ID": route_ids, "Bus Type": types, "Assignment": assignment,
+        "Assigned Vehicle": assigned_vehicle, "Battery (kWh)": vehicle_kwh, "Vehicle Range (mi)": vehicle_range,
+        "Round Trip (mi)": round_half_even_exact(distances, 2), "% in Disadvantaged Community": dac,
+    })
+    assignment_df["_electric"] = assignment_df["Assignment"].ne("Electric")
+    assignment_df = assignment_df.sort_values(by=["_electric", "Route ID"], kind="stable").drop(columns=["_electric"])
+    return assignment_df[ASSIGNMENT_COLUMNS].reset_index(drop=True)
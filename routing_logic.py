@@ -0,0 +1,637 @@
+import datetime
+import heapq
+import math
+from abc import ABC, abstractmethod
+
+import numpy as np
+import polyline
+import requests
+import shapely
+from shapely import STRtree
+
+from cache_logic import make_cache_key
+from concurrency_logic import DeferredMessages, LogMessages, run_ordered
+
+# Routing backends. Every provider answers route(origin, waypoints, destination,
+# departure_time) with the same (distance_mi, duration_min, leg_details, polyline)
+# tuple the Tab 3 calculations expect, so Google and the offline engine are
+# interchangeable.
+
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+MATRIX_MAX_ELEMENTS = 100 # Distance Matrix per-request limit (origins x destinations)
+MATRIX_MAX_SIDE = 25 # At most 25 origins and 25 destinations per request
+MATRIX_MAX_OVERFETCH = 2 # A shared request may bill at most 2x the elements it needs
+DIRECTIONS_BUCKET_MINUTES = 15 # Departures within the same 15 min slot share a cached answer
+METERS_PER_MILE = 1609.34
+EARTH_RADIUS_M = 6371008.8
+
+
+def normalize_point(point, ui):
+    """(lat, lng) from a tuple/list or a stop dict with a 'location'; raises ValueError otherwise."""
+    if isinstance(point, (list, tuple)) and len(point) == 2 and all(isinstance(x, (int, float)) for x in point):
+        return point
+    elif isinstance(point, dict) and "location" in point:
+        loc = point["location"]
+        if isinstance(loc, (list, tuple)) and len(loc) == 2 and all(isinstance(x, (int, float)) for x in loc):
+            return loc
+    ui.error(f"Invalid location format encountered: {point}")
+    raise ValueError(f"Invalid location format: {point}")
+
+
+def directions_departure_bucket(departure_time, bucket_minutes=DIRECTIONS_BUCKET_MINUTES):
+    # Cache slot for a departure: Monday time-of-day floored to the bucket, or "now"
+    if departure_time is None: return "now"
+    if isinstance(departure_time, str):
+        try: departure_time = datetime.datetime.strptime(departure_time, "%H:%M").time()
+        except ValueError: return "now"
+    if not isinstance(departure_time, datetime.time): return "now"
+    minutes = departure_time.hour * 60 + departure_time.minute
+    minutes -= minutes % bucket_minutes
+    return f"mon-{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def get_route_distance(api_key, origin, waypoints, destination, departure_time=None, cache=None, rate_limiter=None, ui=None):
+    # cache: optional ResponseCache; OK responses are stored keyed on the normalized request
+    # rate_limiter: optional HostRateLimiter, only consulted when we actually hit the network
+    # ui: st, a DeferredMessages when called from a worker thread, or None to log
+    ui = ui or LogMessages()
+    def normalize_location(point): return normalize_point(point, ui)
+
+    base_url = DIRECTIONS_URL
+    valid_waypoints = []
+    waypoint_keys = [] # Rounded copies used only for the cache key
+    if waypoints:
+        for wp in waypoints:
+            try:
+                normalized_wp = normalize_location(wp)
+                valid_waypoints.append(f"{normalized_wp[0]},{normalized_wp[1]}")
+                waypoint_keys.append(f"{normalized_wp[0]:.6f},{normalized_wp[1]:.6f}")
+            except (ValueError, TypeError, IndexError) as e:
+                ui.warning(f"Skipping invalid waypoint format: {wp} due to {e}")
+    waypoints_str = "|".join(valid_waypoints) if valid_waypoints else ""
+
+    try:
+        origin_norm = normalize_location(origin)
+        destination_norm = normalize_location(destination)
+    except (ValueError, TypeError, IndexError) as e:
+         ui.error(f"Invalid origin or destination format: Origin={origin}, Dest={destination}, Error: {e}")
+         return None, None, [], None
+
+    mode = "driving"
+    cache_key = None
+    if cache is not None:
+        cache_key = make_cache_key(
+            "directions", mode,
+            f"{origin_norm[0]:.6f},{origin_norm[1]:.6f}",
+            waypoint_keys,
+            f"{destination_norm[0]:.6f},{destination_norm[1]:.6f}",
+            directions_departure_bucket(departure_time),
+        )
+
+    departure_unix = "now"
+    if departure_time:
+        try:
+            now = datetime.datetime.now()
+            if isinstance(departure_time, str):
+                 departure_time = datetime.datetime.strptime(departure_time, "%H:%M").time()
+            elif not isinstance(departure_time, datetime.time):
+                 ui.warning(f"Unexpected departure_time format: {departure_time}. Using current time.")
+                 departure_time = now.time()
+
+            days_ahead = (0 - now.weekday() + 7) % 7
+            if days_ahead == 0 and now.time() > departure_time : days_ahead = 7
+            elif days_ahead == 0 and now.time() <= departure_time: days_ahead = 0
+            next_monday = now.date() + datetime.timedelta(days=days_ahead)
+            departure_datetime = datetime.datetime.combine(next_monday, departure_time)
+            departure_unix = int(departure_datetime.timestamp())
+        except Exception as e:
+            ui.warning(f"Error processing departure time '{departure_time}': {e}. Using default.")
+            departure_unix = "now"
+
+    params = {
+        "origin": f"{origin_norm[0]},{origin_norm[1]}",
+        "destination": f"{destination_norm[0]},{destination_norm[1]}",
+        "waypoints": waypoints_str,
+        "key": api_key,
+        "mode": mode,
+    }
+    if isinstance(departure_unix, int):
+         params["traffic_model"] = "best_guess"
+         params["departure_time"] = departure_unix
+
+    data = cache.get(cache_key) if cache_key else None
+    if data is None:
+        try:
+            if rate_limiter is not None: rate_limiter.acquire(base_url)
+            response = requests.get(base_url, params=params, timeout=20)
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            ui.error(f"Error during Google Maps API request: {e}")
+            return None, None, [], None
+        except Exception as e:
+            ui.error(f"An unexpected error occurred fetching directions: {e}")
+            return None, None, [], None
+        # Only cache usable answers; errors/quota failures should be retried next time
+        if cache_key and data.get("status") == "OK":
+            try: cache.set(cache_key, data)
+            except Exception as cache_err: ui.warning(f"Could not write directions cache: {cache_err}")
+
+    if data["status"] == "OK" and data.get("routes"):
+        route_info = data["routes"][0]
+        legs = route_info.get("legs", [])
+        overview_polyline = route_info.get("overview_polyline", {}).get("points")
+        if not legs:
+             ui.warning("Google Maps API returned OK status but no route legs.")
+             return None, None, [], overview_polyline
+
+        total_distance = sum(leg.get("distance", {}).get("value", 0) for leg in legs) / METERS_PER_MILE
+        total_duration = sum(leg.get("duration", {}).get("value", 0) for leg in legs) / 60
+        leg_details = [{
+            "Start Address": leg.get("start_address", "N/A"),
+            "End Address": leg.get("end_address", "N/A"),
+            "Distance (mi)": round(leg.get("distance", {}).get("value", 0) / METERS_PER_MILE, 2),
+            "Duration (min)": round(leg.get("duration", {}).get("value", 0) / 60, 1)
+        } for leg in legs]
+        return total_distance, total_duration, leg_details, overview_polyline
+    else:
+        ui.warning(f"Google Maps API Error: {data.get('status', 'Unknown Status')}. Message: {data.get('error_message', 'No error message provided.')}")
+        return None, None, [], None
+
+
+class RoutingProvider(ABC):
+    """Interface for routing backends used by the Tab 3 route calculations. Subclasses must implement route()."""
+    name = "base"
+
+    @abstractmethod
+    def route(self, origin, waypoints, destination, departure_time=None, ui=None):
+        """Returns (distance_mi, duration_min, leg_details, encoded_polyline); (None, None, [], None) on failure."""
+
+    def matrix_tile(self, origins, destinations, ui=None):
+        """
+        Travel between every origin and destination ((lat, lng) tuples).
+        Returns rows[i][j] = (meters, seconds), or None where no route was found;
+        returns None instead of rows if the request as a whole failed, so it can be retried.
+        The fallback asks route() once per pair; backends override it with a bulk call.
+        """
+        rows = []
+        for origin in origins:
+            row = []
+            for destination in destinations:
+                distance, duration, _, _ = self.route(origin, [], destination, ui=ui)
+                row.append((distance * METERS_PER_MILE, duration * 60) if distance is not None and duration is not None else None)
+            rows.append(row)
+        return rows
+
+
+class GoogleDirectionsProvider(RoutingProvider):
+    """
+    The Google Directions API (traffic-aware, billed per request).
+
+    Args:
+        api_key: Google Maps API key.
+        cache: Optional cache_logic.ResponseCache for responses.
+        rate_limiter: Optional concurrency_logic.HostRateLimiter shared by workers.
+    """
+    name = "Google Directions"
+
+    def __init__(self, api_key, cache=None, rate_limiter=None):
+        self.api_key = api_key
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+
+    def route(self, origin, waypoints, destination, departure_time=None, ui=None):
+        return get_route_distance(self.api_key, origin, waypoints, destination, departure_time,
+                                  cache=self.cache, rate_limiter=self.rate_limiter, ui=ui)
+
+    def matrix_tile(self, origins, destinations, ui=None):
+        # One Distance Matrix request per tile (no departure time: typical, not traffic-specific, durations)
+        return get_distance_matrix(self.api_key, origins, destinations, cache=self.cache, rate_limiter=self.rate_limiter, ui=ui)
+
+
+def get_distance_matrix(api_key, origins, destinations, cache=None, rate_limiter=None, ui=None):
+    """
+    One Google Distance Matrix request (at most MATRIX_MAX_ELEMENTS elements, MATRIX_MAX_SIDE per side).
+    Returns rows[i][j] = (meters, seconds) or None for elements without a route.
+    A failed request returns None; OK responses are cached like Directions answers.
+    """
+    ui = ui or LogMessages()
+    origin_strs = [f"{lat:.6f},{lng:.6f}" for lat, lng in origins]
+    destination_strs = [f"{lat:.6f},{lng:.6f}" for lat, lng in destinations]
+    cache_key = make_cache_key("distancematrix", "driving", origin_strs, destination_strs) if cache is not None else None
+
+    data = cache.get(cache_key) if cache_key else None
+    if data is None:
+        params = {"origins": "|".join(origin_strs), "destinations": "|".join(destination_strs), "mode": "driving", "key": api_key}
+        try:
+            if rate_limiter is not None: rate_limiter.acquire(DISTANCE_MATRIX_URL)
+            response = requests.get(DISTANCE_MATRIX_URL, params=params, timeout=30)
+            response.raise_for_status()
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            ui.error(f"Error during Google Distance Matrix request: {e}")
+            return None
+        except Exception as e: # e.g. a non-JSON error page
+            ui.error(f"An unexpected error occurred fetching the distance matrix: {e}")
+            return None
+        if data.get("status") != "OK":
+            ui.warning(f"Google Distance Matrix Error: {data.get('status', 'Unknown Status')}. Message: {data.get('error_message', 'No error message provided.')}")
+            return None
+        if cache_key:
+            try: cache.set(cache_key, data)
+            except Exception as cache_err: ui.warning(f"Could not write distance matrix cache: {cache_err}")
+
+    rows = []
+    for row in data.get("rows", []):
+        rows.append([(element["distance"]["value"], element["duration"]["value"]) if element.get("status") == "OK" else None
+                     for element in row.get("elements", [])])
+    return rows if len(rows) == len(origins) else None
+
+
+# --- Offline engine: A* over a local road graph ---
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters (NumPy-friendly)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_M * 2 * np.arcsin(np.sqrt(a))
+
+
+class RoadGraph:
+    """
+    Directed road graph in CSR form. Loaded from an .npz with arrays
+    node_lat, node_lon (per node) and edge_u, edge_v, edge_length_m,
+    edge_duration_s (per directed edge; node positions as indices).
+    Build one with RoadGraph.from_csv(...).save(".data/road_graph.npz").
+    """
+
+    def __init__(self, node_lat, node_lon, edge_u, edge_v, edge_length_m, edge_duration_s):
+        self.node_lat = np.asarray(node_lat, dtype=float)
+        self.node_lon = np.asarray(node_lon, dtype=float)
+        n = len(self.node_lat)
+        edge_u = np.asarray(edge_u, dtype=np.int64)
+        order = np.argsort(edge_u, kind="stable")
+        self.indptr = np.searchsorted(edge_u[order], np.arange(n + 1)).tolist()
+        # Plain lists: the A* inner loop is pure Python and list indexing is faster than NumPy scalars
+        self.targets = np.asarray(edge_v, dtype=np.int64)[order].tolist()
+        self.lengths = np.asarray(edge_length_m, dtype=float)[order].tolist()
+        self.durations = np.asarray(edge_duration_s, dtype=float)[order].tolist()
+        speeds = np.asarray(edge_length_m, dtype=float) / np.maximum(np.asarray(edge_duration_s, dtype=float), 1e-6)
+        self.max_speed_mps = float(speeds.max()) if len(speeds) else 1.0 # Keeps the A* heuristic admissible
+        # Per-node radians/cosines as lists, so the heuristic is a few float ops per reached node
+        self._lat_rad = np.radians(self.node_lat).tolist()
+        self._lon_rad = np.radians(self.node_lon).tolist()
+        self._cos_lat = np.cos(np.radians(self.node_lat)).tolist()
+        self._tree = STRtree(shapely.points(self.node_lon, self.node_lat))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["node_lat"], data["node_lon"], data["edge_u"], data["edge_v"], data["edge_length_m"], data["edge_duration_s"])
+
+    @classmethod
+    def from_csv(cls, nodes_csv, edges_csv, default_speed_mph=20):
+        """
+        Builds a graph from nodes (node_id, lat, lon) and edges (u, v, length_m,
+        optional duration_s, optional oneway) CSVs, e.g. an OpenStreetMap export.
+        Edges without a duration use default_speed_mph; two-way edges are added in both directions.
+        """
+        import pandas as pd
+        nodes = pd.read_csv(nodes_csv)
+        edges = pd.read_csv(edges_csv)
+        position = pd.Series(np.arange(len(nodes)), index=nodes["node_id"].to_numpy())
+        u = position.reindex(edges["u"].to_numpy()).to_numpy()
+        v = position.reindex(edges["v"].to_numpy()).to_numpy()
+        keep = ~(np.isnan(u) | np.isnan(v)) # Drop edges that reference unknown nodes
+        edges, u, v = edges[keep], u[keep].astype(np.int64), v[keep].astype(np.int64)
+        length = edges["length_m"].to_numpy(dtype=float)
+        duration = edges["duration_s"].to_numpy(dtype=float) if "duration_s" in edges else length / (default_speed_mph * METERS_PER_MILE / 3600)
+        two_way = ~edges["oneway"].astype(bool).to_numpy() if "oneway" in edges else np.ones(len(edges), dtype=bool)
+        return cls(nodes["lat"], nodes["lon"],
+                   np.concatenate([u, v[two_way]]), np.concatenate([v, u[two_way]]),
+                   np.concatenate([length, length[two_way]]), np.concatenate([duration, duration[two_way]]))
+
+    def save(self, path):
+        edge_u = np.repeat(np.arange(len(self.node_lat)), np.diff(self.indptr))
+        np.savez_compressed(path, node_lat=self.node_lat, node_lon=self.node_lon, edge_u=edge_u,
+                            edge_v=np.asarray(self.targets), edge_length_m=np.asarray(self.lengths), edge_duration_s=np.asarray(self.durations))
+
+    def nearest_node(self, lat, lon):
+        return int(self._tree.query_nearest(shapely.Point(lon, lat))[0])
+
+    def shortest_path(self, source, target):
+        """
+        Fastest path by A* (duration weights, straight-line / max speed heuristic).
+        Returns (node list, length_m, duration_s) or None if target is unreachable.
+        """
+        if source == target:
+            return [source], 0.0, 0.0
+        lat_rad, lon_rad, cos_lat = self._lat_rad, self._lon_rad, self._cos_lat
+        target_lat, target_lon, target_cos = lat_rad[target], lon_rad[target], cos_lat[target]
+        scale = 2 * EARTH_RADIUS_M / self.max_speed_mps
+        heuristic = {} # Straight-line seconds to target, only for nodes the search reaches (not all N)
+
+        def h(node):
+            value = heuristic.get(node)
+            if value is None:
+                a = math.sin((lat_rad[node] - target_lat) / 2) ** 2 + cos_lat[node] * target_cos * math.sin((lon_rad[node] - target_lon) / 2) ** 2
+                value = heuristic[node] = scale * math.asin(math.sqrt(min(a, 1.0)))
+            return value
+
+        best = {source: 0.0}
+        length_to = {source: 0.0}
+        parent = {source: None}
+        heap = [(h(source), 0.0, source)]
+        indptr, targets, lengths, durations = self.indptr, self.targets, self.lengths, self.durations
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node == target:
+                path = [node]
+                while parent[path[-1]] is not None: path.append(parent[path[-1]])
+                return path[::-1], length_to[target], cost
+            if cost > best.get(node, math.inf):
+                continue # Stale heap entry
+            for e in range(indptr[node], indptr[node + 1]):
+                nxt = targets[e]
+                new_cost = cost + durations[e]
+                if new_cost < best.get(nxt, math.inf):
+                    best[nxt] = new_cost
+                    length_to[nxt] = length_to[node] + lengths[e]
+                    parent[nxt] = node
+                    heapq.heappush(heap, (new_cost + h(nxt), new_cost, nxt))
+        return None
+
+
+    def shortest_paths_from(self, source, targets):
+        """
+        Fastest paths from source to every node in targets (one Dijkstra, stopped once all are settled).
+        Returns {target: (length_m, duration_s)} for the reachable targets.
+        """
+        remaining = set(targets)
+        found = {}
+        best = {source: 0.0}
+        length_to = {source: 0.0}
+        heap = [(0.0, source)]
+        indptr, targets_, lengths, durations = self.indptr, self.targets, self.lengths, self.durations
+        while heap and remaining:
+            cost, node = heapq.heappop(heap)
+            if cost > best.get(node, math.inf):
+                continue # Stale heap entry
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = (length_to[node], cost)
+            for e in range(indptr[node], indptr[node + 1]):
+                nxt = targets_[e]
+                new_cost = cost + durations[e]
+                if new_cost < best.get(nxt, math.inf):
+                    best[nxt] = new_cost
+                    length_to[nxt] = length_to[node] + lengths[e]
+                    heapq.heappush(heap, (new_cost, nxt))
+        return found
+
+
+class LocalGraphProvider(RoutingProvider):
+    """
+    Offline routing over a RoadGraph: no network, quota or API key. Stops are
+    snapped to their nearest graph node and each leg is an A* shortest path.
+    Durations are free-flow (departure_time is ignored).
+
+    Args:
+        graph: A RoadGraph, or a path to its .npz file.
+    """
+    name = "Local road graph"
+
+    def __init__(self, graph):
+        self.graph = RoadGraph.load(graph) if isinstance(graph, str) else graph
+
+    def route(self, origin, waypoints, destination, departure_time=None, ui=None):
+        ui = ui or LogMessages()
+        try:
+            stops = [normalize_point(origin, ui)]
+            for wp in waypoints or []:
+                try: stops.append(normalize_point(wp, ui))
+                except (ValueError, TypeError, IndexError) as e: ui.warning(f"Skipping invalid waypoint format: {wp} due to {e}")
+            stops.append(normalize_point(destination, ui))
+        except (ValueError, TypeError, IndexError) as e:
+            ui.error(f"Invalid origin or destination format: Origin={origin}, Dest={destination}, Error: {e}")
+            return None, None, [], None
+
+        nodes = [self.graph.nearest_node(lat, lng) for lat, lng in stops]
+        total_m, total_s, leg_details, coords = 0.0, 0.0, [], []
+        for (start, end), (u, v) in zip(zip(stops[:-1], stops[1:]), zip(nodes[:-1], nodes[1:])):
+            found = self.graph.shortest_path(u, v)
+            if found is None:
+                ui.warning(f"Local routing: no path between {start} and {end} in the road graph.")
+                return None, None, [], None
+            path, length_m, duration_s = found
+            total_m += length_m; total_s += duration_s
+            leg_details.append({
+                "Start Address": f"{start[0]:.5f}, {start[1]:.5f}",
+                "End Address": f"{end[0]:.5f}, {end[1]:.5f}",
+                "Distance (mi)": round(length_m / METERS_PER_MILE, 2),
+                "Duration (min)": round(duration_s / 60, 1)
+            })
+            leg_coords = [(self.graph.node_lat[n], self.graph.node_lon[n]) for n in path]
+            coords.extend(leg_coords[1:] if coords else leg_coords) # Legs share their joining node
+        encoded = polyline.encode([(float(lat), float(lon)) for lat, lon in coords]) if len(coords) > 1 else None
+        return total_m / METERS_PER_MILE, total_s / 60, leg_details, encoded
+
+    def matrix_tile(self, origins, destinations, ui=None):
+        # One Dijkstra per origin covers the whole row
+        destination_nodes = [self.graph.nearest_node(lat, lng) for lat, lng in destinations]
+        rows = []
+        for lat, lng in origins:
+            found = self.graph.shortest_paths_from(self.graph.nearest_node(lat, lng), destination_nodes)
+            rows.append([found.get(node) for node in destination_nodes])
+        return rows
+
+
+# --- Bulk mode: one stop-to-stop matrix instead of per-route Directions calls ---
+
+def point_key(point):
+    """Matrix key for a (lat, lng): rounded to 6 decimals (~0.1 m), like the Directions cache key."""
+    return (round(float(point[0]), 6), round(float(point[1]), 6))
+
+
+def trip_point_keys(stops):
+    """Point keys of a sequence of stops ((lat, lng) or stop dicts), invalid entries skipped."""
+    points = []
+    for stop in stops:
+        try: points.append(point_key(normalize_point(stop, LogMessages())))
+        except (ValueError, TypeError, IndexError): continue
+    return points
+
+
+def route_stop_points(route):
+    """Every depot/pickup/dropoff location of a route, as point keys (invalid entries skipped)."""
+    return trip_point_keys([route.get("depot")] + list(route.get("pickups", [])) + list(route.get("dropoffs", [])))
+
+
+def trip_pairs(trips, all_pairs=False):
+    """
+    Ordered (origin, destination) point-key pairs a set of trips needs: the consecutive
+    legs of each trip, or with all_pairs every ordered pair of stops within a trip
+    (the search space of the stop-order optimizer).
+    """
+    pairs = set()
+    for trip in trips:
+        points = trip_point_keys(trip)
+        if all_pairs: pairs.update((a, b) for a in points for b in points if a != b)
+        else: pairs.update((a, b) for a, b in zip(points[:-1], points[1:]) if a != b)
+    return pairs
+
+
+class StopMatrix:
+    """
+    Sparse stop-to-stop travel table over the unique stops of a set of trips.
+    entries maps (origin_index, destination_index) -> (meters, seconds); pairs the
+    backend could not route are absent. requested holds every pair a request answered
+    (failed requests are left out, so covers() asks for them again).
+
+    Args:
+        points: Unique point keys (see point_key), in first-seen order.
+    """
+
+    def __init__(self, points):
+        self.points = list(points)
+        self.index = {p: i for i, p in enumerate(self.points)}
+        self.entries = {}
+        self.requested = set()
+
+    def __len__(self):
+        return len(self.points)
+
+    def lookup(self, origin, destination):
+        """(meters, seconds) between two (lat, lng) points, or None if unknown."""
+        i, j = self.index.get(point_key(origin)), self.index.get(point_key(destination))
+        if i is None or j is None: return None
+        if i == j: return (0.0, 0.0)
+        return self.entries.get((i, j))
+
+    def covers(self, trips, all_pairs=False):
+        """True if every pair trip_pairs(trips, all_pairs) needs was already requested."""
+        for a, b in trip_pairs(trips, all_pairs):
+            i, j = self.index.get(a), self.index.get(b)
+            if i is None or j is None or (i, j) not in self.requested: return False
+        return True
+
+
+def plan_matrix_requests(pairs, max_elements=MATRIX_MAX_ELEMENTS, max_side=MATRIX_MAX_SIDE, max_overfetch=MATRIX_MAX_OVERFETCH):
+    """
+    Groups (origin index, destination index) pairs into matrix requests
+    [(origin ids, destination ids)]. Pairs are grouped by origin and each origin asks
+    only for its own destinations. Origins with similar destinations share a request
+    while it stays within max_elements / max_side and bills at most max_overfetch
+    times the pairs it needs (a request returns every origin x destination element).
+    """
+    by_origin = {}
+    for i, j in pairs: by_origin.setdefault(i, set()).add(j)
+    rows = []
+    for i, destinations in by_origin.items():
+        destinations = sorted(destinations)
+        for k in range(0, len(destinations), max_side): rows.append((i, destinations[k:k + max_side]))
+    rows.sort(key=lambda row: (row[1], row[0])) # Origins with the same destinations end up next to each other
+
+    requests_, origins, columns, needed = [], [], set(), 0
+    for i, destinations in rows:
+        merged = columns.union(destinations)
+        billed = (len(origins) + 1) * len(merged)
+        if origins and (billed > max_elements or len(merged) > max_side or len(origins) >= max_side
+                        or billed > max_overfetch * (needed + len(destinations))):
+            requests_.append((origins, sorted(columns)))
+            origins, merged, needed = [], set(destinations), 0
+        origins = origins + [i]; columns = merged; needed += len(destinations)
+    if origins: requests_.append((origins, sorted(columns)))
+    return requests_
+
+
+def build_stop_matrix(trips, provider, all_pairs=False, max_workers=1, on_progress=None, ui=None):
+    """
+    Fills a StopMatrix with the pairs the trips need (see trip_pairs) through
+    provider.matrix_tile (Distance Matrix API or the local engine), batched by
+    plan_matrix_requests.
+
+    Args:
+        trips: Stop sequences in driving order, e.g. pipeline.route_trip_stops for each route.
+        provider: A RoutingProvider.
+        all_pairs: Request every ordered pair within a trip instead of only its legs.
+        max_workers: Requests sent concurrently.
+        on_progress: Optional callback(done, total) on the calling thread.
+        ui: st (messages from workers are replayed on the calling thread) or None to log.
+
+    Returns:
+        (StopMatrix, number of matrix requests).
+    """
+    ui = ui or LogMessages()
+    points, index = [], {}
+    for trip in trips:
+        for p in trip_point_keys(trip):
+            if p not in index:
+                index[p] = len(points); points.append(p)
+    matrix = StopMatrix(points)
+    matrix_requests = plan_matrix_requests({(index[a], index[b]) for a, b in trip_pairs(trips, all_pairs)})
+
+    def fetch(matrix_request):
+        messages = DeferredMessages()
+        origin_ids, destination_ids = matrix_request
+        rows = provider.matrix_tile([points[i] for i in origin_ids], [points[j] for j in destination_ids], ui=messages)
+        return rows, messages
+
+    def on_response(t, outcome):
+        rows, messages = outcome
+        messages.replay(ui)
+        origin_ids, destination_ids = matrix_requests[t]
+        for i, row in zip(origin_ids, rows or []): # rows is None when the request failed
+            for j, value in zip(destination_ids, row):
+                if i == j: continue
+                matrix.requested.add((i, j))
+                if value is not None: matrix.entries[(i, j)] = (float(value[0]), float(value[1]))
+        if on_progress: on_progress(t + 1, len(matrix_requests))
+
+    run_ordered(fetch, matrix_requests, max_workers=max_workers, on_result=on_response)
+    return matrix, len(matrix_requests)
+
+
+class MatrixProvider(RoutingProvider):
+    """
+    Answers route() by summing StopMatrix lookups leg by leg; no requests are made.
+    There is no road geometry, so the polyline is the straight stop-to-stop chain
+    (DAC overlap and the map are approximate in bulk mode).
+
+    Args:
+        matrix: A StopMatrix built by build_stop_matrix.
+    """
+    name = "Distance matrix"
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def route(self, origin, waypoints, destination, departure_time=None, ui=None):
+        ui = ui or LogMessages()
+        try:
+            stops = [normalize_point(origin, ui)]
+            for wp in waypoints or []:
+                try: stops.append(normalize_point(wp, ui))
+                except (ValueError, TypeError, IndexError) as e: ui.warning(f"Skipping invalid waypoint format: {wp} due to {e}")
+            stops.append(normalize_point(destination, ui))
+        except (ValueError, TypeError, IndexError) as e:
+            ui.error(f"Invalid origin or destination format: Origin={origin}, Dest={destination}, Error: {e}")
+            return None, None, [], None
+
+        total_m, total_s, leg_details = 0.0, 0.0, []
+        for start, end in zip(stops[:-1], stops[1:]):
+            found = self.matrix.lookup(start, end)
+            if found is None:
+                ui.warning(f"Distance matrix: no travel time between {start} and {end}.")
+                return None, None, [], None
+            length_m, duration_s = found
+            total_m += length_m; total_s += duration_s
+            leg_details.append({
+                "Start Address": f"{start[0]:.5f}, {start[1]:.5f}",
+                "End Address": f"{end[0]:.5f}, {end[1]:.5f}",
+                "Distance (mi)": round(length_m / METERS_PER_MILE, 2),
+                "Duration (min)": round(duration_s / 60, 1)
+            })
+        encoded = polyline.encode([(float(lat), float(lng)) for lat, lng in stops])
+        return total_m / METERS_PER_MILE, total_s / 60, leg_details, encoded
@@ -0,0 +1,194 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from routing_logic import METERS_PER_MILE
+
+# Stop-order optimizer for the Tab 3 trips. Works purely on a StopMatrix
+# (routing_logic.build_stop_matrix), so trying orders never calls an API.
+# AM: depot -> pickups (reordered) -> dropoffs in their existing order.
+# PM: schools in their existing order -> pickups (reordered) -> depot.
+# Pickups always stay on the home side of the school block, so every pupil
+# is picked up before (AM) or dropped after (PM) their school stop.
+
+DEFAULT_TIME_BUDGET_SECONDS = 0.25 # Local search budget per trip
+OR_OPT_MAX_SEGMENT = 3
+
+
+def path_cost(cost, path):
+    """Sum of cost[a, b] along path (inf if any leg is unknown)."""
+    path = np.asarray(path)
+    if len(path) < 2: return 0.0
+    return float(cost[path[:-1], path[1:]].sum())
+
+
+def nearest_neighbour(cost, start, nodes):
+    """Greedy order of nodes: always drive to the closest unvisited stop next."""
+    order, current, remaining = [], start, list(nodes)
+    while remaining:
+        nxt = min(remaining, key=lambda n: cost[current, n])
+        order.append(nxt); remaining.remove(nxt); current = nxt
+    return order
+
+
+def improve_order(cost, start, order, end, deadline):
+    """
+    2-opt (segment reversal) and Or-opt (move a run of up to OR_OPT_MAX_SEGMENT stops)
+    on the open path start -> order -> end, endpoints fixed. Stops at a local optimum
+    or at the deadline (time.monotonic()). Costs may be asymmetric, so candidates are
+    scored on the full path.
+    """
+    best = list(order)
+    best_cost = path_cost(cost, [start] + best + [end])
+    n = len(best)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                candidate = best[:i] + best[i:j + 1][::-1] + best[j + 1:]
+                candidate_cost = path_cost(cost, [start] + candidate + [end])
+                if candidate_cost < best_cost - 1e-9:
+                    best, best_cost, improved = candidate, candidate_cost, True
+            if time.monotonic() >= deadline: return best
+        for length in range(1, min(OR_OPT_MAX_SEGMENT, n - 1) + 1):
+            for i in range(n - length + 1):
+                segment, rest = best[i:i + length], best[:i] + best[i + length:]
+                for k in range(len(rest) + 1):
+                    if k == i: continue
+                    candidate = rest[:k] + segment + rest[k:]
+                    candidate_cost = path_cost(cost, [start] + candidate + [end])
+                    if candidate_cost < best_cost - 1e-9:
+                        best, best_cost, improved = candidate, candidate_cost, True
+                        break
+                if time.monotonic() >= deadline: return best
+    return best
+
+
+def optimize_open_path(cost, start, nodes, end, time_budget_seconds=DEFAULT_TIME_BUDGET_SECONDS):
+    """Order of nodes minimizing cost on start -> nodes -> end (nearest neighbour, then local search)."""
+    if len(nodes) < 2: return list(nodes)
+    deadline = time.monotonic() + time_budget_seconds
+    return improve_order(cost, start, nearest_neighbour(cost, start, nodes), end, deadline)
+
+
+def _trip_matrix(stops, matrix):
+    # Dense distance sub-matrix (meters) over one route's stops; inf where unknown
+    n = len(stops)
+    cost = np.full((n, n), np.inf)
+    for a in range(n):
+        for b in range(n):
+            found = matrix.lookup(stops[a], stops[b])
+            if found is not None: cost[a, b] = found[0]
+    return cost
+
+
+def _pm_school_block(route):
+    # The PM schools in the order the existing reverse-sequence sort visits them
+    dropoffs = route.get("dropoffs", [])
+    return sorted(dropoffs[:-1], key=lambda x: x.get('sequence', 0), reverse=True)
+
+
+def optimize_route_order(route, matrix, time_budget_seconds=DEFAULT_TIME_BUDGET_SECONDS):
+    """
+    Best pickup order for the AM and PM trips of one route.
+
+    Returns a dict with am_pickup_order / pm_pickup_order (indices into route["pickups"],
+    None when the current order is already as short) and the before/after trip miles,
+    or None if the route can't be optimized (no depot/dropoffs, or unknown legs).
+    """
+    depot, pickups, dropoffs = route.get("depot"), route.get("pickups", []), route.get("dropoffs", [])
+    if not depot or not dropoffs or any(not p.get("location") for p in pickups) or any(not d.get("location") for d in dropoffs):
+        return None
+    # Local ids: 0 = depot, 1..P = pickups, then dropoffs
+    stops = [depot] + [p["location"] for p in pickups] + [d["location"] for d in dropoffs]
+    cost = _trip_matrix(stops, matrix)
+    P = len(pickups)
+    pickup_ids = list(range(1, P + 1))
+    dropoff_ids = list(range(P + 1, P + 1 + len(dropoffs)))
+
+    # AM as calculate_route_feasibility drives it: depot, pickups, dropoffs[1:], dropoffs[0]
+    am_tail = dropoff_ids[1:] + dropoff_ids[:1]
+    am_before = path_cost(cost, [0] + pickup_ids + am_tail)
+    am_order = optimize_open_path(cost, 0, pickup_ids, am_tail[0], time_budget_seconds)
+    am_after = path_cost(cost, [0] + am_order + am_tail)
+
+    # PM: current reverse-sequence order vs. schools first, then the reordered pickups
+    pm_start = dropoff_ids[-1]
+    sequence_of = {id(d): i for i, d in zip(dropoff_ids, dropoffs)}
+    sequence_of.update({id(p): i for i, p in zip(pickup_ids, pickups)})
+    pm_current = sorted(dropoffs[:-1] + pickups, key=lambda x: x.get('sequence', 0), reverse=True)
+    pm_before = path_cost(cost, [pm_start] + [sequence_of[id(s)] for s in pm_current] + [0])
+    pm_schools = [sequence_of[id(d)] for d in _pm_school_block(route)]
+    pm_order = optimize_open_path(cost, pm_schools[-1] if pm_schools else pm_start, pickup_ids, 0, time_budget_seconds)
+    pm_after = path_cost(cost, [pm_start] + pm_schools + pm_order + [0])
+
+    if not np.isfinite(am_before) or not np.isfinite(pm_before) or not np.isfinite(am_after) or not np.isfinite(pm_after):
+        return None
+    keep_am, keep_pm = am_after >= am_before - 1e-6, pm_after >= pm_before - 1e-6
+    return {
+        "am_pickup_order": None if keep_am else [i - 1 for i in am_order],
+        "pm_pickup_order": None if keep_pm else [i - 1 for i in pm_order],
+        "am_before_mi": am_before / METERS_PER_MILE, "am_after_mi": (am_before if keep_am else am_after) / METERS_PER_MILE,
+        "pm_before_mi": pm_before / METERS_PER_MILE, "pm_after_mi": (pm_before if keep_pm else pm_after) / METERS_PER_MILE,
+    }
+
+
+def apply_route_order(route, optimized):
+    """
+    Copy of route with the optimized order applied: pickups are reordered for AM and
+    the PM pickup order is stored as "pm_pickup_order" (indices into the new pickups).
+    """
+    new_route = dict(route)
+    pickups = list(route.get("pickups", []))
+    am_order = optimized.get("am_pickup_order") or list(range(len(pickups)))
+    new_route["pickups"] = [pickups[i] for i in am_order]
+    pm_order = optimized.get("pm_pickup_order")
+    if pm_order is not None:
+        position = {old: new for new, old in enumerate(am_order)}
+        new_route["pm_pickup_order"] = [position[i] for i in pm_order]
+    else:
+        new_route.pop("pm_pickup_order", None)
+    return new_route
+
+
+def pm_waypoint_stops(route):
+    """
+    PM waypoints (stop dicts) between the last dropoff and the depot: the optimized
+    order when the route carries one, otherwise the reverse sort on sequence.
+    """
+    pm_order = route.get("pm_pickup_order")
+    if pm_order is not None:
+        pickups = route.get("pickups", [])
+        return _pm_school_block(route) + [pickups[i] for i in pm_order]
+    return sorted(route.get("dropoffs", [])[:-1] + route.get("pickups", []), key=lambda x: x.get('sequence', 0), reverse=True)
+
+
+def optimize_routes(routes, matrix, time_budget_seconds=DEFAULT_TIME_BUDGET_SECONDS, on_progress=None):
+    """
+    Optimizes every route against matrix.
+
+    Returns:
+        (optimized routes list, summary DataFrame with before/after and saved miles per route).
+        Routes that can't be optimized are returned unchanged and reported as skipped.
+    """
+    new_routes, rows = [], []
+    for i, route in enumerate(routes):
+        route_id = route.get("route_id", f"Route_{i+1}")
+        optimized = optimize_route_order(route, matrix, time_budget_seconds)
+        if optimized is None:
+            new_routes.append(route)
+            rows.append({"Route ID": route_id, "Status": "Skipped"})
+        else:
+            new_routes.append(apply_route_order(route, optimized))
+            before = optimized["am_before_mi"] + optimized["pm_before_mi"]
+            after = optimized["am_after_mi"] + optimized["pm_after_mi"]
+            rows.append({
+                "Route ID": route_id, "Status": "Optimized",
+                "AM Before (mi)": round(optimized["am_before_mi"], 2), "AM After (mi)": round(optimized["am_after_mi"], 2),
+                "PM Before (mi)": round(optimized["pm_before_mi"], 2), "PM After (mi)": round(optimized["pm_after_mi"], 2),
+                "Miles Saved": round(before - after, 2),
+            })
+        if on_progress: on_progress(i + 1, len(routes))
+    return new_routes, pd.DataFrame(rows)
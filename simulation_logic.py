@@ -0,0 +1,293 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from plan_logic import EFFICIENCY_KWH_PER_MILE, USABLE_BATTERY_FRACTION
+from routing_logic import METERS_PER_MILE, haversine_m, point_key
+from weather_logic import AM_SERVICE_HOURS, PM_SERVICE_HOURS, consumption_kwh_per_mile
+
+# State-of-charge simulation. Every route's day is a list of steps (AM legs and
+# stop dwells, deadhead back to the depot, the midday layover, deadhead out,
+# PM legs and dwells) built from the Tab 3 "Leg Details". The engine walks the
+# steps once, updating a (vehicles x days) SoC array per step, so a whole fleet
+# over a school year is a few dozen NumPy operations.
+# Pure pandas/NumPy, no Streamlit.
+
+STOP_DWELL_MINUTES = 2.0 # Bus idles at each intermediate stop while pupils board/leave
+DEADHEAD_DETOUR_FACTOR = 1.3 # Road miles per straight-line mile for depot <-> school runs
+DEADHEAD_MPH = 18.0
+SCHOOL_DAY_MINUTES = 390 # First bell to dismissal
+DEFAULT_AM_DEPARTURE = datetime.time(6, 30) # Used when a route has no bell time
+IDLE_AUX_KW = 1.5 # Lights, doors, electronics while idling
+HEATING_KW_PER_F = 0.25 # Cabin heat below HVAC_COMFORT_LOW_F (idle only; driving is in kWh/mile)
+COOLING_KW_PER_F = 0.2 # Cabin cooling above HVAC_COMFORT_HIGH_F
+HVAC_COMFORT_LOW_F = 65.0
+HVAC_COMFORT_HIGH_F = 75.0
+CHARGER_EFFICIENCY = 0.9 # Grid kWh reaching the battery
+
+AM, PM = 0, 1
+
+
+def hvac_kw(temperatures):
+    """Idle heating/cooling load (kW) at each temperature (°F); NaN counts as cold."""
+    temperatures = np.asarray(temperatures, dtype=float)
+    temperatures = np.where(np.isnan(temperatures), HVAC_COMFORT_LOW_F - 40.0, temperatures)
+    return (HEATING_KW_PER_F * np.clip(HVAC_COMFORT_LOW_F - temperatures, 0, None)
+            + COOLING_KW_PER_F * np.clip(temperatures - HVAC_COMFORT_HIGH_F, 0, None))
+
+
+def _valid_point(point):
+    return isinstance(point, (list, tuple)) and len(point) == 2 and all(isinstance(v, (int, float)) for v in point)
+
+
+def depot_key(route):
+    """Point key of a route's depot (routing_logic.point_key), or None if it has no valid depot."""
+    depot = (route or {}).get("depot")
+    return point_key(depot) if _valid_point(depot) else None
+
+
+def _deadhead(origin, destination):
+    # Estimated (miles, minutes) for an empty run; zero when either end is unknown
+    if not _valid_point(origin) or not _valid_point(destination): return 0.0, 0.0
+    miles = float(haversine_m(origin[0], origin[1], destination[0], destination[1])) / METERS_PER_MILE * DEADHEAD_DETOUR_FACTOR
+    return miles, miles / DEADHEAD_MPH * 60
+
+
+def _trip_legs(result, prefix, leg_key):
+    # (miles, minutes) per leg; one leg from the trip totals if the result predates leg storage
+    legs = result.get(leg_key) or []
+    if legs:
+        return [(float(leg.get("Distance (mi)") or 0.0), float(leg.get("Duration (min)") or 0.0)) for leg in legs]
+    miles, minutes = result.get(f"{prefix} Distance (miles)"), result.get(f"{prefix} Duration (min)")
+    return [(float(miles or 0.0), float(minutes or 0.0))] if miles else []
+
+
+def route_steps(result, route=None):
+    """
+    The day of one route as a list of steps (event, phase, miles, minutes, idling, charging).
+    route (the Tab 2 route dict) supplies depot/school locations for the deadhead runs.
+    """
+    route = route or {}
+    depot, dropoffs = route.get("depot"), route.get("dropoffs") or []
+    first_school = dropoffs[0].get("location") if dropoffs else None
+    last_school = dropoffs[-1].get("location") if dropoffs else None
+    steps = []
+    for phase, prefix, leg_key in [(AM, "AM", "Leg Details"), (PM, "PM", "PM Leg Details")]:
+        if phase == PM:
+            in_miles, in_minutes = _deadhead(first_school, depot)
+            out_miles, out_minutes = _deadhead(depot, last_school)
+            steps.append(("Deadhead to Depot", AM, in_miles, in_minutes, False, False))
+            steps.append(("Layover", AM, 0.0, max(0.0, SCHOOL_DAY_MINUTES - in_minutes - out_minutes), False, True))
+            steps.append(("Deadhead to School", PM, out_miles, out_minutes, False, False))
+        legs = _trip_legs(result, prefix, leg_key)
+        for i, (miles, minutes) in enumerate(legs):
+            steps.append((f"{prefix} Leg {i + 1}", phase, miles, minutes, False, False))
+            if i < len(legs) - 1:
+                steps.append((f"{prefix} Stop {i + 1}", phase, 0.0, STOP_DWELL_MINUTES, True, False))
+    return steps
+
+
+def _step_arrays(step_lists):
+    # Pads per-route step lists into (routes x steps) arrays; padding steps use no energy
+    n_steps = max((len(s) for s in step_lists), default=0)
+    shape = (len(step_lists), n_steps)
+    arrays = {"phase": np.zeros(shape, dtype=np.int8), "miles": np.zeros(shape), "minutes": np.zeros(shape),
+              "idle": np.zeros(shape, dtype=bool), "charge": np.zeros(shape, dtype=bool)}
+    for r, steps in enumerate(step_lists):
+        for s, (_, phase, miles, minutes, idle, charge) in enumerate(steps):
+            arrays["phase"][r, s], arrays["miles"][r, s], arrays["minutes"][r, s] = phase, miles, minutes
+            arrays["idle"][r, s], arrays["charge"][r, s] = idle, charge
+    return arrays
+
+
+def _energy_rates(bus_types, am_temps, pm_temps, efficiency_table=EFFICIENCY_KWH_PER_MILE):
+    # (kWh/mile, idle kW) stacked by phase: arrays (2, routes, days)
+    per_mile = np.stack([consumption_kwh_per_mile(bus_types, am_temps, efficiency_table),
+                         consumption_kwh_per_mile(bus_types, pm_temps, efficiency_table)])
+    idle_kw = np.stack([IDLE_AUX_KW + hvac_kw(am_temps), IDLE_AUX_KW + hvac_kw(pm_temps)])
+    return per_mile, idle_kw
+
+
+def _step_use(arrays, s, per_mile, idle_kw):
+    # kWh drawn by step s for every (route, day)
+    phase, rows = arrays["phase"][:, s], np.arange(arrays["phase"].shape[0])
+    hours = arrays["minutes"][:, s, None] / 60
+    return arrays["miles"][:, s, None] * per_mile[phase, rows] + np.where(arrays["idle"][:, s, None], hours * idle_kw[phase, rows], 0.0)
+
+
+def _simulate(arrays, capacity_kwh, bus_types, am_temps, pm_temps, charge_kw=0.0, efficiency_table=EFFICIENCY_KWH_PER_MILE, record=False):
+    """
+    Steps SoC for every (route, day). capacity_kwh is nameplate per route; vehicles start
+    full and fail when SoC drops below the reserve (1 - USABLE_BATTERY_FRACTION).
+    Returns (min SoC kWh, end SoC kWh, first failing step or -1, SoC after each step if record).
+    """
+    capacity = np.asarray(capacity_kwh, dtype=float)[:, None]
+    reserve = capacity * (1 - USABLE_BATTERY_FRACTION)
+    per_mile, idle_kw = _energy_rates(bus_types, am_temps, pm_temps, efficiency_table)
+
+    soc = np.broadcast_to(capacity, per_mile.shape[1:]).copy()
+    min_soc = soc.copy()
+    fail_step = np.full(soc.shape, -1)
+    history = []
+    for s in range(arrays["miles"].shape[1]):
+        if arrays["charge"][:, s].any():
+            added = np.where(arrays["charge"][:, s, None], arrays["minutes"][:, s, None] / 60 * charge_kw * CHARGER_EFFICIENCY, 0.0)
+            soc = np.minimum(capacity, soc + added)
+        soc = soc - _step_use(arrays, s, per_mile, idle_kw)
+        newly_failed = (fail_step < 0) & ~(soc >= reserve) # NaN consumption (unknown bus type) fails too
+        fail_step[newly_failed] = s
+        min_soc = np.fmin(min_soc, soc)
+        if record: history.append(soc.copy())
+    return min_soc, soc, fail_step, (np.stack(history, axis=-1) if record and history else None)
+
+
+def route_temperatures(route_ids, route_zips, dates, climatology=None, fixed_temperature_f=None):
+    """(AM, PM) temperature arrays (routes x days): from the climatology, else fixed_temperature_f everywhere."""
+    if climatology is not None:
+        zips = [route_zips.get(rid) for rid in route_ids]
+        return (climatology.trip_temperatures(zips, dates, AM_SERVICE_HOURS),
+                climatology.trip_temperatures(zips, dates, PM_SERVICE_HOURS))
+    fixed = np.full((len(route_ids), len(dates)), np.nan if fixed_temperature_f is None else float(fixed_temperature_f))
+    return fixed, fixed.copy()
+
+
+def route_vehicles(route_ids, route_bus_types, ev_fleet, assignment_df=None, default_type="A"):
+    """
+    (vehicle label, nameplate kWh) per route: the bus assigned in Tab 3 if any (its kWh from
+    the assignment's Battery (kWh) column), otherwise the largest-battery EV of the route's
+    type (NaN kWh when the fleet has none).
+    """
+    fleet_kwh = pd.to_numeric(ev_fleet["Battery Capacity (kWh)"], errors="coerce") if ev_fleet is not None and not ev_fleet.empty else pd.Series(dtype=float)
+    best_by_type = fleet_kwh.groupby(ev_fleet["Type"]).max().dropna().to_dict() if len(fleet_kwh) else {}
+    assigned = {}
+    if assignment_df is not None and not assignment_df.empty:
+        electric = assignment_df[assignment_df["Assignment"] == "Electric"]
+        assigned = dict(zip(electric["Route ID"], zip(electric["Assigned Vehicle"], electric["Battery (kWh)"])))
+    labels, capacity = [], []
+    for rid in route_ids:
+        vehicle, vehicle_kwh = assigned.get(rid, (None, np.nan))
+        if vehicle:
+            labels.append(vehicle)
+            capacity.append(vehicle_kwh)
+        else:
+            bus_type = route_bus_types.get(rid, default_type)
+            labels.append(f"Best Type {bus_type} EV")
+            capacity.append(best_by_type.get(bus_type, np.nan))
+    return labels, np.array(capacity, dtype=float)
+
+
+def _percent(kwh, capacity):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.round(100.0 * kwh / capacity, 1)
+
+
+def simulate_fleet(results, routes, route_bus_types, ev_fleet, dates, am_temps, pm_temps,
+                   assignment_df=None, charge_kw=0.0, default_type="A"):
+    """
+    Simulates every route's vehicle on every date.
+
+    Args:
+        results: st.session_state.results (with "Leg Details" / "PM Leg Details").
+        routes: st.session_state.routes (depot/school locations for deadhead runs).
+        route_bus_types: {route_id: "A" | "C"}.
+        ev_fleet: Output of plan_logic.process_fleet_data.
+        dates: Days to simulate.
+        am_temps, pm_temps: (routes x days) °F, e.g. from route_temperatures().
+        assignment_df: Optional plan_logic.assign_vehicles output (which bus runs each route).
+        charge_kw: Depot charger power available during the midday layover (0 = none).
+
+    Returns:
+        (route summary DataFrame, DataFrame of failing route-days), or None if there are no routes.
+    """
+    rows = [r for r in results if r.get("Route ID")]
+    if not rows:
+        return None
+    dates = pd.DatetimeIndex(dates)
+    routes_by_id = {r.get("route_id"): r for r in routes or []}
+    route_ids = np.array([r.get("Route ID") for r in rows], dtype=object)
+    bus_types = np.array([route_bus_types.get(rid, default_type) for rid in route_ids], dtype=object)
+    step_lists = [route_steps(r, routes_by_id.get(rid)) for r, rid in zip(rows, route_ids)]
+    arrays = _step_arrays(step_lists)
+    labels, capacity = route_vehicles(route_ids, route_bus_types, ev_fleet, assignment_df, default_type)
+
+    min_soc, end_soc, fail_step, _ = _simulate(arrays, capacity, bus_types, am_temps, pm_temps, charge_kw)
+    failed = fail_step >= 0
+    days_failed = failed.sum(axis=1)
+    first_fail = np.where(failed.any(axis=1), np.argmax(failed, axis=1), -1)
+
+    summary = pd.DataFrame({
+        "Route ID": route_ids,
+        "Vehicle": labels,
+        "Battery (kWh)": capacity,
+        "Deadhead (mi)": np.round([sum(s[2] for s in steps if s[0].startswith("Deadhead")) for steps in step_lists], 2),
+        "Lowest SoC (%)": _percent(np.min(min_soc, axis=1), capacity) if len(dates) else np.nan,
+        "Days Simulated": len(dates),
+        "Days Failed": days_failed,
+        "First Failure Date": [dates[i].strftime("%Y-%m-%d") if i >= 0 else "None" for i in first_fail],
+    })
+    fail_r, fail_d = np.nonzero(failed)
+    failures = pd.DataFrame({
+        "Route ID": route_ids[fail_r],
+        "Date": dates[fail_d].strftime("%Y-%m-%d"),
+        "Fails During": [step_lists[r][fail_step[r, d]][0] for r, d in zip(fail_r, fail_d)],
+        "Lowest SoC (%)": _percent(min_soc[fail_r, fail_d], capacity[fail_r]),
+        "End SoC (%)": _percent(end_soc[fail_r, fail_d], capacity[fail_r]),
+    })
+    return summary, failures
+
+
+def _start_time(result):
+    # AM depot departure as a datetime.time: the suggested departure, else DEFAULT_AM_DEPARTURE
+    departure = result.get("Suggested Depot Departure Time")
+    if departure:
+        try: return datetime.datetime.strptime(departure, "%I:%M %p").time()
+        except (TypeError, ValueError): pass
+    return DEFAULT_AM_DEPARTURE
+
+
+def day_profiles(results, routes, route_bus_types, am_temp_f, pm_temp_f, default_type="A"):
+    """
+    One typical day per route for depot charging: DataFrame with Route ID, Depot (point key
+    or None), Departure / Return (minutes after midnight) and Energy Used (kWh), with no
+    midday charging.
+    """
+    rows = [r for r in results if r.get("Route ID")]
+    routes_by_id = {r.get("route_id"): r for r in routes or []}
+    route_ids = [r.get("Route ID") for r in rows]
+    bus_types = np.array([route_bus_types.get(rid, default_type) for rid in route_ids], dtype=object)
+    step_lists = [route_steps(r, routes_by_id.get(rid)) for r, rid in zip(rows, route_ids)]
+    arrays = _step_arrays(step_lists)
+    per_mile, idle_kw = _energy_rates(bus_types, np.full((len(rows), 1), float(am_temp_f)), np.full((len(rows), 1), float(pm_temp_f)))
+    energy = sum((_step_use(arrays, s, per_mile, idle_kw) for s in range(arrays["miles"].shape[1])), np.zeros((len(rows), 1)))[:, 0]
+    departure = np.array([_start_time(r).hour * 60 + _start_time(r).minute for r in rows], dtype=float)
+    return pd.DataFrame({
+        "Route ID": route_ids,
+        "Depot": [depot_key(routes_by_id.get(rid)) for rid in route_ids],
+        "Departure (min)": departure,
+        "Return (min)": departure + arrays["minutes"].sum(axis=1),
+        "Energy Used (kWh)": energy,
+    })
+
+
+def soc_timeline(result, route, bus_type, capacity_kwh, am_temp, pm_temp, charge_kw=0.0):
+    """
+    Step-by-step SoC for one vehicle on one day: DataFrame with Time, Event, Miles,
+    Minutes, SoC (kWh), SoC (%) and the reserve line, starting with the full battery.
+    """
+    steps = route_steps(result, route)
+    arrays = _step_arrays([steps])
+    _, _, _, history = _simulate(arrays, [capacity_kwh], np.array([bus_type], dtype=object),
+                                 np.array([[am_temp]], dtype=float), np.array([[pm_temp]], dtype=float), charge_kw, record=True)
+    soc = [float(capacity_kwh)] + ([] if history is None else history[0, 0].tolist())
+    clock = datetime.datetime.combine(datetime.date.today(), _start_time(result))
+    times, events, miles, minutes = [clock.strftime("%H:%M")], ["Depart Depot"], [0.0], [0.0]
+    for event, _, step_miles, step_minutes, _, _ in steps:
+        clock += datetime.timedelta(minutes=step_minutes)
+        times.append(clock.strftime("%H:%M")); events.append(event); miles.append(round(step_miles, 2)); minutes.append(round(step_minutes, 1))
+    soc = np.array(soc)
+    return pd.DataFrame({
+        "Time": times, "Event": events, "Miles": miles, "Minutes": minutes,
+        "SoC (kWh)": np.round(soc, 1), "SoC (%)": _percent(soc, capacity_kwh),
+        "Reserve (%)": round(100 * (1 - USABLE_BATTERY_FRACTION), 1),
+    })
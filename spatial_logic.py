@@ -0,0 +1,574 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from shapely.errors import GEOSException
+
+# Spatial helpers shared by app.py. Nothing in here touches Streamlit so the
+# same objects can be built once in load_spatial_data and reused everywhere.
+
+SPATIAL_STORE_DIR = os.path.join(".cache", "spatial")
+STORE_FORMAT_VERSION = 2 # 2: ZIP store is ZIP-sorted int32/float32
+NEAREST_CHUNK_POINTS = 64 # Points per nearest_zips block (64 x ~33k centroids of float64 work arrays)
+
+
+class DACIndex:
+    """
+    STRtree-backed index over the (already validated) DAC polygons.
+    A route line query only touches the polygons whose envelopes it hits,
+    and the polygons are prepared so the intersects test is cheap.
+
+    Args:
+        geometries: Iterable of shapely (Multi)Polygons, in GeoDataFrame order.
+    """
+
+    def __init__(self, geometries):
+        self.geometries = np.asarray(list(geometries), dtype=object)
+        self._build()
+
+    def _build(self):
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+        self.geometries.flags.writeable = False # Shared across sessions, never mutated
+
+    # Prepared state is not kept by pickle (st.cache_data pickles return values),
+    # so rebuild it on load instead of shipping the tree around.
+    def __getstate__(self):
+        return {"geometries": self.geometries}
+
+    def __setstate__(self, state):
+        self.geometries = state["geometries"]
+        self._build()
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def candidates(self, geom):
+        """Indices (ascending) of DAC polygons that actually intersect geom."""
+        idx = self.tree.query(geom, predicate="intersects")
+        return np.sort(idx)
+
+    def intersection_length(self, line, on_error=None):
+        """
+        Total length of line that falls inside DAC polygons.
+        Mirrors the old per-polygon loop: only LineString/MultiLineString pieces
+        count, summed in polygon order so the result is identical, and a polygon
+        whose intersection fails is skipped (on_error(exception) is called for it).
+        """
+        idx = self.candidates(line)
+        if len(idx) == 0:
+            return 0.0
+        try:
+            pieces = shapely.intersection(line, self.geometries[idx])
+        except GEOSException:
+            # One bad polygon fails the whole vectorized call; redo them one by one
+            pieces = np.array([self._intersection_or_none(line, geom, on_error) for geom in self.geometries[idx]], dtype=object)
+        type_ids = shapely.get_type_id(pieces)
+        # 1 = LineString, 5 = MultiLineString
+        keep = (type_ids == 1) | (type_ids == 5)
+        total = 0.0
+        for length in shapely.length(pieces[keep]):
+            total += length
+        return total
+
+    @staticmethod
+    def _intersection_or_none(line, geom, on_error):
+        try:
+            return shapely.intersection(line, geom)
+        except GEOSException as error:
+            if on_error: on_error(error)
+            return None
+
+
+def build_dac_index(dac_gdf):
+    """Builds a DACIndex from the DAC GeoDataFrame, or None if there is nothing to index."""
+    if dac_gdf is None or dac_gdf.empty:
+        return None
+    return DACIndex(dac_gdf.geometry.values)
+
+
+# --- Decoded route geometry, memoized per encoded polyline ---
+
+class RouteGeometry:
+    """
+    A decoded route polyline: coords is a read-only (N, 2) float64 array of (lat, lng),
+    line the shapely LineString in (lng, lat) order (None if fewer than 2 points).
+    locations is the [[lat, lng], ...] list folium wants, built on first use.
+    """
+    __slots__ = ("coords", "line", "_locations")
+
+    def __init__(self, coords):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.coords.flags.writeable = False
+        self.line = shapely.linestrings(self.coords[:, ::-1]) if len(self.coords) >= 2 else None
+        self._locations = None
+
+    @property
+    def locations(self):
+        if self._locations is None: self._locations = self.coords.tolist()
+        return self._locations
+
+
+class GeometryCache:
+    """
+    Encoded polyline -> RouteGeometry, so each route line is decoded and built once
+    (when results are computed) and reused by the DAC overlap and the Tab 4 map.
+    Keyed by the polyline text itself, so identical trips share one entry.
+    Reads and inserts are safe from worker threads (a duplicate decode is harmless).
+    """
+
+    def __init__(self):
+        self._geometries = {}
+        self._simplified = {} # (encoded, tolerance) -> simplified (N, 2) (lat, lng) array
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def get(self, encoded):
+        """RouteGeometry for an encoded polyline, or None if it is empty. Raises ValueError/IndexError if undecodable."""
+        if not encoded or not isinstance(encoded, str): return None
+        geometry = self._geometries.get(encoded)
+        if geometry is not None:
+            self.hits += 1
+            return geometry
+        self.misses += 1
+        import polyline
+        geometry = RouteGeometry(polyline.decode(encoded))
+        self._geometries[encoded] = geometry
+        return geometry
+
+    def add_results(self, results, polyline_keys=("AM Overview Polyline", "PM Overview Polyline")):
+        """Decodes every polyline in results up front and drops entries no result uses any more."""
+        keep = set()
+        for result in results:
+            for key in polyline_keys:
+                encoded = result.get(key)
+                if not encoded: continue
+                try:
+                    self.get(encoded); keep.add(encoded)
+                except (ValueError, IndexError):
+                    continue # Undecodable polylines are reported where they are used
+        self._geometries = {k: v for k, v in self._geometries.items() if k in keep}
+        self._simplified = {k: v for k, v in self._simplified.items() if k[0] in keep}
+
+    def simplified(self, encoded_polylines, tolerance):
+        """
+        Douglas-Peucker simplified (lat, lng) arrays for many polylines (tolerance in degrees),
+        memoized per tolerance; all misses are simplified in one vectorized shapely call.
+        Empty or undecodable polylines give None.
+        """
+        tolerance = float(tolerance)
+        missing = []
+        for encoded in dict.fromkeys(encoded_polylines):
+            if (encoded, tolerance) in self._simplified: continue
+            try: geometry = self.get(encoded)
+            except (ValueError, IndexError): geometry = None
+            if geometry is None or geometry.line is None:
+                self._simplified[(encoded, tolerance)] = geometry.coords if geometry is not None else None
+            else:
+                missing.append((encoded, geometry.line))
+        if missing:
+            lines = shapely.simplify(np.array([line for _, line in missing], dtype=object), tolerance, preserve_topology=False)
+            for (encoded, _), line in zip(missing, lines):
+                coords = shapely.get_coordinates(line)[:, ::-1].copy()
+                coords.flags.writeable = False
+                self._simplified[(encoded, tolerance)] = coords
+        return [self._simplified.get((encoded, tolerance)) for encoded in encoded_polylines]
+
+
+# --- Memory report for the shared, process-wide datasets ---
+
+def _geometry_nbytes(geometries):
+    # GEOS memory isn't visible to Python: 16 bytes per 2D coordinate plus a per-geometry overhead
+    geometries = np.asarray(geometries, dtype=object)
+    if len(geometries) == 0: return 0
+    return int(shapely.get_num_coordinates(geometries).sum() * 16 + len(geometries) * 64)
+
+
+def estimate_nbytes(obj, _seen=None):
+    """Approximate bytes held by a dataset (DataFrame, GeoDataFrame, DACIndex, dict, arrays)."""
+    if _seen is None: _seen = set()
+    if obj is None or id(obj) in _seen: return 0
+    _seen.add(id(obj))
+    if isinstance(obj, ZipIndex):
+        return int(obj.zips.nbytes + obj.latitude.nbytes + obj.longitude.nbytes + obj._lat_rad.nbytes + obj._lon_rad.nbytes + obj._cos_lat.nbytes)
+    if isinstance(obj, GeometryCache):
+        return (sum(g.coords.nbytes + _geometry_nbytes([g.line]) if g.line is not None else g.coords.nbytes for g in obj._geometries.values())
+                + sum(c.nbytes for c in obj._simplified.values() if c is not None))
+    if isinstance(obj, ZipAreaIndex):
+        return _geometry_nbytes(obj.geometries) + obj.geometries.nbytes + obj.codes.nbytes + obj.labels.nbytes + len(obj) * 32
+    if isinstance(obj, DACIndex):
+        return _geometry_nbytes(obj.geometries) + obj.geometries.nbytes + len(obj) * 32 # + tree nodes
+    if hasattr(obj, "geometry") and isinstance(obj, pd.DataFrame):
+        attrs = obj.drop(columns=[obj.geometry.name]).memory_usage(deep=True).sum()
+        return int(attrs + _geometry_nbytes(obj.geometry.values))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if hasattr(obj, "items"):
+        return sys.getsizeof(obj) + sum(estimate_nbytes(k, _seen) + estimate_nbytes(v, _seen) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_nbytes(v, _seen) for v in obj)
+    return sys.getsizeof(obj)
+
+
+def memory_report(datasets):
+    """DataFrame of approximate bytes per named dataset, e.g. memory_report({'zip_index': zip_index})."""
+    rows = [{"Dataset": name, "Bytes": estimate_nbytes(obj), "Shared Object ID": hex(id(obj)) if obj is not None else "N/A"} for name, obj in datasets.items()]
+    report = pd.DataFrame(rows)
+    report["MB"] = (report["Bytes"] / (1024 * 1024)).round(2)
+    return report
+
+
+# --- Precompiled binary stores ---
+# The CSV sources are converted once into plain .npy arrays (WKB blob + offsets
+# for geometries, fixed-width columns for attributes). Loading memory-maps the
+# arrays, so workers skip WKT parsing and share the file pages via the OS cache.
+# A store is rebuilt whenever its source file's size or mtime changes; without
+# the source file, an existing store of the current format is used as is.
+
+def _source_signature(source_path):
+    stat = os.stat(source_path)
+    return {"source": os.path.basename(source_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "version": STORE_FORMAT_VERSION}
+
+
+def store_is_fresh(store_dir, source_path):
+    """
+    True if store_dir holds a complete store built from the current source_path.
+    When source_path is missing (deployments may ship only the store), any complete
+    store of the current format counts as fresh.
+    """
+    try:
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    signature = meta.get("signature") or {}
+    try:
+        return signature == _source_signature(source_path)
+    except OSError: # No source to compare against
+        return signature.get("version") == STORE_FORMAT_VERSION
+
+
+def write_array_store(store_dir, arrays, source_path, geometries=None):
+    """
+    Writes named NumPy arrays (and optionally geometries as WKB) to store_dir.
+    meta.json is written last, so a half-written store is never considered fresh.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    arrays = dict(arrays)
+    if geometries is not None:
+        wkb = shapely.to_wkb(np.asarray(geometries, dtype=object))
+        lengths = np.fromiter((len(b) for b in wkb), dtype=np.int64, count=len(wkb))
+        arrays["wkb_offsets"] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        arrays["wkb_blob"] = np.frombuffer(b"".join(wkb), dtype=np.uint8)
+    for name, array in arrays.items():
+        tmp_path = os.path.join(store_dir, f".{name}.{os.getpid()}.npy")
+        np.save(tmp_path, np.asarray(array), allow_pickle=False)
+        os.replace(tmp_path, os.path.join(store_dir, f"{name}.npy"))
+    meta = {"signature": _source_signature(source_path), "arrays": sorted(arrays)}
+    tmp_meta = os.path.join(store_dir, f".meta.{os.getpid()}.json")
+    with open(tmp_meta, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta, os.path.join(store_dir, "meta.json"))
+
+
+def read_array_store(store_dir, mmap=True):
+    """
+    Reads a store written by write_array_store. Returns (arrays, geometries or None).
+    Arrays are memory-mapped read-only when mmap is True.
+    """
+    with open(os.path.join(store_dir, "meta.json")) as f:
+        meta = json.load(f)
+    mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode=mode, allow_pickle=False) for name in meta["arrays"]}
+    geometries = None
+    if "wkb_blob" in arrays:
+        blob, offsets = arrays.pop("wkb_blob"), arrays.pop("wkb_offsets")
+        # One copy of the blob, cheap bytes slices, then a single vectorized decode of the whole array
+        data, bounds = blob.tobytes(), offsets.tolist()
+        wkb = np.empty(len(bounds) - 1, dtype=object)
+        wkb[:] = [data[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        geometries = shapely.from_wkb(wkb)
+    return arrays, geometries
+
+
+def build_dac_store(csv_path, store_dir):
+    """
+    Parses the DAC CSV once (DAC-designated rows, WKT -> geometry, valid only)
+    and writes GEOIDs + WKB geometries to store_dir.
+    Raises ValueError if required columns are missing.
+    """
+    dac_locs_raw = pd.read_csv(csv_path)
+    required_dac_cols = ['the_geom', 'GEOID', 'DAC_Designation']
+    missing = [c for c in required_dac_cols if c not in dac_locs_raw.columns]
+    if missing:
+        raise ValueError(f"DAC file '{csv_path}' missing required columns: {missing}")
+    dac_locs = dac_locs_raw[dac_locs_raw['DAC_Designation'] == 'Designated as DAC']
+    wkt_strings = dac_locs['the_geom'].astype(object).where(dac_locs['the_geom'].notna(), None).to_numpy(dtype=object)
+    geoms = shapely.from_wkt(wkt_strings, on_invalid="ignore") # Unparseable -> None, like safe_wkt_load
+    keep = ~shapely.is_missing(geoms)
+    keep[keep] = shapely.is_valid(geoms[keep])
+    write_array_store(store_dir, {"GEOID": dac_locs['GEOID'].astype(str).to_numpy()[keep].astype("U")}, csv_path, geometries=geoms[keep])
+
+
+def load_dac_geometries(csv_path, store_dir=os.path.join(SPATIAL_STORE_DIR, "dac")):
+    """Returns (GEOID array, geometry array) from the binary store, rebuilding it from csv_path if stale."""
+    if not store_is_fresh(store_dir, csv_path):
+        build_dac_store(csv_path, store_dir)
+    arrays, geometries = read_array_store(store_dir)
+    return arrays["GEOID"], geometries
+
+
+def build_zip_store(csv_path, store_dir):
+    """
+    Converts the ZIP centroid CSV (zip, lat, lng) into ZIP-sorted arrays: int32 zip,
+    float32 latitude/longitude. Non-numeric ZIPs are dropped.
+    Raises ValueError if required columns are missing.
+    """
+    zipcodes_df = pd.read_csv(csv_path, dtype={'zip': str}, usecols=lambda c: c in ('zip', 'lat', 'lng'))
+    missing = [c for c in ['zip', 'lat', 'lng'] if c not in zipcodes_df.columns]
+    if missing:
+        raise ValueError(f"Zipcode file '{csv_path}' missing required columns: {', '.join(missing)}")
+    zips = pd.to_numeric(zipcodes_df['zip'].astype(str).str.strip(), errors='coerce')
+    zipcodes_df = zipcodes_df[zips.notna() & zipcodes_df['lat'].notna() & zipcodes_df['lng'].notna()].assign(zip=zips.astype('Int64'))
+    zipcodes_df = zipcodes_df.drop_duplicates('zip').sort_values('zip')
+    write_array_store(store_dir, {
+        "zip": zipcodes_df['zip'].to_numpy(dtype=np.int32),
+        "latitude": zipcodes_df['lat'].to_numpy(dtype=np.float32),
+        "longitude": zipcodes_df['lng'].to_numpy(dtype=np.float32),
+    }, csv_path)
+
+
+def load_zip_arrays(csv_path, store_dir=os.path.join(SPATIAL_STORE_DIR, "zip")):
+    """Returns {'zip', 'latitude', 'longitude'} arrays from the binary store, rebuilding it if stale."""
+    if not store_is_fresh(store_dir, csv_path):
+        build_zip_store(csv_path, store_dir)
+    arrays, _ = read_array_store(store_dir)
+    return arrays
+
+
+def load_zip_index(csv_path, store_dir=os.path.join(SPATIAL_STORE_DIR, "zip")):
+    """ZipIndex over the memory-mapped ZIP store (see load_zip_arrays)."""
+    arrays = load_zip_arrays(csv_path, store_dir)
+    return ZipIndex(arrays["zip"], arrays["latitude"], arrays["longitude"])
+
+
+class ZipIndex:
+    """
+    Array-backed ZIP centroid index: sorted int32 ZIP codes and float32 lat/lon
+    (about 12 bytes per ZIP instead of a dict per ZIP). Exact and prefix lookups
+    are binary searches; nearest() is a vectorized great-circle scan.
+
+    Args:
+        zips: ZIP codes as integers (sorted here if not already).
+        latitude, longitude: Centroids in the same order.
+    """
+
+    def __init__(self, zips, latitude, longitude):
+        zips = np.asarray(zips, dtype=np.int32)
+        latitude = np.asarray(latitude, dtype=np.float32)
+        longitude = np.asarray(longitude, dtype=np.float32)
+        if len(zips) > 1 and np.any(zips[1:] < zips[:-1]):
+            order = np.argsort(zips, kind="stable")
+            zips, latitude, longitude = zips[order], latitude[order], longitude[order]
+        self.zips, self.latitude, self.longitude = zips, latitude, longitude
+        # Precomputed for nearest(): radians and cos(lat)
+        self._lat_rad = np.radians(latitude)
+        self._lon_rad = np.radians(longitude)
+        self._cos_lat = np.cos(self._lat_rad)
+
+    def __len__(self):
+        return len(self.zips)
+
+    @staticmethod
+    def _to_int(zip_code):
+        # "501", "00501", 501 -> 501; None for anything that isn't a 1-5 digit ZIP
+        text = str(zip_code).strip()
+        if not text.isdigit() or len(text) > 5: return None
+        return int(text)
+
+    def _position(self, zip_code):
+        value = self._to_int(zip_code)
+        if value is None: return -1
+        i = int(np.searchsorted(self.zips, value))
+        return i if i < len(self.zips) and self.zips[i] == value else -1
+
+    def __contains__(self, zip_code):
+        return self._position(zip_code) >= 0
+
+    def lookup(self, zip_code):
+        """(lat, lon) centroid of a ZIP code, or None if unknown."""
+        i = self._position(zip_code)
+        if i < 0: return None
+        return float(self.latitude[i]), float(self.longitude[i])
+
+    def with_prefix(self, prefix, limit=None):
+        """ZIP strings starting with prefix (e.g. '104' -> 10451, 10452, ...), in order."""
+        prefix = str(prefix).strip()
+        if not prefix.isdigit() or len(prefix) > 5: return []
+        scale = 10 ** (5 - len(prefix))
+        lo, hi = np.searchsorted(self.zips, [int(prefix) * scale, (int(prefix) + 1) * scale])
+        if limit is not None: hi = min(hi, lo + limit)
+        return [f"{z:05d}" for z in self.zips[lo:hi]]
+
+    def _distances_m(self, lat, lon):
+        lat, lon = np.radians(lat), np.radians(lon)
+        a = np.sin((self._lat_rad - lat) / 2) ** 2 + np.cos(lat) * self._cos_lat * np.sin((self._lon_rad - lon) / 2) ** 2
+        return 6371008.8 * 2 * np.arcsin(np.sqrt(a))
+
+    def nearest(self, lat, lon, k=1):
+        """The k closest ZIP centroids to a point: list of (zip string, distance in meters)."""
+        if len(self.zips) == 0: return []
+        distances = self._distances_m(lat, lon)
+        k = min(k, len(distances))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best])]
+        return [(f"{self.zips[i]:05d}", float(distances[i])) for i in best]
+
+    def nearest_zips(self, lats, lons, chunk_points=NEAREST_CHUNK_POINTS):
+        """
+        Closest ZIP string for every point (bulk reverse lookup): one argmin over a
+        points x centroids haversine block per chunk_points points.
+        """
+        lats = np.radians(np.asarray(lats, dtype=float))
+        lons = np.radians(np.asarray(lons, dtype=float))
+        if len(self.zips) == 0: return [None] * len(lats)
+        result = []
+        for start in range(0, len(lats), chunk_points):
+            lat = lats[start:start + chunk_points, None]
+            lon = lons[start:start + chunk_points, None]
+            # The haversine term grows with distance, so its argmin is the nearest centroid
+            a = np.sin((self._lat_rad - lat) / 2) ** 2 + np.cos(lat) * self._cos_lat * np.sin((self._lon_rad - lon) / 2) ** 2
+            result.extend(f"{z:05d}" for z in self.zips[np.argmin(a, axis=1)])
+        return result
+
+
+# --- MODZCTA (NYC ZIP area) polygons: offline point -> ZIP labels ---
+
+def build_modzcta_store(csv_path, store_dir):
+    """
+    Parses the MODZCTA CSV (MODZCTA, label, the_geom WKT) once and writes the codes,
+    labels and WKB polygons to store_dir. Invalid geometries are repaired with make_valid.
+    Raises ValueError if required columns are missing.
+    """
+    raw = pd.read_csv(csv_path, dtype={'MODZCTA': str, 'label': str})
+    missing = [c for c in ['MODZCTA', 'the_geom'] if c not in raw.columns]
+    if missing:
+        raise ValueError(f"MODZCTA file '{csv_path}' missing required columns: {', '.join(missing)}")
+    wkt_strings = raw['the_geom'].astype(object).where(raw['the_geom'].notna(), None).to_numpy(dtype=object)
+    geoms = shapely.from_wkt(wkt_strings, on_invalid="ignore")
+    keep = ~shapely.is_missing(geoms)
+    geoms = geoms[keep]
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any(): geoms[invalid] = shapely.make_valid(geoms[invalid])
+    codes = raw['MODZCTA'].astype(str).str.strip().to_numpy()[keep]
+    labels = raw['label'].fillna(raw['MODZCTA']).astype(str).to_numpy()[keep] if 'label' in raw.columns else codes
+    write_array_store(store_dir, {"modzcta": codes.astype("U"), "label": labels.astype("U")}, csv_path, geometries=geoms)
+
+
+class ZipAreaIndex:
+    """
+    STRtree over MODZCTA polygons. label_points() answers "which ZIP area is each
+    point in" for any number of points with one vectorized tree query.
+
+    Args:
+        codes: MODZCTA code per polygon.
+        labels: Display label per polygon (e.g. "10001, 10118").
+        geometries: shapely (Multi)Polygons in lon/lat.
+    """
+
+    def __init__(self, codes, labels, geometries):
+        self.codes = np.asarray(codes)
+        self.labels = np.asarray(labels)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self._build()
+
+    def _build(self):
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+        self.geometries.flags.writeable = False # Shared across sessions, never mutated
+
+    def __getstate__(self):
+        return {"codes": self.codes, "labels": self.labels, "geometries": self.geometries}
+
+    def __setstate__(self, state):
+        self.codes, self.labels, self.geometries = state["codes"], state["labels"], state["geometries"]
+        self._build()
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def label_points(self, lats, lons):
+        """
+        MODZCTA code for every (lat, lon) point, or None where a point lies outside all
+        areas. Points on a shared border get the lowest-numbered polygon.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        result = np.full(len(lats), None, dtype=object)
+        if len(lats) == 0 or len(self.geometries) == 0: return result.tolist()
+        point_idx, area_idx = self.tree.query(shapely.points(lons, lats), predicate="intersects")
+        order = np.lexsort((area_idx, point_idx))
+        point_idx, area_idx = point_idx[order], area_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+        result[point_idx[first]] = self.codes[area_idx[first]]
+        return result.tolist()
+
+    def label_point(self, lat, lon):
+        return self.label_points([lat], [lon])[0]
+
+
+def load_zip_areas(csv_path, store_dir=os.path.join(SPATIAL_STORE_DIR, "modzcta")):
+    """ZipAreaIndex from the MODZCTA binary store, rebuilding it from csv_path if stale."""
+    if not store_is_fresh(store_dir, csv_path):
+        build_modzcta_store(csv_path, store_dir)
+    arrays, geometries = read_array_store(store_dir)
+    return ZipAreaIndex(arrays["modzcta"], arrays["label"], geometries)
+
+
+def stop_locations(route):
+    """(lat, lng) of a route's depot, pickups and dropoffs in that order (None where missing)."""
+    stops = [route.get("depot")] + [p.get("location") for p in route.get("pickups", [])] + [d.get("location") for d in route.get("dropoffs", [])]
+    return [tuple(loc) if isinstance(loc, (list, tuple)) and len(loc) == 2 else None for loc in stops]
+
+
+def label_route_stops(routes, zip_areas, zip_index=None, memo=None):
+    """
+    ZIP label for every stop of every route (stop_locations order), from one bulk query.
+    Stops outside the MODZCTA areas fall back to the nearest ZIP centroid in zip_index.
+    memo (e.g. a dict in st.session_state) keeps the labels per route's stop locations
+    across calls, so only new or moved routes are queried; entries for routes that are
+    gone are dropped.
+    Returns a list (per route) of lists of ZIP strings / None.
+    """
+    memo = {} if memo is None else memo
+    per_route = [tuple(stop_locations(route)) for route in routes]
+    missing = list(dict.fromkeys(locs for locs in per_route if locs not in memo))
+    flat = [loc for locs in missing for loc in locs if loc is not None]
+    labels = zip_areas.label_points([p[0] for p in flat], [p[1] for p in flat]) if zip_areas is not None else [None] * len(flat)
+    unlabeled = [i for i, label in enumerate(labels) if label is None]
+    if unlabeled and zip_index is not None and len(zip_index):
+        nearest = zip_index.nearest_zips([flat[i][0] for i in unlabeled], [flat[i][1] for i in unlabeled])
+        for i, zip_code in zip(unlabeled, nearest): labels[i] = zip_code
+    labels = iter(labels)
+    for locs in missing: memo[locs] = [next(labels) if loc is not None else None for loc in locs]
+    for stale in set(memo) - set(per_route): del memo[stale]
+    return [list(memo[locs]) for locs in per_route]
+
+if __name__ == "__main__":
+    # Build step for deployments: python spatial_logic.py [dac_csv] [zip_csv] [modzcta_csv]
+    dac_csv = sys.argv[1] if len(sys.argv) > 1 else ".data/dac_file.csv"
+    zip_csv = sys.argv[2] if len(sys.argv) > 2 else ".data/uszips.csv"
+    modzcta_csv = sys.argv[3] if len(sys.argv) > 3 else ".data/Modified_Zip_Code_Tabulation_Areas__MODZCTA_.csv"
+    build_dac_store(dac_csv, os.path.join(SPATIAL_STORE_DIR, "dac"))
+    build_zip_store(zip_csv, os.path.join(SPATIAL_STORE_DIR, "zip"))
+    build_modzcta_store(modzcta_csv, os.path.join(SPATIAL_STORE_DIR, "modzcta"))
+    print(f"Spatial stores written to {SPATIAL_STORE_DIR}")
@@ -0,0 +1,69 @@
+import cache_logic
+from cache_logic import ResponseCache, make_cache_key
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0): self.now = now
+    def __call__(self): return self.now
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_logic.time, "time", clock)
+    cache = ResponseCache(str(tmp_path / "c.sqlite"), ttl_seconds=60)
+    cache.set("a", {"x": 1})
+    cache.set("short", {"x": 2}, ttl_seconds=10)
+    clock.now += 30
+    assert cache.get("a") == {"x": 1}
+    assert cache.get("short") is None # Per-entry TTL overrides the cache-wide one
+    clock.now += 31
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 0)
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_logic.time, "time", clock)
+    cache = ResponseCache(str(tmp_path / "c.sqlite"), ttl_seconds=None, max_entries=2)
+    cache.set("a", 1); clock.now += 1
+    cache.set("b", 2); clock.now += 1
+    assert cache.get("a") == 1 # "b" is now the least recently used
+    clock.now += 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_eviction_trims_to_the_low_water_mark(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_logic.time, "time", clock)
+    cache = ResponseCache(str(tmp_path / "c.sqlite"), ttl_seconds=None, max_entries=10)
+    for i in range(11):
+        cache.set(f"k{i}", i); clock.now += 1
+    assert cache.stats()["entries"] == 9 # Trimmed to 90%, the two oldest dropped
+    assert cache.get("k0") is None and cache.get("k1") is None and cache.get("k2") == 2
+    cache.set("k11", 11)
+    assert cache.stats()["entries"] == 10 # Back under the limit: no eviction on this write
+
+
+def test_byte_limit_evicts_oldest_entries(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_logic.time, "time", clock)
+    cache = ResponseCache(str(tmp_path / "c.sqlite"), ttl_seconds=None, max_bytes=100)
+    for i in range(5):
+        cache.set(f"k{i}", "x" * 28); clock.now += 1 # 30 bytes of JSON each
+    # 150 bytes > 100: drop oldest until at most 90 bytes remain
+    assert cache.stats()["bytes"] == 90
+    assert cache.get("k1") is None and cache.get("k2") is not None
+
+
+def test_cache_is_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "nested" / "c.sqlite")
+    ResponseCache(path).set("k", [1, 2])
+    assert ResponseCache(path).get("k") == [1, 2]
+
+
+def test_make_cache_key_ignores_dict_order():
+    assert make_cache_key("directions", {"a": 1, "b": 2}) == make_cache_key("directions", {"b": 2, "a": 1})
+    assert make_cache_key("directions", {"a": 1}) != make_cache_key("geocode", {"a": 1})
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from charging_logic import charging_sessions, default_depot_settings, electric_depots, plan_charging, schedule_depot, unmanaged_peak_kw
+
+
+def make_profiles():
+    return pd.DataFrame({
+        "Route ID": ["101", "102", "103"],
+        "Depot": [(40.7, -74.0)] * 3,
+        "Departure (min)": [390.0, 400.0, 410.0],
+        "Return (min)": [960.0, 970.0, 980.0],
+        "Energy Used (kWh)": [90.0, 120.0, 60.0],
+    })
+
+
+def make_assignment():
+    return pd.DataFrame({"Route ID": ["101", "102", "103"], "Assignment": ["Electric", "Electric", "Diesel - Vehicles Exhausted"],
+                         "Assigned Vehicle": ["Lion C #1", "Lion C #2", None]})
+
+
+def test_sessions_only_for_assigned_electric_buses():
+    sessions = charging_sessions(make_profiles(), make_assignment())
+    assert sessions["Route ID"].tolist() == ["101", "102"]
+    assert sessions["Ready By (min)"].tolist() == [390.0 + 1440, 400.0 + 1440]
+    assert charging_sessions(make_profiles(), None).empty
+
+
+def test_schedule_depot_meets_energy_and_charger_limits():
+    sessions = charging_sessions(make_profiles(), make_assignment())
+    power, shortfall = schedule_depot(sessions, chargers=1, charger_kw=19.2)
+    assert np.allclose(shortfall, 0)
+    assert np.allclose(power.sum(axis=1) * 0.25, sessions["Energy Needed (kWh)"])
+    assert ((power > 1e-6).sum(axis=0) <= 1).all() # One charger: never two buses at once
+    assert power.sum(axis=0).max() <= unmanaged_peak_kw(sessions) + 1e-9
+
+
+def test_grid_cap_leaves_shortfall_when_too_tight():
+    sessions = charging_sessions(make_profiles(), make_assignment())
+    _, shortfall = schedule_depot(sessions, chargers=2, charger_kw=19.2, grid_cap_kw=2.0)
+    assert shortfall.sum() > 0
+
+
+def test_load_profile_hours_are_ordered_across_midnight():
+    sessions = charging_sessions(make_profiles(), make_assignment())
+    settings = pd.DataFrame({"Depot": sessions["Depot"].unique(), "Chargers": 2, "Charger kW": 19.2, "Grid Cap (kW)": 0.0})
+    summary, schedule, load = plan_charging(sessions, settings)
+    assert load["Hour"].is_monotonic_increasing and load["Hour"].iloc[-1] > 24
+    assert summary.at[0, "Buses Short"] == 0 and len(schedule) == 2
+
+
+def test_electric_depots_match_session_depots():
+    routes = [{"route_id": rid, "depot": [40.7, -74.0]} for rid in ["101", "102", "103"]]
+    profiles = make_profiles().assign(Depot=[(40.7, -74.0)] * 3)
+    depots = electric_depots(routes, make_assignment())
+    sessions = charging_sessions(profiles, make_assignment())
+    assert depots["Depot"].tolist() == sessions["Depot"].tolist()
+    assert default_depot_settings(depots)["Chargers"].tolist() == [2]
+    assert electric_depots(routes, None).empty
+
+
+def test_charger_per_bus_spreads_energy_to_lower_the_peak():
+    sessions = charging_sessions(make_profiles(), make_assignment())
+    power, shortfall = schedule_depot(sessions, chargers=2, charger_kw=19.2)
+    assert np.allclose(shortfall, 0)
+    assert np.allclose(power.sum(axis=1) * 0.25, sessions["Energy Needed (kWh)"])
+    # 210 kWh over a ~14.5 h overnight window: both buses together stay under one charger at full power
+    assert power.sum(axis=0).max() < 19.2
@@ -0,0 +1,55 @@
+import threading
+import time
+
+import concurrency_logic
+from concurrency_logic import DeferredMessages, TokenBucket, run_ordered
+
+
+class Recorder:
+    def __init__(self): self.calls = []
+    def warning(self, body, **kwargs): self.calls.append(("warning", body, kwargs))
+    def error(self, body, **kwargs): self.calls.append(("error", body, kwargs))
+    def info(self, body, **kwargs): self.calls.append(("info", body, kwargs))
+
+
+def test_run_ordered_returns_results_in_input_order():
+    # Later items finish first; results and callbacks still follow input order
+    def slow_square(n):
+        time.sleep(0.01 * (5 - n))
+        return n * n
+
+    seen = []
+    results = run_ordered(slow_square, range(5), max_workers=4,
+                          on_result=lambda i, r: seen.append((i, r, threading.current_thread())))
+    assert results == [0, 1, 4, 9, 16]
+    assert [(i, r) for i, r, _ in seen] == list(enumerate(results))
+    assert all(thread is threading.main_thread() for _, _, thread in seen)
+    assert run_ordered(slow_square, range(5), max_workers=1) == results
+
+
+def test_deferred_messages_replay_in_order_once():
+    ui = DeferredMessages()
+    ui.warning("first", icon="⚠️")
+    ui.error("second")
+    ui.info("third")
+    st = Recorder()
+    ui.replay(st)
+    assert st.calls == [("warning", "first", {"icon": "⚠️"}), ("error", "second", {}), ("info", "third", {})]
+    ui.replay(st)
+    assert len(st.calls) == 3
+
+
+def test_token_bucket_paces_after_the_burst(monkeypatch):
+    clock = {"now": 0.0}
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock["now"] += seconds
+
+    monkeypatch.setattr(concurrency_logic.time, "monotonic", lambda: clock["now"])
+    monkeypatch.setattr(concurrency_logic.time, "sleep", sleep)
+    bucket = TokenBucket(rate=4, capacity=2)
+    for _ in range(6): bucket.acquire()
+    assert len(sleeps) == 4 # Two burst tokens, then one wait per request
+    assert abs(clock["now"] - 1.0) < 1e-9 # Four more tokens at 4/s take one second
@@ -0,0 +1,179 @@
+import io
+
+from geocoding_logic import geocode_cache_key, iter_route_batches, normalize_address, routes_are_contiguous
+
+
+class FakeGeocodeCache:
+    """Answers every address from a fixed table, so no request goes out."""
+
+    def __init__(self, coords_by_address):
+        self.entries = {geocode_cache_key(normalize_address(a)): {"coords": c, "status": "OK", "error": None, "message": None}
+                        for a, c in coords_by_address.items()}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return dict(entry) if entry is not None else None
+
+    def set(self, key, value, ttl_seconds=None):
+        self.entries[key] = value
+
+
+class Messages:
+    def __init__(self): self.warnings, self.errors = [], []
+    def warning(self, body, **kwargs): self.warnings.append(body)
+    def error(self, body, **kwargs): self.errors.append(body)
+    def info(self, body, **kwargs): pass
+
+
+ADDRESSES = {
+    "Depot A": (40.70, -74.00), "Depot B": (40.80, -73.90),
+    "Pickup A1": (40.71, -74.01), "Pickup A2": (40.72, -74.02), "Pickup B1": (40.81, -73.91),
+    "School A": (40.73, -74.03), "School B": (40.82, -73.92),
+}
+
+
+def load(csv_text, chunksize):
+    ui = Messages()
+    routes, failures = [], []
+    for batch, batch_failures in iter_route_batches(io.StringIO(csv_text), "key", ui=ui, chunksize=chunksize,
+                                                    cache=FakeGeocodeCache(ADDRESSES), max_workers=1):
+        routes.extend(batch)
+        failures.extend(batch_failures)
+    return {r["route_id"]: r for r in routes}, failures, ui
+
+
+def test_rows_ordered_by_sequence_keep_every_stop():
+    # All depots, then all pickups, then all dropoffs: no route is contiguous
+    csv_text = (
+        "Route,Location Type,Address,Sequence Number,Time\n"
+        "101,Depot,Depot A,0,\n"
+        "102,Depot,Depot B,0,\n"
+        "101,Pickup,Pickup A1,1,\n"
+        "102,Pickup,Pickup B1,1,\n"
+        "101,Pickup,Pickup A2,2,\n"
+        "101,Dropoff,School A,3,08:00\n"
+        "102,Dropoff,School B,2,08:15\n"
+    )
+    routes, failures, ui = load(csv_text, chunksize=2)
+    assert not failures and not ui.warnings
+    assert sorted(routes) == ["101", "102"]
+    assert routes["101"]["depot"] == ADDRESSES["Depot A"]
+    assert [p["location"] for p in routes["101"]["pickups"]] == [ADDRESSES["Pickup A1"], ADDRESSES["Pickup A2"]]
+    assert [d["location"] for d in routes["101"]["dropoffs"]] == [ADDRESSES["School A"]]
+    assert [p["location"] for p in routes["102"]["pickups"]] == [ADDRESSES["Pickup B1"]]
+    assert [d["location"] for d in routes["102"]["dropoffs"]] == [ADDRESSES["School B"]]
+
+
+def test_contiguous_routes_stream_across_chunks():
+    csv_text = (
+        "Route,Location Type,Address,Sequence Number\n"
+        "101,Depot,Depot A,0\n"
+        "101,Pickup,Pickup A1,1\n"
+        "101,Dropoff,School A,2\n"
+        "102,Depot,Depot B,0\n"
+        "102,Dropoff,School B,1\n"
+    )
+    assert routes_are_contiguous(io.StringIO(csv_text), chunksize=2)
+    batches = list(iter_route_batches(io.StringIO(csv_text), "key", ui=Messages(), chunksize=2,
+                                      cache=FakeGeocodeCache(ADDRESSES), max_workers=1))
+    assert [[r["route_id"] for r in batch] for batch, _ in batches] == [["101"], ["102"]]
+
+
+def test_blank_route_cell_does_not_turn_ids_into_floats():
+    # A NaN in the Route column used to make pandas parse the chunk as float ("101" -> "101.0")
+    csv_text = (
+        "Route,Location Type,Address,Sequence Number\n"
+        "101,Depot,Depot A,0\n"
+        ",Pickup,Pickup A1,1\n"
+        "101,Dropoff,School A,2\n"
+    )
+    routes, _, ui = load(csv_text, chunksize=2)
+    assert list(routes) == ["101"]
+    assert routes["101"]["dropoffs"][0]["location"] == ADDRESSES["School A"]
+    assert len(ui.warnings) == 1 # The blank row is reported and skipped
+
+
+def test_padded_headers_are_read_as_text():
+    csv_text = " Route ,Location Type,Address,Sequence Number\n007,Depot,Depot A,0\n007,Dropoff,School A,1\n"
+    routes, _, _ = load(csv_text, chunksize=10)
+    assert list(routes) == ["007"]
+
+
+class LockedCache(FakeGeocodeCache):
+    def set(self, key, value, ttl_seconds=None):
+        raise RuntimeError("database is locked")
+
+
+def test_cache_write_failure_does_not_abort_geocoding(monkeypatch):
+    import geocoding_logic
+    monkeypatch.setattr(geocoding_logic, "geocode_address", lambda address, *args, **kwargs: {
+        "coords": (40.0, -74.0), "status": "OK", "error": None, "message": None})
+    ui = Messages()
+    results = geocoding_logic.geocode_addresses(["New A", "New B"], "key", max_workers=1, cache=LockedCache({}), ui=ui)
+    assert [r["coords"] for r in results.values()] == [(40.0, -74.0), (40.0, -74.0)]
+    assert len(ui.warnings) == 1
+
+
+class UnreadableCache(FakeGeocodeCache):
+    def get(self, key):
+        raise RuntimeError("file is not a database")
+
+
+def test_cache_read_failure_is_treated_as_a_miss(monkeypatch):
+    import geocoding_logic
+    looked_up = []
+
+    def fake_geocode(address, *args, **kwargs):
+        looked_up.append(address)
+        return {"coords": (40.0, -74.0), "status": "OK", "error": None, "message": None}
+
+    monkeypatch.setattr(geocoding_logic, "geocode_address", fake_geocode)
+    ui = Messages()
+    results = geocoding_logic.geocode_addresses(["New A", "New B"], "key", max_workers=1, cache=UnreadableCache({}), ui=ui)
+    assert looked_up == ["New A", "New B"]
+    assert len(results) == 2
+    assert len(ui.warnings) == 1
+
+
+def test_out_of_order_file_keeps_first_seen_route_order():
+    # "20" sorts before "3" as text; routes should still come back in file order
+    csv_text = (
+        "Route,Location Type,Address,Sequence Number\n"
+        "3,Depot,Depot A,0\n"
+        "20,Depot,Depot B,0\n"
+        "3,Dropoff,School A,1\n"
+        "20,Dropoff,School B,1\n"
+    )
+    assert not routes_are_contiguous(io.StringIO(csv_text), chunksize=10)
+    routes, failures, _ = load(csv_text, chunksize=10)
+    assert not failures
+    assert list(routes) == ["3", "20"]
+
+
+def test_failed_address_is_retried_for_later_routes(monkeypatch):
+    import geocoding_logic
+    calls = []
+
+    def flaky_geocode(address, *args, **kwargs):
+        calls.append(address)
+        if len(calls) == 1: # The shared depot's first lookup hits a transient network error
+            return {"coords": None, "status": None, "error": "Network Error", "message": "timed out"}
+        return {"coords": ADDRESSES[address], "status": "OK", "error": None, "message": None}
+
+    monkeypatch.setattr(geocoding_logic, "geocode_address", flaky_geocode)
+    csv_text = (
+        "Route,Location Type,Address,Sequence Number\n"
+        "101,Depot,Depot A,0\n"
+        "101,Dropoff,School A,1\n"
+        "102,Depot,Depot A,0\n"
+        "102,Dropoff,School B,1\n"
+        "103,Depot,Depot A,0\n"
+        "103,Dropoff,School B,1\n"
+    )
+    routes, failures = {}, []
+    for batch, batch_failures in iter_route_batches(io.StringIO(csv_text), "key", ui=Messages(), chunksize=2, max_workers=1):
+        routes.update((r["route_id"], r) for r in batch)
+        failures.extend(batch_failures)
+    assert failures == ["Route 101: Depot A (Network Error)"]
+    assert routes["102"]["depot"] == routes["103"]["depot"] == ADDRESSES["Depot A"]
+    assert calls.count("Depot A") == 2 # Retried once, then memoized
@@ -0,0 +1,100 @@
+from map_logic import MapRenderCache
+
+
+class Messages:
+    def __init__(self): self.warnings = []
+    def warning(self, body, **kwargs): self.warnings.append(body)
+
+
+def test_builder_warnings_replay_on_every_hit():
+    cache, builds = MapRenderCache(), []
+
+    def build(messages):
+        builds.append(1)
+        messages.warning("Could not add marker for 'Pickup 2'")
+        return "map"
+
+    ui = Messages()
+    assert cache.get_or_build("route", build, ui=ui) == "map"
+    assert cache.get_or_build("route", build, ui=ui) == "map"
+    assert len(builds) == 1 and (cache.hits, cache.misses) == (1, 1)
+    assert ui.warnings == ["Could not add marker for 'Pickup 2'"] * 2
+
+
+def test_least_recently_used_map_is_dropped():
+    cache = MapRenderCache(max_entries=2)
+    for key in ["a", "b", "a", "c"]: cache.get_or_build(key, lambda: key.upper())
+    assert len(cache) == 2
+    assert cache.get_or_build("b", lambda: "rebuilt") == "rebuilt" and cache.misses == 4
+
+
+# --- Overview map: clustering, fitting, clipping and rebuild decisions ---
+
+import pandas as pd
+import polyline
+
+from map_logic import MAX_ZOOM, MIN_ZOOM, clamp_zoom, cluster_points, fit_zoom, overview_features, view_bounds, view_needs_rebuild
+from spatial_logic import GeometryCache
+
+
+def test_nearby_points_cluster_until_zoomed_in():
+    lats, lons = [40.7000, 40.7001, 40.8000], [-74.0000, -74.0001, -73.9000]
+    c_lats, c_lons, counts = cluster_points(lats, lons, zoom=10)
+    assert sorted(counts.tolist()) == [1, 2]
+    pair = counts.tolist().index(2)
+    assert abs(c_lats[pair] - 40.70005) < 1e-9 and abs(c_lons[pair] + 74.00005) < 1e-9 # Centroid of the pair
+    assert len(cluster_points(lats, lons, zoom=MAX_ZOOM)[2]) == 3
+    assert len(cluster_points([], [], zoom=10)[2]) == 0
+
+
+def test_fit_zoom_and_view_bounds():
+    assert fit_zoom([], []) == 11
+    assert fit_zoom([40.7], [-74.0]) == MAX_ZOOM # A single point is clamped, not infinite
+    assert fit_zoom([-60.0, 60.0], [-170.0, 170.0]) == MIN_ZOOM
+    city = fit_zoom([40.60, 40.85], [-74.05, -73.75])
+    assert MIN_ZOOM < city < MAX_ZOOM
+    south, west, north, east = view_bounds([40.725, -73.9], city, margin=0)
+    assert south < 40.60 and north > 40.85 and west < -74.05 and east > -73.75 # The fitted view shows every point
+    padded = view_bounds([40.725, -73.9], city)
+    assert padded[0] < south and padded[3] > east
+
+
+def test_view_needs_rebuild():
+    center = [40.7, -74.0]
+    assert not view_needs_rebuild(center, 12, [40.701, -74.001], 12) # Small pan within the sent area
+    assert view_needs_rebuild(center, 12, [41.5, -74.0], 12) # Panned out of it
+    assert view_needs_rebuild(center, 12, center, 13)
+    # Leaflet reporting a zoom below the map's minimum must not look like a new view forever
+    assert clamp_zoom(2) == MIN_ZOOM and clamp_zoom(25) == MAX_ZOOM
+    assert not view_needs_rebuild(center, MIN_ZOOM, center, clamp_zoom(2))
+
+
+def test_overview_map_limits_leaflet_zoom():
+    from map_logic import build_overview_map
+    plan_df = pd.DataFrame({"Route ID": ["R1"], "EV Eligibility": ["OK in All Weather"]})
+    routes = [{"route_id": "R1", "depot": (40.7, -74.0), "pickups": [], "dropoffs": [{"location": (40.8, -73.9)}]}]
+    m, stats = build_overview_map(plan_df, routes, [], GeometryCache(), zoom=1)
+    assert stats["zoom"] == MIN_ZOOM
+    html = m.get_root().render()
+    assert f'"minZoom": {MIN_ZOOM}' in html and f'"maxZoom": {MAX_ZOOM}' in html
+
+
+def test_overview_features_simplify_and_clip_to_view():
+    # A dense straight line in Manhattan and a short one far away in Buffalo
+    dense = [(40.70 + i * 0.001, -74.0) for i in range(101)]
+    far = [(42.88, -78.88), (42.89, -78.87)]
+    results = [{"Route ID": "R1", "AM Overview Polyline": polyline.encode(dense)},
+               {"Route ID": "R2", "AM Overview Polyline": polyline.encode(far)},
+               {"Route ID": "R3", "AM Overview Polyline": polyline.encode(far)}] # Not in the plan
+    plan_df = pd.DataFrame({"Route ID": ["R1", "R2"], "EV Eligibility": ["OK in All Weather", "Bogus"]})
+    cache = GeometryCache()
+
+    features, vertices = overview_features(plan_df, results, cache, zoom=12, latitude=40.75)
+    assert [f["properties"]["Route ID"] for f in features] == ["R1", "R2"]
+    assert features[1]["properties"]["color"] == "#808080" # Unknown eligibility
+    assert len(features[0]["geometry"]["coordinates"]) == 2 and vertices == 4 # Collinear points dropped
+    assert features[0]["geometry"]["coordinates"][0] == [-74.0, 40.7] # GeoJSON order is lon, lat
+
+    features, _ = overview_features(plan_df, results, cache, zoom=12, latitude=40.75, bounds=view_bounds([40.75, -74.0], 12))
+    assert [f["properties"]["Route ID"] for f in features] == ["R1"]
+    assert overview_features(plan_df, results, cache, zoom=12, latitude=40.75, trip_type="PM Trip") == ([], 0)
@@ -0,0 +1,86 @@
+from pipeline import changed_routes, duplicate_route_ids, mark_routes_calculated, merge_results
+
+
+def make_route(route_id, dropoffs=((40.73, -74.03),)):
+    return {"route_id": route_id, "depot": (40.70, -74.00), "pickups": [{"location": (40.71, -74.01), "sequence": 1}],
+            "dropoffs": [{"location": loc, "sequence": 2 + i, "bell_time": None} for i, loc in enumerate(dropoffs)]}
+
+
+def test_changed_routes_tracks_edits():
+    routes = [make_route("101"), make_route("102")]
+    assert [i for i, _ in changed_routes(routes)] == [0, 1]
+    mark_routes_calculated(routes)
+    assert changed_routes(routes) == []
+    routes[1]["pickups"].append({"location": (40.75, -74.05), "sequence": 3})
+    assert [i for i, _ in changed_routes(routes)] == [1]
+
+
+def test_merge_replaces_results_in_route_order():
+    routes = [make_route("101"), make_route("102")]
+    old = [{"Route ID": "102", "AM Distance (miles)": 5.0}, {"Route ID": "101", "AM Distance (miles)": 3.0}]
+    new = [{"Route ID": "102", "AM Distance (miles)": 6.0}]
+    merged = merge_results(routes, old, new, recomputed_ids=["102"])
+    assert [(r["Route ID"], r["AM Distance (miles)"]) for r in merged] == [("101", 3.0), ("102", 6.0)]
+
+
+def test_recomputed_route_without_result_drops_stale_result():
+    # Route 102 lost its dropoffs: calculate_route_feasibility skips it and returns no result
+    routes = [make_route("101"), make_route("102", dropoffs=())]
+    old = [{"Route ID": "101", "AM Distance (miles)": 3.0}, {"Route ID": "102", "AM Distance (miles)": 5.0}]
+    merged = merge_results(routes, old, [], recomputed_ids=["102"])
+    assert [r["Route ID"] for r in merged] == ["101"]
+
+
+def test_merge_drops_results_of_deleted_routes():
+    old = [{"Route ID": "101"}, {"Route ID": "gone"}]
+    assert [r["Route ID"] for r in merge_results([make_route("101")], old, [])] == ["101"]
+
+
+def test_duplicate_route_ids():
+    assert duplicate_route_ids([make_route("101"), make_route("102")]) == []
+    assert duplicate_route_ids([make_route("101"), make_route("102"), make_route("101")]) == ["101"]
+
+
+def test_bulk_matrix_requests_only_driven_legs():
+    from routing_logic import RoutingProvider, build_stop_matrix, trip_pairs
+    from pipeline import route_trip_stops
+
+    class Counting(RoutingProvider):
+        def __init__(self): self.requests, self.elements = 0, 0
+        def route(self, origin, waypoints, destination, departure_time=None, ui=None): return None, None, [], None
+        def matrix_tile(self, origins, destinations, ui=None):
+            self.requests += 1; self.elements += len(origins) * len(destinations)
+            return [[(1000.0, 60.0)] * len(destinations) for _ in origins]
+
+    # Three routes out of one depot to one school, two pickups each
+    depot, school = (40.70, -74.00), (40.80, -73.90)
+    routes = [{"route_id": f"R{r}", "depot": depot,
+               "pickups": [{"location": (40.71 + r / 100, -73.99), "sequence": 1}, {"location": (40.72 + r / 100, -73.98), "sequence": 2}],
+               "dropoffs": [{"location": school, "sequence": 3}]} for r in range(3)]
+    trips = [trip for route in routes for trip in route_trip_stops(route)]
+    provider = Counting()
+    matrix, request_count = build_stop_matrix(trips, provider)
+
+    # 3 routes x (3 AM + 3 PM legs); one 8 x 8 block would have billed 64 elements
+    assert len(matrix) == 8 and len(trip_pairs(trips)) == 18
+    assert (request_count, provider.requests, provider.elements) == (4, 4, 32)
+    assert matrix.covers(trips) and not matrix.covers(trips, all_pairs=True)
+
+
+def test_failed_matrix_request_is_not_covered():
+    from routing_logic import RoutingProvider, build_stop_matrix
+
+    class FailsOnce(RoutingProvider):
+        def __init__(self): self.calls = 0
+        def route(self, origin, waypoints, destination, departure_time=None, ui=None): return None, None, [], None
+        def matrix_tile(self, origins, destinations, ui=None):
+            self.calls += 1
+            if self.calls == 1: return None # e.g. OVER_QUERY_LIMIT
+            return [[(1000.0, 60.0)] * len(destinations) for _ in origins]
+
+    trips = [[(40.70, -74.00), (40.71, -73.99), (40.80, -73.90)]]
+    provider = FailsOnce()
+    matrix, _ = build_stop_matrix(trips, provider, all_pairs=True)
+    assert not matrix.covers(trips, all_pairs=True) # The failed pairs are fetched again next time
+    matrix, _ = build_stop_matrix(trips, provider, all_pairs=True)
+    assert matrix.covers(trips, all_pairs=True)
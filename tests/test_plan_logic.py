@@ -0,0 +1,117 @@
+import pandas as pd
+
+from plan_logic import assign_vehicles, process_fleet_data
+
+
+def make_fleet(quantity):
+    # 250 kWh nameplate -> 200 kWh usable -> 80 mi cold-weather range for a Type C bus
+    return process_fleet_data(pd.DataFrame({"Name": ["Lion C"], "Powertrain": ["EV"], "Type": ["C"],
+                                            "Quantity": [quantity], "Battery Capacity (kWh)": [250.0]}))
+
+
+def make_results():
+    return [
+        {"Route ID": "101", "AM Distance (miles)": 30.0, "PM Distance (miles)": 30.0, "Percent in DAC": 0.0},
+        {"Route ID": "102", "AM Distance (miles)": 30.0, "PM Distance (miles)": 30.0, "Percent in DAC": 100.0},
+        {"Route ID": "103", "AM Distance (miles)": 50.0, "PM Distance (miles)": 50.0, "Percent in DAC": 100.0},
+    ]
+
+
+def test_scarce_buses_go_to_dac_routes_first():
+    assignment = assign_vehicles(make_results(), {"101": "C", "102": "C", "103": "C"}, make_fleet(1)).set_index("Route ID")
+    assert assignment.at["102", "Assignment"] == "Electric"
+    assert assignment.at["102", "Assigned Vehicle"] == "Lion C #1"
+    assert assignment.at["101", "Assignment"] == "Diesel - Vehicles Exhausted"
+    assert assignment.at["103", "Assignment"] == "Diesel - No Bus In Range"
+
+
+def test_each_bus_is_assigned_at_most_once():
+    assignment = assign_vehicles(make_results(), {"101": "C", "102": "C", "103": "C"}, make_fleet(2))
+    electric = assignment[assignment["Assignment"] == "Electric"]
+    assert sorted(electric["Route ID"]) == ["101", "102"]
+    assert electric["Assigned Vehicle"].is_unique
+    assert (electric["Round Trip (mi)"] <= electric["Vehicle Range (mi)"]).all()
+
+
+def test_no_routes_gives_none():
+    assert assign_vehicles([], {}, make_fleet(1)) is None
+
+
+def test_assignment_carries_each_units_battery():
+    # Same Name, different batteries: the unit's own kWh must come through, not a name lookup
+    fleet = process_fleet_data(pd.DataFrame({"Name": ["Lion C", "Lion C"], "Powertrain": ["EV", "EV"], "Type": ["C", "C"],
+                                             "Quantity": [1, 1], "Battery Capacity (kWh)": [250.0, 150.0]}))
+    results = [{"Route ID": "101", "AM Distance (miles)": 20.0, "PM Distance (miles)": 20.0},
+               {"Route ID": "102", "AM Distance (miles)": 35.0, "PM Distance (miles)": 35.0}]
+    assignment = assign_vehicles(results, {"101": "C", "102": "C"}, fleet).set_index("Route ID")
+    assert assignment.at["102", "Battery (kWh)"] == 250.0 # Only the big battery reaches 70 mi
+    assert assignment.at["101", "Battery (kWh)"] == 150.0
+
+
+# --- Vectorized ranges and eligibility against the original per-row formulas ---
+
+def baseline_ranges(kwh, bus_type):
+    # The row-wise calc_ranges the vectorized process_fleet_data replaced
+    if pd.isna(kwh): return [None, None, None]
+    if bus_type == "A": return [round((kwh * 0.8) / 2, 1), round((kwh * 0.8) / 1.5, 1), round((kwh * 0.8) / 1.0, 1)]
+    if bus_type == "C": return [round((kwh * 0.8) / 2.5, 1), round((kwh * 0.8) / 1.8, 1), round((kwh * 0.8) / 1.5, 1)]
+    return [None, None, None]
+
+
+def baseline_eligibility(row):
+    in_dac = pd.to_numeric(row.get("Percent in DAC"), errors='coerce')
+    dac_preference = (in_dac is not None and in_dac > 70)
+    cold_ok = bool(row.get("Eligible Buses < 50°F") and row["Eligible Buses < 50°F"] not in ["None", "N/A"])
+    mild_ok = bool(row.get("Eligible Buses 50–70°F") and row["Eligible Buses 50–70°F"] not in ["None", "N/A"])
+    warm_ok = bool(row.get("Eligible Buses 70°F+") and row["Eligible Buses 70°F+"] not in ["None", "N/A"])
+    if dac_preference and cold_ok: return "Preferred - All Weather"
+    elif cold_ok: return "OK in All Weather"
+    elif mild_ok: return "OK > 50°F Weather"
+    elif warm_ok: return "OK > 70°F Weather"
+    else: return "NOT FEASIBLE (No Bus)"
+
+
+def test_fleet_ranges_match_the_row_wise_formula():
+    import numpy as np
+    from plan_logic import RANGE_COLS
+    # Quarter-kWh steps hit many x.x5 ties where np.round and round() can disagree
+    kwh = list(np.arange(50.0, 400.0, 0.25)) + [0.3125, 113.4375, 155.0, None, float("nan")]
+    types = (["A", "C"] * len(kwh))[:len(kwh)]
+    fleet = pd.DataFrame({"Name": [f"Bus {i}" for i in range(len(kwh) + 2)], "Powertrain": ["EV"] * len(kwh) + ["EV", "Diesel"],
+                          "Type": types + ["B", "C"], "Quantity": 1, "Battery Capacity (kWh)": kwh + [200.0, 200.0]})
+    ev_fleet = process_fleet_data(fleet)
+    assert len(ev_fleet) == len(kwh) + 1 # The diesel bus is dropped
+    for (_, row), k, t in zip(ev_fleet.iterrows(), kwh + [200.0], types + ["B"]):
+        expected = baseline_ranges(k, t)
+        for col, value in zip(RANGE_COLS, expected):
+            assert (pd.isna(row[col]) and value is None) or row[col] == value, (k, t, col)
+
+
+def test_eligibility_labels_match_the_row_wise_rules():
+    from plan_logic import classify_eligibility
+    # build_plan always fills the eligible-bus columns with strings, so missing values aren't compared
+    cases = [ # (Percent in DAC, cold, mild, warm)
+        (70.0, "Bus 1", "Bus 1", "Bus 1"), (70.01, "Bus 1", "Bus 1", "Bus 1"), (100.0, "None", "Bus 1", "Bus 1"),
+        (None, "Bus 1", "", ""), ("n/a", "Bus 1", "Bus 1", "Bus 1"), (0.0, "N/A", "None", "Bus 1"),
+        (0.0, "None", "None", "None"), (85.0, "", "", "Bus 2"), (71, "Bus 1, Bus 2", "None", "None"),
+    ]
+    plan_df = pd.DataFrame(cases, columns=["Percent in DAC", "Eligible Buses < 50°F", "Eligible Buses 50–70°F", "Eligible Buses 70°F+"])
+    assert list(classify_eligibility(plan_df)) == [baseline_eligibility(row) for _, row in plan_df.iterrows()]
+
+
+def test_eligible_bus_names_match_the_row_wise_filter():
+    from plan_logic import ELIGIBLE_COLS, RANGE_COLS, build_plan
+    ev_fleet = pd.DataFrame({
+        "Name": ["Short", "Long", "Short", None, "Bad"], "Type": ["C", "C", "C", "C", "C"], "Quantity": 1,
+        "Cold Weather Range": [60.0, 80.0, 70.0, 90.0, "x"], "Average Weather Range": [80.0, 100.0, 90.0, 95.0, "x"],
+        "Warm Weather Range": [100.0, 120.0, 110.0, 99.0, "x"],
+    })
+    round_trips = [0.0, 60.0, 60.01, 70.0, 80.0, 80.01, 100.0, 120.0, 130.0]
+    results = [{"Route ID": f"R{i}", "AM Distance (miles)": d / 2, "PM Distance (miles)": d / 2, "Percent in DAC": 0.0}
+               for i, d in enumerate(round_trips)]
+    plan = build_plan(results, {}, ev_fleet, default_type="C").set_index("Route ID")
+    for i, d in enumerate(round_trips):
+        for range_col in RANGE_COLS:
+            eligible = ev_fleet[pd.to_numeric(ev_fleet[range_col], errors='coerce').fillna(0) >= d]
+            names = eligible["Name"].dropna().unique()
+            assert plan.at[f"R{i}", ELIGIBLE_COLS[range_col]] == (", ".join(names) if len(names) > 0 else "None"), (d, range_col)
@@ -0,0 +1,61 @@
+import pytest
+
+from routing_logic import RoutingProvider
+
+
+def test_provider_without_route_fails_at_construction():
+    class Incomplete(RoutingProvider):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_matrix_tile_falls_back_to_route_calls():
+    class Straight(RoutingProvider):
+        def route(self, origin, waypoints, destination, departure_time=None, ui=None):
+            return 1.0, 2.0, [], None
+
+    rows = Straight().matrix_tile([(40.0, -74.0)], [(40.1, -74.0), (40.2, -74.0)])
+    assert len(rows) == 1 and len(rows[0]) == 2 and all(cell is not None for cell in rows[0])
+
+
+def test_distance_matrix_survives_non_json_response(monkeypatch):
+    import routing_logic
+
+    class HtmlResponse:
+        status_code = 200
+        def raise_for_status(self): pass
+        def json(self): raise ValueError("Expecting value: line 1 column 1 (char 0)")
+
+    monkeypatch.setattr(routing_logic.requests, "get", lambda *args, **kwargs: HtmlResponse())
+    errors = []
+    ui = type("UI", (), {"error": lambda self, body, **kw: errors.append(body), "warning": lambda self, body, **kw: None})()
+    rows = routing_logic.get_distance_matrix("key", [(40.0, -74.0)], [(40.1, -74.0), (40.2, -74.0)], ui=ui)
+    assert rows is None and len(errors) == 1 # Failed as a whole, not "no route" per element
+
+
+def make_graph():
+    # 0 -> 1 -> 3 is short but slow; 0 -> 2 -> 3 is longer but fast; 4 is unreachable
+    from routing_logic import RoadGraph
+    lat = [40.700, 40.700, 40.710, 40.700, 40.800]
+    lon = [-74.000, -73.990, -73.990, -73.980, -73.900]
+    edges = [(0, 1, 850.0, 200.0), (1, 3, 850.0, 200.0), (0, 2, 1400.0, 80.0), (2, 3, 1400.0, 80.0), (3, 0, 1700.0, 300.0)]
+    u, v, length, duration = zip(*edges)
+    return RoadGraph(lat, lon, u, v, length, duration)
+
+
+def test_shortest_path_is_fastest_and_matches_dijkstra():
+    graph = make_graph()
+    path, length_m, duration_s = graph.shortest_path(0, 3)
+    assert path == [0, 2, 3] and length_m == 2800.0 and duration_s == 160.0
+    assert graph.shortest_paths_from(0, [3])[3] == (length_m, duration_s)
+    assert graph.shortest_path(1, 1) == ([1], 0.0, 0.0)
+    assert graph.shortest_path(0, 4) is None
+
+
+def test_local_provider_routes_through_waypoints():
+    from routing_logic import LocalGraphProvider, METERS_PER_MILE
+    miles, minutes, legs, encoded = LocalGraphProvider(make_graph()).route((40.700, -74.000), [(40.710, -73.990)], (40.700, -73.980))
+    assert len(legs) == 2 and encoded
+    assert abs(miles - 2800.0 / METERS_PER_MILE) < 1e-9 and abs(minutes - 160.0 / 60) < 1e-9
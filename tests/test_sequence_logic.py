@@ -0,0 +1,61 @@
+import random
+
+from routing_logic import haversine_m
+from sequence_logic import apply_route_order, optimize_route_order, optimize_routes, pm_waypoint_stops
+
+
+class StraightLineMatrix:
+    """StopMatrix stand-in: great-circle meters between any two points."""
+
+    def lookup(self, origin, destination):
+        meters = float(haversine_m(origin[0], origin[1], destination[0], destination[1]))
+        return (meters, meters / 10.0)
+
+
+def make_route(pickup_points, school_points, depot=(40.70, -74.00)):
+    pickups = [{"location": p, "sequence": i + 1} for i, p in enumerate(pickup_points)]
+    dropoffs = [{"location": s, "sequence": len(pickups) + i + 1} for i, s in enumerate(school_points)]
+    return {"route_id": "R1", "depot": depot, "pickups": pickups, "dropoffs": dropoffs}
+
+
+def test_optimized_trips_are_never_longer():
+    rng = random.Random(7)
+    matrix = StraightLineMatrix()
+    for _ in range(25):
+        pickups = [(40.70 + rng.uniform(0, 0.1), -74.00 + rng.uniform(0, 0.1)) for _ in range(rng.randint(0, 7))]
+        schools = [(40.70 + rng.uniform(0, 0.1), -74.00 + rng.uniform(0, 0.1)) for _ in range(rng.randint(1, 3))]
+        result = optimize_route_order(make_route(pickups, schools), matrix, time_budget_seconds=1.0)
+        assert result["am_after_mi"] <= result["am_before_mi"] + 1e-9
+        assert result["pm_after_mi"] <= result["pm_before_mi"] + 1e-9
+
+
+def test_zigzag_pickups_are_straightened():
+    # Pickups on a line north of the depot, listed out of order; the school is further north
+    route = make_route([(40.72, -74.0), (40.71, -74.0), (40.73, -74.0)], [(40.75, -74.0)])
+    result = optimize_route_order(route, StraightLineMatrix())
+    assert result["am_pickup_order"] == [1, 0, 2]
+    assert result["am_after_mi"] < result["am_before_mi"]
+
+
+def test_route_without_depot_is_skipped():
+    route = make_route([(40.71, -74.0)], [(40.75, -74.0)], depot=None)
+    assert optimize_route_order(route, StraightLineMatrix()) is None
+    new_routes, summary = optimize_routes([route], StraightLineMatrix())
+    assert new_routes == [route]
+    assert list(summary["Status"]) == ["Skipped"]
+
+
+def test_pm_order_is_remapped_to_the_reordered_pickups():
+    route = make_route([(40.71, -74.0), (40.72, -74.0), (40.73, -74.0)], [(40.75, -74.0), (40.76, -74.0)])
+    a, b, c = route["pickups"]
+    optimized = {"am_pickup_order": [2, 0, 1], "pm_pickup_order": [0, 1, 2]} # Old indices A, B, C
+    new_route = apply_route_order(route, optimized)
+    assert new_route["pickups"] == [c, a, b]
+    assert new_route["pm_pickup_order"] == [1, 2, 0]
+    assert pm_waypoint_stops(new_route) == [route["dropoffs"][0], a, b, c]
+    assert "pm_pickup_order" not in route # The input route is left alone
+
+    # Re-applying an AM-only result drops the stale PM order
+    again = apply_route_order(new_route, {"am_pickup_order": [0, 1, 2], "pm_pickup_order": None})
+    assert "pm_pickup_order" not in again
+    assert pm_waypoint_stops(again) == sorted(route["dropoffs"][:-1] + route["pickups"], key=lambda x: x["sequence"], reverse=True)
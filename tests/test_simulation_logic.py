@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from simulation_logic import route_temperatures, simulate_fleet, soc_timeline
+
+
+def make_result(route_id, leg_miles):
+    legs = [{"Distance (mi)": miles, "Duration (min)": miles * 2} for miles in leg_miles]
+    return {"Route ID": route_id, "Leg Details": legs, "PM Leg Details": list(reversed(legs))}
+
+
+FLEET = pd.DataFrame({"Name": ["Lion C"], "Type": ["C"], "Battery Capacity (kWh)": [250.0]})
+
+
+def run(results, days=3, temperature_f=60.0):
+    dates = pd.bdate_range("2026-09-08", periods=days)
+    route_ids = [r["Route ID"] for r in results]
+    am_temps, pm_temps = route_temperatures(route_ids, {}, dates, fixed_temperature_f=temperature_f)
+    return simulate_fleet(results, [], {rid: "C" for rid in route_ids}, FLEET, dates, am_temps, pm_temps)
+
+
+def test_short_route_passes_and_long_route_fails_every_day():
+    # 1.8 kWh/mi for Type C at 60°F: 40 mi/day uses ~72 kWh, 120 mi/day ~216 kWh (> 200 usable)
+    summary, failures = run([make_result("101", [10.0, 10.0]), make_result("102", [30.0, 30.0])])
+    summary = summary.set_index("Route ID")
+    assert summary.at["101", "Days Failed"] == 0
+    assert summary.at["102", "Days Failed"] == 3
+    assert summary.at["102", "First Failure Date"] == "2026-09-08"
+    assert set(failures["Route ID"]) == {"102"} and failures["Fails During"].str.startswith("PM").all()
+
+
+def test_midday_charging_rescues_the_long_route():
+    results = [make_result("102", [30.0, 30.0])]
+    dates = pd.bdate_range("2026-09-08", periods=1)
+    am_temps, pm_temps = route_temperatures(["102"], {}, dates, fixed_temperature_f=60.0)
+    summary, _ = simulate_fleet(results, [], {"102": "C"}, FLEET, dates, am_temps, pm_temps, charge_kw=19.2)
+    assert summary.at[0, "Days Failed"] == 0
+
+
+def test_timeline_starts_full_and_ends_at_simulated_soc():
+    result = make_result("101", [10.0, 10.0])
+    timeline = soc_timeline(result, None, "C", 250.0, 60.0, 60.0)
+    assert timeline["SoC (kWh)"].iloc[0] == 250.0
+    assert timeline["Event"].iloc[0] == "Depart Depot" and timeline["SoC (kWh)"].is_monotonic_decreasing
+    assert np.isclose(timeline["SoC (kWh)"].iloc[-1], 250.0 - 40 * 1.8, atol=0.5)
+
+
+def test_assigned_vehicle_battery_comes_from_the_assignment():
+    from simulation_logic import route_vehicles
+    assignment = pd.DataFrame({"Route ID": ["101", "102"], "Assignment": ["Electric", "Diesel - No Bus In Range"],
+                               "Assigned Vehicle": ["Bus #7 #1", None], "Battery (kWh)": [180.0, np.nan]})
+    labels, capacity = route_vehicles(["101", "102"], {"101": "C", "102": "C"}, FLEET, assignment)
+    assert labels == ["Bus #7 #1", "Best Type C EV"]
+    assert capacity.tolist() == [180.0, 250.0]
@@ -0,0 +1,84 @@
+import numpy as np
+import shapely
+from shapely.errors import GEOSException
+
+import spatial_logic
+from spatial_logic import DACIndex
+
+
+def make_index():
+    return DACIndex([shapely.box(0, 0, 1, 1), shapely.box(2, 0, 3, 1), shapely.box(5, 5, 6, 6)])
+
+
+def test_intersection_length_sums_pieces_inside_polygons():
+    line = shapely.linestrings([(-1, 0.5), (4, 0.5)])
+    assert make_index().intersection_length(line) == 2.0
+
+
+def test_failing_polygon_is_skipped_not_the_whole_route(monkeypatch):
+    index = make_index()
+    bad = index.geometries[1]
+    real_intersection = shapely.intersection
+
+    def flaky_intersection(a, b):
+        if isinstance(b, np.ndarray) or b is bad:
+            raise GEOSException("TopologyException")
+        return real_intersection(a, b)
+
+    monkeypatch.setattr(spatial_logic.shapely, "intersection", flaky_intersection)
+    errors = []
+    line = shapely.linestrings([(-1, 0.5), (4, 0.5)])
+    assert index.intersection_length(line, on_error=errors.append) == 1.0
+    assert len(errors) == 1
+
+
+def make_zip_areas():
+    from spatial_logic import ZipAreaIndex
+    # Two touching squares in lon/lat; 10002 shares the x = 1 border with 10001
+    return ZipAreaIndex(["10001", "10002"], ["10001", "10002"], [shapely.box(0, 0, 1, 1), shapely.box(1, 0, 2, 1)])
+
+
+def test_label_points_uses_polygons_and_lowest_area_on_borders():
+    lats, lons = [0.5, 0.5, 0.5, 5.0], [0.5, 1.5, 1.0, 5.0]
+    assert make_zip_areas().label_points(lats, lons) == ["10001", "10002", "10001", None]
+    assert make_zip_areas().label_points([], []) == []
+
+
+def test_stops_outside_areas_fall_back_to_nearest_centroid():
+    from spatial_logic import ZipIndex, label_route_stops
+    zip_index = ZipIndex([501, 90210, 10001], [40.8, 34.1, 0.5], [-73.0, -118.4, 0.5])
+    lats, lons = [40.7, 34.0, 33.0], [-73.1, -118.3, -117.0]
+    assert zip_index.nearest_zips(lats, lons, chunk_points=2) == [zip_index.nearest(lat, lon)[0][0] for lat, lon in zip(lats, lons)]
+
+    routes = [{"depot": (0.5, 0.5), "pickups": [{"location": (40.7, -73.1)}], "dropoffs": [{"location": (34.0, -118.3)}, {"location": None}]}]
+    memo = {}
+    assert label_route_stops(routes, make_zip_areas(), zip_index, memo=memo) == [["10001", "00501", "90210", None]]
+
+    # A second call answers from the memo; routes that are gone drop out of it
+    assert label_route_stops(routes, None, None, memo=memo) == [["10001", "00501", "90210", None]]
+    label_route_stops([], None, None, memo=memo)
+    assert memo == {}
+
+
+def test_zip_store_round_trip_and_source_changes(tmp_path):
+    import os
+    from spatial_logic import load_zip_arrays, store_is_fresh
+
+    csv_path, store_dir = tmp_path / "uszips.csv", str(tmp_path / "store")
+    csv_path.write_text("zip,lat,lng\n10002,40.71,-73.98\n00501,40.81,-73.04\nabc,1,1\n")
+    arrays = load_zip_arrays(str(csv_path), store_dir)
+    assert arrays["zip"].tolist() == [501, 10002] # Sorted, non-numeric dropped
+    assert abs(float(arrays["latitude"][1]) - 40.71) < 1e-5
+    assert store_is_fresh(store_dir, str(csv_path))
+
+    # An edited source invalidates the store and the next load rebuilds it
+    csv_path.write_text("zip,lat,lng\n10002,40.71,-73.98\n")
+    os.utime(csv_path, ns=(1, 1))
+    assert not store_is_fresh(store_dir, str(csv_path))
+    assert load_zip_arrays(str(csv_path), store_dir)["zip"].tolist() == [10002]
+
+    # Without the source, the existing store is still usable
+    csv_path.unlink()
+    assert store_is_fresh(store_dir, str(csv_path))
+    assert load_zip_arrays(str(csv_path), store_dir)["zip"].tolist() == [10002]
+    assert not store_is_fresh(str(tmp_path / "missing"), str(csv_path))
@@ -0,0 +1,34 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from weather_logic import Climatology, evaluate_school_year, school_days
+
+
+def make_climatology():
+    temperatures = np.full((2, 366, 24), 50.0, dtype=np.float32)
+    temperatures[1] = 20.0
+    return Climatology(np.array(["10001", "10002"]), temperatures)
+
+
+def make_fleet():
+    return pd.DataFrame({"Name": ["Lion C"], "Type": ["C"], "Battery Capacity (kWh)": [210.0]})
+
+
+def test_unknown_bus_type_gives_nan_without_warnings():
+    results = [{"Route ID": "101", "AM Distance (miles)": 20.0, "PM Distance (miles)": 20.0},
+               {"Route ID": "102", "AM Distance (miles)": 20.0, "PM Distance (miles)": 20.0}]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        route_summary, daily_summary, energy = evaluate_school_year(
+            results, {"101": "C", "102": "Z"}, {"101": "10001", "102": "99999"}, make_fleet(), make_climatology(),
+            school_days("2026-09-08", 5))
+    assert route_summary["Days Feasible"].tolist() == [5, 0]
+    assert np.isnan(route_summary.at[1, "Peak Energy (kWh)"])
+    assert len(daily_summary) == 5 and energy.shape == (2, 5)
+
+
+def test_unknown_zip_uses_area_mean():
+    temps = make_climatology().trip_temperatures(["10001", "99999"], school_days("2026-09-08", 2), (7,))
+    assert temps.tolist() == [[50.0, 50.0], [35.0, 35.0]]
@@ -0,0 +1,201 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from plan_logic import EFFICIENCY_KWH_PER_MILE, RANGE_COLS, USABLE_BATTERY_FRACTION
+
+# Temperature-aware range model. Replaces the three fixed weather bands with
+# per-route, per-date energy demand: each route's trips are priced at the
+# climatological temperature of its depot ZIP at the hours the bus runs, on
+# every school day, as one (routes x days) NumPy array.
+# Pure pandas/NumPy, no Streamlit.
+
+CLIMATOLOGY_PATH = ".data/hourly_climatology.csv"
+SCHOOL_YEAR_DAYS = 180
+AM_SERVICE_HOURS = (6, 7, 8) # Local hours the AM trip is on the road
+PM_SERVICE_HOURS = (14, 15, 16)
+
+# Temperature (°F) each plan_logic weather band is taken to represent. The
+# consumption curve interpolates EFFICIENCY_KWH_PER_MILE between these points
+# and holds the end values outside them.
+BAND_TEMPERATURES_F = {"Cold Weather Range": 35.0, "Average Weather Range": 60.0, "Warm Weather Range": 80.0}
+
+CLIMATOLOGY_REQUIRED_COLS = ["ZIP", "Hour", "Temperature (F)"]
+
+
+class Climatology:
+    """
+    Hourly temperature normals per ZIP and day of year.
+
+    Args:
+        zips: Sorted ZIP strings.
+        temperatures: float32 array (len(zips), 366, 24) in °F; NaN where unknown.
+    """
+
+    def __init__(self, zips, temperatures):
+        self.zips = np.asarray(zips)
+        self.temperatures = np.asarray(temperatures, dtype=np.float32)
+        # City-wide normal, used for ZIPs (or cells) the file doesn't cover
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # All-NaN cells stay NaN
+            self.area_mean = np.nanmean(self.temperatures, axis=0) if len(self.zips) else np.full((366, 24), np.nan, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.zips)
+
+    def zip_positions(self, zip_codes):
+        """Row of each ZIP in temperatures, -1 for ZIPs not in the file."""
+        zip_codes = np.asarray([str(z).strip().zfill(5) if z is not None else "" for z in zip_codes])
+        if len(self.zips) == 0: return np.full(len(zip_codes), -1)
+        pos = np.minimum(np.searchsorted(self.zips, zip_codes), len(self.zips) - 1)
+        return np.where(self.zips[pos] == zip_codes, pos, -1)
+
+    def trip_temperatures(self, zip_codes, dates, hours):
+        """Mean temperature over hours for every (ZIP, date): array (len(zip_codes), len(dates))."""
+        rows = self.zip_positions(zip_codes)
+        days = pd.DatetimeIndex(dates).dayofyear.to_numpy() - 1
+        hours = np.asarray(hours, dtype=int)
+        fallback = self.area_mean[days][:, hours] # (days, hours)
+        if len(self.zips):
+            cells = self.temperatures[np.maximum(rows, 0)[:, None, None], days[None, :, None], hours[None, None, :]]
+            cells = np.where((rows >= 0)[:, None, None] & ~np.isnan(cells), cells, fallback[None, :, :])
+        else:
+            cells = np.broadcast_to(fallback, (len(rows),) + fallback.shape)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # All-NaN cells stay NaN
+            return np.nanmean(cells, axis=2).astype(float) if cells.shape[2] else np.full(cells.shape[:2], np.nan)
+
+
+def load_climatology(source):
+    """
+    Reads an hourly climatology CSV (path or file-like) into a Climatology.
+    Columns: ZIP, Hour (0-23), Temperature (F), and either Day of Year (1-366) or
+    Date (several years of the same day are averaged). Raises ValueError if
+    required columns are missing.
+    """
+    raw = pd.read_csv(source, dtype={"ZIP": str})
+    missing = [c for c in CLIMATOLOGY_REQUIRED_COLS if c not in raw.columns]
+    if "Day of Year" not in raw.columns and "Date" not in raw.columns:
+        missing.append("Day of Year (or Date)")
+    if missing:
+        raise ValueError(f"Climatology file missing required columns: {', '.join(missing)}")
+
+    if "Day of Year" in raw.columns:
+        day = pd.to_numeric(raw["Day of Year"], errors="coerce")
+    else:
+        day = pd.to_datetime(raw["Date"], errors="coerce").dt.dayofyear
+    frame = pd.DataFrame({
+        "zip": raw["ZIP"].astype(str).str.strip().str.zfill(5),
+        "day": day,
+        "hour": pd.to_numeric(raw["Hour"], errors="coerce"),
+        "temp": pd.to_numeric(raw["Temperature (F)"], errors="coerce"),
+    }).dropna()
+    frame = frame[frame["day"].between(1, 366) & frame["hour"].between(0, 23)]
+    normals = frame.groupby(["zip", "day", "hour"], sort=False)["temp"].mean().reset_index()
+
+    zips, zip_rows = np.unique(normals["zip"].to_numpy(), return_inverse=True)
+    temperatures = np.full((len(zips), 366, 24), np.nan, dtype=np.float32)
+    temperatures[zip_rows, normals["day"].to_numpy(dtype=int) - 1, normals["hour"].to_numpy(dtype=int)] = normals["temp"].to_numpy()
+    # Files without leap years never fill day 366 (Dec 31 of a leap year); reuse day 365
+    temperatures[:, 365] = np.where(np.isnan(temperatures[:, 365]), temperatures[:, 364], temperatures[:, 365])
+    return Climatology(zips, temperatures)
+
+
+def consumption_kwh_per_mile(bus_types, temperatures, efficiency_table=EFFICIENCY_KWH_PER_MILE):
+    """
+    kWh/mile for each route (bus_types, length R) at each temperature (array R x D),
+    interpolated along the band table. Unknown temperatures use the cold-band value;
+    unknown bus types give NaN.
+    """
+    temperatures = np.asarray(temperatures, dtype=float)
+    bus_types = np.asarray(bus_types)
+    knots = np.array([BAND_TEMPERATURES_F[col] for col in RANGE_COLS])
+    order = np.argsort(knots)
+    out = np.full(temperatures.shape, np.nan)
+    for bus_type in np.unique(bus_types):
+        if bus_type not in efficiency_table.index: continue
+        values = efficiency_table.loc[bus_type, RANGE_COLS].to_numpy(dtype=float)
+        rows = bus_types == bus_type
+        temps = np.where(np.isnan(temperatures[rows]), knots.min(), temperatures[rows])
+        out[rows] = np.interp(temps, knots[order], values[order])
+    return out
+
+
+def school_days(first_day, n_days=SCHOOL_YEAR_DAYS):
+    """The first n_days weekdays starting at first_day."""
+    return pd.bdate_range(start=pd.Timestamp(first_day), periods=n_days)
+
+
+def fleet_capacity_by_type(ev_fleet):
+    """{bus type: largest usable kWh of any EV of that type} (the best bus a route could get)."""
+    if ev_fleet is None or ev_fleet.empty: return {}
+    kwh = pd.to_numeric(ev_fleet["Battery Capacity (kWh)"], errors="coerce") * USABLE_BATTERY_FRACTION
+    return kwh.groupby(ev_fleet["Type"]).max().dropna().to_dict()
+
+
+def evaluate_school_year(results, route_bus_types, route_zips, ev_fleet, climatology, dates,
+                         efficiency_table=EFFICIENCY_KWH_PER_MILE, default_type="A"):
+    """
+    Energy demand and feasibility of every route on every date, assuming no midday charging.
+
+    Args:
+        results: st.session_state.results (per-route dicts with AM/PM Distance (miles)).
+        route_bus_types: {route_id: "A" | "C"}.
+        route_zips: {route_id: ZIP string} of each route's depot (sets its temperatures).
+        ev_fleet: Output of plan_logic.process_fleet_data.
+        climatology: Climatology.
+        dates: School days (e.g. from school_days()).
+
+    Returns:
+        (route summary DataFrame, per-date summary DataFrame, energy DataFrame of kWh
+        with one row per route and one column per date), or None if there are no routes.
+    """
+    rows = [r for r in results if r.get("Route ID")]
+    if not rows:
+        return None
+    dates = pd.DatetimeIndex(dates)
+    route_ids = np.array([r.get("Route ID") for r in rows], dtype=object)
+    bus_types = np.array([route_bus_types.get(rid, default_type) for rid in route_ids], dtype=object)
+    zips = [route_zips.get(rid) for rid in route_ids]
+    am_miles = np.array([r.get("AM Distance (miles)") or 0.0 for r in rows], dtype=float)
+    pm_miles = np.array([r.get("PM Distance (miles)") or 0.0 for r in rows], dtype=float)
+
+    # (routes x days) temperatures and energy
+    am_temps = climatology.trip_temperatures(zips, dates, AM_SERVICE_HOURS)
+    pm_temps = climatology.trip_temperatures(zips, dates, PM_SERVICE_HOURS)
+    energy = (am_miles[:, None] * consumption_kwh_per_mile(bus_types, am_temps, efficiency_table)
+              + pm_miles[:, None] * consumption_kwh_per_mile(bus_types, pm_temps, efficiency_table))
+
+    capacity_by_type = fleet_capacity_by_type(ev_fleet)
+    capacity = np.array([capacity_by_type.get(t, np.nan) for t in bus_types], dtype=float)
+    feasible = energy <= capacity[:, None] # NaN capacity or energy -> infeasible
+    days_feasible = feasible.sum(axis=1)
+    first_bad = np.where(~feasible.all(axis=1), np.argmin(feasible, axis=1), -1) if len(dates) else np.full(len(rows), -1)
+
+    # nanmax/nanmean warn through `warnings` (not np.errstate) on all-NaN rows, e.g. unknown
+    # bus types; those rows are meant to come out NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        peak_energy = np.round(np.nanmax(energy, axis=1), 1) if len(dates) else np.nan
+        am_mean, pm_mean = np.nanmean(am_temps, axis=0), np.nanmean(pm_temps, axis=0)
+    route_summary = pd.DataFrame({
+        "Route ID": route_ids,
+        "ZIP": [z if z else "N/A" for z in zips],
+        "Bus Type": bus_types,
+        "Round Trip (mi)": np.round(am_miles + pm_miles, 2),
+        "Peak Energy (kWh)": peak_energy,
+        "Best Bus Usable (kWh)": np.round(capacity, 1),
+        "Days Feasible": days_feasible,
+        "Days Not Feasible": len(dates) - days_feasible,
+        "First Infeasible Date": [dates[i].strftime("%Y-%m-%d") if i >= 0 else "None" for i in first_bad],
+    })
+    daily_summary = pd.DataFrame({
+        "Date": dates.strftime("%Y-%m-%d"),
+        "AM Temp (°F)": np.round(am_mean, 1),
+        "PM Temp (°F)": np.round(pm_mean, 1),
+        "Routes Feasible": feasible.sum(axis=0),
+        "Routes Not Feasible": len(rows) - feasible.sum(axis=0),
+    })
+    energy_df = pd.DataFrame(np.round(energy, 1), index=pd.Index(route_ids, name="Route ID"), columns=dates.strftime("%Y-%m-%d"))
+    return route_summary, daily_summary, energy_df